@@ -13,6 +13,7 @@ from metadata_registration_api.errors import (
     TokenException,
     IdenticalPropertyException,
     RequestBodyException,
+    IdempotencyKeyException,
 )
 
 authorizations = {
@@ -37,6 +38,8 @@ from . import api_study_sample
 from . import api_user
 from . import api_state
 from . import api_ids
+from . import api_job
+from . import api_monitoring
 
 api.add_namespace(api_props.api, path=os.environ.get("API_EP_PROPERTY", "/properties"))
 api.add_namespace(api_ctrl_voc.api, path=os.environ.get("API_EP_CTRL_VOC", "/ctrl_voc"))
@@ -49,6 +52,10 @@ api.add_namespace(api_study_sample.api, path=os.environ.get("API_EP_STUDY", "/st
 api.add_namespace(api_user.api, path=os.environ.get("API_EP_USER", "/users"))
 api.add_namespace(api_state.api, path=os.environ.get("API_EP_STATE", "/states"))
 api.add_namespace(api_ids.api, path=os.environ.get("API_EP_IDS", "/ids"))
+api.add_namespace(api_job.api, path=os.environ.get("API_EP_JOB", "/jobs"))
+api.add_namespace(
+    api_monitoring.api, path=os.environ.get("API_EP_MONITORING", "/monitoring")
+)
 
 
 @api.errorhandler(TokenException)
@@ -64,6 +71,11 @@ def state_machine_exception(error):
     return {"error_type": str(error.__class__.__name__), "message": str(error)}, 422
 
 
+@api.errorhandler(IdempotencyKeyException)
+def handle_idempotency_key_error(error):
+    return {"error_type": str(error.__class__.__name__), "message": str(error)}, 409
+
+
 @api.errorhandler(NotUniqueError)
 def handle_not_unique_error(error):
     return {
@@ -1,3 +1,4 @@
+from flask import current_app as app
 from flask_restx import Namespace, Resource, fields
 from flask_restx import reqparse, inputs
 from mongoengine.errors import ValidationError
@@ -126,6 +127,7 @@ class ApiControlledVocabulary(Resource):
         """ Add a new entry """
         entry = ControlledVocabulary(**api.payload)
         entry = entry.save()
+        app.reference_registry.invalidate()
         return {"message": f"Add entry '{entry.name}'", "id": str(entry.id)}, 201
 
     @token_required
@@ -140,9 +142,11 @@ class ApiControlledVocabulary(Resource):
         entry = ControlledVocabulary.objects().all()
         if not force_delete:
             entry.update(deprecated=True)
+            app.reference_registry.invalidate()
             return {"message": "Deprecate all entries"}
         else:
             entry.delete()
+            app.reference_registry.invalidate()
             return {"message": "Delete all entries"}
 
 
@@ -178,6 +182,7 @@ class ApiControlledVocabularyId(Resource):
             entry_old = ControlledVocabulary(**entry_old_json)
             entry_old.save(validate=False)
             raise error
+        app.reference_registry.invalidate()
         return {"message": f"Update entry '{entry.name}'"}
 
     @token_required
@@ -192,9 +197,11 @@ class ApiControlledVocabularyId(Resource):
         entry = ControlledVocabulary.objects(id=id).get()
         if not force_delete:
             entry.update(deprecated=True)
+            app.reference_registry.invalidate()
             return {"message": f"Deprecate entry '{entry.name}'"}
         else:
             entry.delete()
+            app.reference_registry.invalidate()
             return {"message": f"Delete entry '{entry.name}'"}
 
 
@@ -1,18 +1,46 @@
-from flask_restx import Namespace, Resource
+from flask_restx import Namespace, Resource, fields
 from flask_restx import reqparse
 
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import BadRequest, NotFound
 
-from metadata_registration_lib.api_utils import reverse_map
-
-from metadata_registration_api.api.api_utils import get_property_map
 from metadata_registration_api.mongo_utils import (
     find_study_id_from_lvl1_uuid,
     find_study_id_and_lvl1_uuid_from_lvl2_uuid,
+    find_entities_from_uuids,
 )
 
 api = Namespace("IDs", description="IDs and UUIDs related operations")
 
+# Model definition
+# ----------------------------------------------------------------------------------------------------------------------
+
+resolve_model = api.model(
+    "Resolve UUIDs",
+    {
+        "uuids": fields.List(
+            fields.String(),
+            required=True,
+            description="UUIDs of nested entities of any level (ex: dataset_uuid, pe_uuid)",
+        ),
+    },
+)
+
+resolved_entity_model = api.model(
+    "Resolved UUID",
+    {
+        "uuid": fields.String(),
+        "found": fields.Boolean(),
+        "study_id": fields.String(),
+        "parent_uuid": fields.String(
+            description="UUID of the parent entity (null for level 1 entities)"
+        ),
+        "prop": fields.String(description="Property name (singular) of the entity"),
+        "level": fields.Integer(
+            description="1 for datasets and samples, 2 for PEs, ..."
+        ),
+    },
+)
+
 
 lvl_1_uuid_param = {
     "type": str,
@@ -26,6 +54,12 @@ lvl_2_uuid_param = {
     "help": "UUID of level 2 entity (ex: pe_uuid)",
     "required": True,
 }
+uuid_param = {
+    "type": str,
+    "location": "args",
+    "help": "UUID of a nested entity of any level (ex: dataset_uuid, pe_uuid)",
+    "required": True,
+}
 lvl1_prop_name_param = {
     "type": str,
     "location": "args",
@@ -60,11 +94,7 @@ class ApiIdLvl1(Resource):
         lvl1_uuid = args["lvl1_uuid"]
         lvl1_prop_name = args["lvl1_prop_name"].lower()
 
-        prop_name_to_id = get_property_map(key="name", value="id")
-
-        study_id = find_study_id_from_lvl1_uuid(
-            lvl1_prop_name, lvl1_uuid, prop_name_to_id
-        )
+        study_id = find_study_id_from_lvl1_uuid(lvl1_prop_name, lvl1_uuid)
 
         if study_id is not None:
             return {"study_id": study_id}
@@ -88,18 +118,60 @@ class ApiIdLvl2(Resource):
         lvl1_prop_name = args["lvl1_prop_name"].lower()
         lvl2_prop_name = args["lvl2_prop_name"].lower()
 
-        prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
-
         study_id, lvl1_uuid = find_study_id_and_lvl1_uuid_from_lvl2_uuid(
             lvl1_prop=lvl1_prop_name,
             lvl2_prop=lvl2_prop_name,
             lvl2_uuid=lvl2_uuid,
-            prop_name_to_id=prop_name_to_id,
-            prop_id_to_name=prop_id_to_name,
         )
 
         if study_id is not None and lvl1_uuid is not None:
             return {"study_id": study_id, "lvl1_uuid": lvl1_uuid}
         else:
             raise NotFound(f"{lvl2_prop_name} with uuid {lvl2_uuid} not found")
+
+
+@api.route("/path")
+class ApiIdPath(Resource):
+    _get_parser = reqparse.RequestParser()
+    _get_parser.add_argument("uuid", **uuid_param)
+
+    @api.doc(parser=_get_parser)
+    @api.response("200", "Success")
+    def get(self):
+        """Find the full ancestor path (study -> ... -> entity) of a nested entity uuid"""
+        args = self._get_parser.parse_args()
+        uuid = args["uuid"]
+
+        entity = find_entities_from_uuids([uuid]).get(uuid)
+
+        if entity is not None:
+            return {"uuid": uuid, "path": entity["path"]}
+        else:
+            raise NotFound(f"Entity with uuid {uuid} not found")
+
+
+@api.route("/resolve")
+class ApiIdResolve(Resource):
+    @api.expect(resolve_model)
+    @api.marshal_with(resolved_entity_model)
+    @api.response("200", "Success")
+    def post(self):
+        """Find parent study id, parent uuid and level of many uuids (of mixed levels)"""
+        payload = api.payload
+        uuids = payload.get("uuids") if isinstance(payload, dict) else None
+
+        if not isinstance(uuids, list) or not all(isinstance(u, str) for u in uuids):
+            raise BadRequest(
+                "The body must be an object with a list of UUIDs in 'uuids'"
+            )
+
+        entities = find_entities_from_uuids(uuids)
+
+        results = []
+        for uuid in uuids:
+            if uuid in entities:
+                results.append({"uuid": uuid, "found": True, **entities[uuid]})
+            else:
+                results.append({"uuid": uuid, "found": False})
+
+        return results
@@ -0,0 +1,65 @@
+from flask_restx import Namespace, Resource, fields
+
+from .decorators import token_required
+from ..model import Job
+
+api = Namespace("Jobs", description="Background job related operations")
+
+
+# Model definition
+# ----------------------------------------------------------------------------------------------------------------------
+
+job_model = api.model(
+    "Job",
+    {
+        "id": fields.String(),
+        "job_type": fields.String(),
+        "status": fields.String(
+            description="queued, running, succeeded or failed", example="running"
+        ),
+        "n_done": fields.Integer(),
+        "n_total": fields.Integer(),
+        "error": fields.Raw(),
+        "created": fields.DateTime(),
+        "started": fields.DateTime(),
+        "finished": fields.DateTime(),
+    },
+)
+
+
+def get_user_jobs(user):
+    """Jobs started by the user: the jobs of the other users are not found (404)"""
+    return Job.objects(user_id=user.id if user else None)
+
+
+# Routes
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+@api.route("/id/<job_id>", strict_slashes=False)
+@api.param("job_id", "The job identifier")
+class ApiJobId(Resource):
+    @token_required
+    @api.marshal_with(job_model)
+    def get(self, job_id, user=None):
+        """Fetch the status and progress of a job"""
+        return get_user_jobs(user).filter(id=job_id).exclude("result").get()
+
+
+@api.route("/id/<job_id>/result", strict_slashes=False)
+@api.param("job_id", "The job identifier")
+class ApiJobIdResult(Resource):
+    @token_required
+    @api.response(200, "Success (job result)")
+    @api.response(202, "Job not finished yet")
+    @api.response(422, "Job failed")
+    def get(self, job_id, user=None):
+        """Fetch the result of a job"""
+        job = get_user_jobs(user).filter(id=job_id).get()
+
+        if job.status == "succeeded":
+            return job.result
+        elif job.status == "failed":
+            return job.error, 422
+        else:
+            return {"message": f"The job is {job.status}", "status": job.status}, 202
@@ -0,0 +1,25 @@
+from flask import current_app as app
+from flask_restx import Namespace, Resource
+
+from .decorators import token_required
+
+api = Namespace("Monitoring", description="Metrics of the API worker")
+
+
+# Routes
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+@api.route("/mongo_pool", strict_slashes=False)
+class ApiMongoPool(Resource):
+    @token_required
+    @api.response(200, "Success (pool counters by server address)")
+    def get(self, user=None):
+        """
+        Fetch the MongoDB connection pool metrics of the worker process serving the request
+        n_in_use / max_in_use: connections checked out now / at most, wait_ms_*: time spent
+        waiting for a connection, n_checkout_failures: by reason (ex: timeout)
+        """
+        metrics = app.mongo_pool_metrics.get_metrics()
+        metrics["pool_config"] = app.config["MONGODB_POOL"]
+        return metrics
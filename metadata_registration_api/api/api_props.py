@@ -1,3 +1,4 @@
+from flask import current_app as app
 from flask_restx import Namespace, Resource, fields
 from flask_restx import reqparse, inputs
 
@@ -180,6 +181,7 @@ class ApiProperties(Resource):
         validate_controlled_vocabulary(entry)
 
         entry = entry.save()
+        app.reference_registry.invalidate()
         return {"message": f"Add entry '{entry.name}'", "id": str(entry.id)}, 201
 
     @token_required
@@ -196,9 +198,11 @@ class ApiProperties(Resource):
         entry = Property.objects().all()
         if not force_delete:
             entry.update(deprecated=True)
+            app.reference_registry.invalidate()
             return {"message": "Deprecate all entries"}
         else:
             entry.delete()
+            app.reference_registry.invalidate()
             return {"message": "Delete all entries"}
 
 
@@ -227,6 +231,7 @@ class ApiPropertyId(Resource):
 
         entry = Property.objects(id=id).first()
         entry.update(**api.payload)
+        app.reference_registry.invalidate()
         return {"message": f"Update entry '{entry.name}'"}
 
     @token_required
@@ -243,9 +248,11 @@ class ApiPropertyId(Resource):
         entry = Property.objects(id=id).get()
         if not force_delete:
             entry.update(deprecated=True)
+            app.reference_registry.invalidate()
             return {"message": f"Deprecate entry '{entry.name}'"}
         else:
             entry.delete()
+            app.reference_registry.invalidate()
             return {"message": f"Delete entry '{entry.name}'"}
 
 
@@ -1,8 +1,6 @@
 from flask_restx import Namespace, Resource, fields
 from flask import current_app as app
 
-from metadata_registration_api.mongo_utils import get_states
-from bson.objectid import ObjectId
 
 api = Namespace("States", description="State related operations")
 
@@ -40,8 +38,7 @@ class ApiState(Resource):
     @api.response("200", "Success")
     def get(self):
         """ Fetch a list with all entries """
-        states = get_states(app)
-        return list(states)
+        return app.state_registry.get_states()
 
 
 @api.route("/id/<id>", strict_slashes=False)
@@ -51,8 +48,7 @@ class ApiStateId(Resource):
     @api.response("200", "Success")
     def get(self, id):
         """ Fetch a specific entries """
-        state = get_states(app, q={"_id": ObjectId(id)})[0]
-        return state
+        return app.state_registry.get_by_id(id)
 
 
 @api.route("/name/<name>", strict_slashes=False)
@@ -62,5 +58,4 @@ class ApiStateName(Resource):
     @api.response("200", "Success")
     def get(self, name):
         """ Fetch a specific entries """
-        state = get_states(app, q={"name": name})[0]
-        return state
\ No newline at end of file
+        return app.state_registry.get_by_name(name)
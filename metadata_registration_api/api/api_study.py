@@ -2,29 +2,47 @@ from datetime import datetime
 import re
 
 from flask import current_app as app
-from flask import request
+from flask import request, g
 from flask_restx import Namespace, Resource, fields, marshal
 from flask_restx import reqparse, inputs
+from flask_restx.mask import Mask
+from mongoengine.errors import NotUniqueError
+from pymongo.errors import BulkWriteError
+from dynamic_form.errors import DynamicFormException
+from study_state_machine.errors import StateMachineException
 
 from metadata_registration_lib.api_utils import (
     FormatConverter,
     reverse_map,
     get_entity_converter,
 )
-from metadata_registration_api.es_utils import (
-    index_study,
-    remove_study_from_index,
+from metadata_registration_api.es_bulk import get_entity_update, get_study_document
+from metadata_registration_api.es_outbox import (
+    enqueue_es_operation,
+    enqueue_es_update,
 )
 from metadata_registration_api.api.api_utils import (
     MetaInformation,
     ChangeLog,
     get_property_map,
     get_mask,
+    get_study_summary,
 )
 from .api_props import property_model_id
-from .decorators import token_required
+from .decorators import token_required, idempotent
 from ..errors import IdenticalPropertyException, RequestBodyException
-from ..model import Study
+from ..model import EntityIndex, SampleIndex, Study, Property
+from ..mongo_utils import (
+    get_raw_studies,
+    get_raw_study,
+    raw_study_to_json,
+    get_entity_index,
+    get_sample_index,
+    update_entity_index,
+    insert_entity_index,
+    update_sample_index,
+    insert_sample_index,
+)
 
 api = Namespace("Studies", description="Study related operations")
 
@@ -72,6 +90,26 @@ meta_information_model = api.model(
     },
 )
 
+summary_model = api.model(
+    "Summary",
+    {
+        "n_datasets": fields.Integer(),
+        "n_pes": fields.Integer(),
+        "n_samples": fields.Integer(),
+        "state": fields.String(),
+        "last_modified": fields.DateTime(),
+        "last_editor": fields.String(),
+    },
+)
+
+study_summary_model = api.model(
+    "Study (summary)",
+    {
+        "id": fields.String(attribute="_id"),
+        "summary": fields.Nested(summary_model, allow_null=True),
+    },
+)
+
 study_model = api.model(
     "Study",
     {
@@ -133,6 +171,11 @@ study_add_model = api.inherit(
     },
 )
 
+study_bulk_add_model = api.model(
+    "Add Studies (bulk)",
+    {"studies": fields.List(fields.Nested(study_add_model), required=True)},
+)
+
 # Common parser params
 # ----------------------------------------------------------------------------------------------------------------------
 entry_format_param = {
@@ -233,17 +276,21 @@ class ApiStudy(Resource):
         if args["limit"] != 0:
             res = res.limit(args["limit"])
 
-        if args["properties_id_only"] or args["entry_format"] == "form":
-            marchal_model = study_model_prop_id
-        else:
-            marchal_model = study_model
-
-        # Marshal studies
-        study_json_list = marshal(
-            list(res.select_related()), marchal_model, mask=get_mask(request)
+        # Marshal studies (raw pymongo documents, no MongoEngine document construction)
+        expand_properties = not (
+            args["properties_id_only"] or args["entry_format"] == "form"
+        )
+        mask = get_mask(request)
+        raw_studies = get_raw_studies(res, fields=get_study_fields(mask))
+        study_json_list = raw_studies_to_json(
+            raw_studies, expand_properties=expand_properties, mask=mask
         )
 
-        if args["entry_format"] == "api" or "entries" not in study_json_list[0]:
+        if (
+            args["entry_format"] == "api"
+            or len(study_json_list) == 0
+            or "entries" not in study_json_list[0]
+        ):
             return study_json_list
 
         elif args["entry_format"] == "form":
@@ -257,20 +304,14 @@ class ApiStudy(Resource):
             return study_json_list
 
     @token_required
+    @idempotent
     @api.expect(study_add_model)
     def post(self, user=None):
         """ Add a new entry """
 
         payload = api.payload
-
-        # 1. Split payload
-        form_name = payload["form_name"]
-        initial_state = payload["initial_state"]
-        entries = payload["entries"]
         entry_format = payload.get("entry_format", "api")
 
-        app.study_state_machine.load_state(state_name=initial_state)
-
         prop_id_to_name = get_property_map(key="id", value="name")
         prop_name_to_id = reverse_map(prop_id_to_name)
         if entry_format == "form":
@@ -278,69 +319,26 @@ class ApiStudy(Resource):
         else:
             prop_name_to_syns = None
 
-        # 2. Get both API and form format
-        if entry_format == "api":
-            try:
-                if len(entries) != len({prop["property"] for prop in entries}):
-                    raise IdenticalPropertyException(
-                        "The entries cannot have several identical property values."
-                    )
-            except TypeError as e:
-                raise RequestBodyException("Entries has wrong format.") from e
-
-        study_converter, _ = get_entity_converter(
-            entries,
-            entry_format,
-            prop_id_to_name,
-            prop_name_to_id,
-            replace_synonyms=True,
-            prop_name_to_syns=prop_name_to_syns,
-        )
-
-        # Validate and sort entries according to form
-        form_cls = app.form_manager.get_form_by_name(form_name=form_name)
-        study_converter.sort_from_form(form_cls())
-
-        entries = {
-            "api_format": study_converter.get_api_format(),
-            "form_format": study_converter.get_form_format(),
-        }
-
-        validate_form_format_against_form(
-            form_name, entries["form_format"], form_cls=form_cls
+        # 1-4. Convert and validate entries, evaluate the state of the study
+        study_data, form_format = get_new_study_data(
+            payload, user, prop_id_to_name, prop_name_to_id, prop_name_to_syns
         )
 
-        # 3. Check unicity of pseudo alternate pk in entries
+        # 5. Check unicity of pseudo alternate pk in entries
         check_alternate_pk_unicity(
-            entries=entries["form_format"],
+            entries=form_format,
             pseudo_apks=["study_id"],
             prop_map=prop_name_to_id,
         )
 
-        # 4. Evaluate new state of study by passing form data
-        app.study_state_machine.create_study(**entries["form_format"])
-        state = app.study_state_machine.current_state
-
-        meta_info = MetaInformation(state=str(state))
-        log = ChangeLog(
-            user_id=user.id if user else None,
-            action="Created study",
-            timestamp=datetime.now(),
-            manual_user=payload.get("manual_meta_information", {}).get("user", None),
-        )
-        meta_info.add_log(log)
-
-        study_data = {
-            "entries": entries["api_format"],
-            "meta_information": meta_info.to_json(),
-        }
-
-        # 5. Insert data into database
+        # 6. Insert data into database
         study = Study(**study_data)
         study.save()
+        update_entity_index(study.id, form_format)
+        update_sample_index(study.id, form_format.get("samples") or [])
 
         # Index study on ES
-        index_study_if_es(study, entries["form_format"], "add")
+        index_study_if_es(study, form_format, "add")
 
         return {"message": f"Study added", "id": str(study.id)}, 201
 
@@ -361,9 +359,169 @@ class ApiStudy(Resource):
             return {"message": "Deprecate all entries"}
         else:
             entry.delete()
+            EntityIndex.objects().delete()
+            SampleIndex.objects().delete()
             return {"message": "Delete all entries"}
 
 
+@api.route("/bulk")
+class ApiStudyBulk(Resource):
+    @token_required
+    @idempotent
+    @api.expect(study_bulk_add_model)
+    @api.response(201, "Success (all studies added)")
+    @api.response(207, "Partial success (see the result of each study)")
+    def post(self, user=None):
+        """Add many new studies at once"""
+        studies_payload = api.payload["studies"]
+
+        # 1. Get reference data once for all studies
+        prop_id_to_name = get_property_map(key="id", value="name")
+        prop_name_to_id = reverse_map(prop_id_to_name)
+        if any(p.get("entry_format", "api") == "form" for p in studies_payload):
+            prop_name_to_syns = get_property_map(key="name", value="synonyms")
+        else:
+            prop_name_to_syns = None
+
+        forms = {}
+
+        # 2. Convert and evaluate the state of each study
+        # (the unicity of study_id is enforced by the unique index of Study.study_id)
+        results = [None] * len(studies_payload)
+        new_studies = []
+        for index, payload in enumerate(studies_payload):
+            try:
+                form_name = payload["form_name"]
+                if form_name not in forms:
+                    forms[form_name] = app.form_manager.get_form_by_name(
+                        form_name=form_name
+                    )
+
+                study_data, form_format = get_new_study_data(
+                    payload,
+                    user,
+                    prop_id_to_name,
+                    prop_name_to_id,
+                    prop_name_to_syns,
+                    form_cls=forms[form_name],
+                    validate=False,
+                )
+
+                new_studies.append((index, Study(**study_data), form_format))
+
+            except Exception as error:
+                results[index] = get_bulk_error_result(index, error)
+
+        # 3. Validate the entries against their form (in the validation pool if configured)
+        # and the documents against the model
+        errors = dict(
+            validate_forms_data(
+                [form_format for _, _, form_format in new_studies],
+                [studies_payload[index]["form_name"] for index, _, _ in new_studies],
+                forms,
+            )
+        )
+        valid_studies = []
+        for i, (index, study, form_format) in enumerate(new_studies):
+            try:
+                if i in errors:
+                    raise errors[i]
+                study.validate()
+                valid_studies.append((index, study, form_format))
+            except Exception as error:
+                results[index] = get_bulk_error_result(index, error)
+
+        # 4. Insert all valid studies at once (unordered insert_many: a failed study
+        # doesn't prevent the others from being inserted, ex: duplicated study_id)
+        documents = [study.to_mongo() for _, study, _ in valid_studies]
+        write_errors = {}
+        if len(documents) > 0:
+            try:
+                Study._get_collection().insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                write_errors = {
+                    error["index"]: error for error in e.details["writeErrors"]
+                }
+
+        n_added = 0
+        entity_index = []
+        sample_index = []
+        for i, ((index, study, form_format), document) in enumerate(
+            zip(valid_studies, documents)
+        ):
+            if i in write_errors:
+                results[index] = get_write_error_result(index, write_errors[i])
+                continue
+
+            study.id = document["_id"]
+            results[index] = {"index": index, "status": 201, "id": str(study.id)}
+            n_added += 1
+
+            entity_index.extend(
+                {"study_id": str(study.id), **e} for e in get_entity_index(form_format)
+            )
+            sample_index.extend(
+                {"study_id": str(study.id), **item}
+                for item in get_sample_index(form_format.get("samples") or [])
+            )
+
+            # Index study on ES
+            index_study_if_es(study, form_format, "add")
+
+        # Index the nested entities and the samples of all added studies at once
+        insert_entity_index(entity_index)
+        insert_sample_index(sample_index)
+
+        message = f"Added {n_added} of {len(studies_payload)} studies"
+        status_code = 201 if n_added == len(studies_payload) else 207
+        return {"message": message, "results": results}, status_code
+
+
+@api.route("/summary")
+class ApiStudySummary(Resource):
+    _get_parser = reqparse.RequestParser()
+    _get_parser.add_argument(
+        "deprecated",
+        type=inputs.boolean,
+        location="args",
+        default=False,
+        help="Boolean indicator which determines if deprecated entries should be returned as well",
+    )
+    _get_parser.add_argument(
+        "skip",
+        type=int,
+        location="args",
+        default=0,
+        help="Number of results which should be skipped",
+    )
+    _get_parser.add_argument(
+        "limit",
+        type=int,
+        location="args",
+        default=0,
+        help="Number of results which should be returned (0 = all)",
+    )
+
+    @token_required
+    @api.marshal_with(study_summary_model)
+    @api.doc(parser=_get_parser)
+    def get(self, user=None):
+        """Fetch the summary (entity counts, state, last change) of all studies"""
+        args = self._get_parser.parse_args()
+
+        res = Study.objects()
+
+        if not args["deprecated"]:
+            res = res.filter(meta_information__deprecated=False)
+
+        res = res.skip(args["skip"])
+        if args["limit"] != 0:
+            res = res.limit(args["limit"])
+
+        # Only the summary is loaded, never the entries
+        return list(get_raw_studies(res, fields=["id", "summary"]))
+
+
 @api.route("/id/<id>", strict_slashes=False)
 @api.param("id", "The property identifier")
 class ApiStudyId(Resource):
@@ -382,13 +540,13 @@ class ApiStudyId(Resource):
         """Fetch an entry given its unique identifier"""
         args = self._get_parser.parse_args()
 
-        if args["properties_id_only"] or args["entry_format"] == "form":
-            marchal_model = study_model_prop_id
-        else:
-            marchal_model = study_model
-
-        study_json = marshal(
-            Study.objects(id=id).get(), marchal_model, mask=get_mask(request)
+        expand_properties = not (
+            args["properties_id_only"] or args["entry_format"] == "form"
+        )
+        mask = get_mask(request)
+        raw_study = get_raw_study(id, fields=get_study_fields(mask))
+        [study_json] = raw_studies_to_json(
+            [raw_study], expand_properties=expand_properties, mask=mask
         )
 
         if args["entry_format"] == "api" or "entries" not in study_json:
@@ -453,13 +611,14 @@ class ApiStudyId(Resource):
         # 4. Determine current state and evaluate next state
         state_name = str(study.meta_information.state)
 
-        app.study_state_machine.load_state(state_name=state_name)
-        app.study_state_machine.change_state(**entries["form_format"])
-        new_state = app.study_state_machine.current_state
+        state_machine = get_state_machine()
+        new_state = state_machine.change_state(state_name, entries["form_format"])
 
         # 5. Create and append meta information to the study
         meta_info = MetaInformation(
-            state=state_name, change_log=study.meta_information.change_log
+            state=state_name,
+            change_log=study.meta_information.change_log,
+            evaluated_state=state_machine.get_evaluated_state(state_name, new_state),
         )
 
         log = ChangeLog(
@@ -474,13 +633,19 @@ class ApiStudyId(Resource):
         study_data = {
             "entries": entries["api_format"],
             "meta_information": meta_info.to_json(),
+            "summary": get_study_summary(entries["form_format"], str(new_state), log),
+            "study_id": get_study_id(entries["form_format"]),
         }
 
         # 6. Update data in database
         study.update(**study_data)
+        update_entity_index(study.id, entries["form_format"])
+        update_sample_index(study.id, entries["form_format"].get("samples") or [])
 
         # Index study on ES
-        index_study_if_es(study, entries["form_format"], "update")
+        index_study_if_es(
+            study, entries["form_format"], "update", last_modified=log.timestamp
+        )
 
         return {"message": f"Update study"}
 
@@ -494,13 +659,201 @@ class ApiStudyId(Resource):
         entry = Study.objects(id=id).get()
         if not force_delete:
             entry.update(meta_information__deprecated=True)
-            return {"message": "Deprecate entry"}
+            message = "Deprecate entry"
         else:
             entry.delete()
-            # Update ES
-            if app.config["ES"]["USE"]:
-                remove_study_from_index(app.config, id)
-            return {"message": "Delete entry"}
+            EntityIndex.objects(study_id=str(id)).delete()
+            SampleIndex.objects(study_id=str(id)).delete()
+            message = "Delete entry"
+
+        # Update ES (deprecated studies are not indexed)
+        if app.config["ES"]["USE"]:
+            enqueue_es_operation(id, "delete")
+        return {"message": message}
+
+
+def get_study_fields(mask):
+    """Study fields to load from the DB given a X-Fields mask (only the fields of the study models)"""
+    if mask and "entries" not in Mask(mask):
+        # Do not load the (heavy) entries if they are not requested
+        return ["id", "meta_information"]
+    return ["id", "entries", "meta_information"]
+
+
+def raw_studies_to_json(raw_studies, expand_properties=False, mask=None):
+    """
+    Convert raw pymongo studies directly to the response shape of study_model
+    (expand_properties=True) or study_model_prop_id (expand_properties=False)
+    """
+    properties = get_properties_json() if expand_properties else None
+    study_json_list = [raw_study_to_json(s, properties) for s in raw_studies]
+
+    if mask:
+        study_json_list = Mask(mask).apply(study_json_list)
+
+    return study_json_list
+
+
+def get_properties_json():
+    """Returns all properties marshalled with property_model_id as {prop_id: property}"""
+    properties = list(Property.objects())
+    properties_json = marshal(properties, property_model_id)
+    return {
+        str(prop.id): prop_json for prop, prop_json in zip(properties, properties_json)
+    }
+
+
+def get_new_study_data(
+    payload,
+    user,
+    prop_id_to_name,
+    prop_name_to_id,
+    prop_name_to_syns=None,
+    form_cls=None,
+    validate=True,
+):
+    """
+    Steps to convert and validate the entries of a new study and to evaluate its state
+    Returns the study data to insert in the DB and the entries in form format
+    validate: if False, the entries are not validated against the form (done by the caller)
+    """
+    # 1. Split payload
+    form_name = payload["form_name"]
+    initial_state = payload["initial_state"]
+    entries = payload["entries"]
+    entry_format = payload.get("entry_format", "api")
+
+    # Fail early if the initial state doesn't exist
+    get_state_machine().get_state(initial_state)
+
+    # 2. Get both API and form format
+    if entry_format == "api":
+        try:
+            if len(entries) != len({prop["property"] for prop in entries}):
+                raise IdenticalPropertyException(
+                    "The entries cannot have several identical property values."
+                )
+        except TypeError as e:
+            raise RequestBodyException("Entries has wrong format.") from e
+
+    study_converter, _ = get_entity_converter(
+        entries,
+        entry_format,
+        prop_id_to_name,
+        prop_name_to_id,
+        replace_synonyms=True,
+        prop_name_to_syns=prop_name_to_syns,
+    )
+
+    # 3. Validate and sort entries according to form
+    if form_cls is None:
+        form_cls = app.form_manager.get_form_by_name(form_name=form_name)
+    study_converter.sort_from_form(form_cls())
+
+    entries = {
+        "api_format": study_converter.get_api_format(),
+        "form_format": study_converter.get_form_format(),
+    }
+
+    if validate:
+        validate_form_format_against_form(
+            form_name, entries["form_format"], form_cls=form_cls
+        )
+
+    # 4. Evaluate new state of study by passing form data
+    state = get_state_machine().create_study(initial_state, entries["form_format"])
+
+    meta_info = MetaInformation(state=str(state))
+    log = ChangeLog(
+        user_id=user.id if user else None,
+        action="Created study",
+        timestamp=datetime.now(),
+        manual_user=payload.get("manual_meta_information", {}).get("user", None),
+    )
+    meta_info.add_log(log)
+
+    study_data = {
+        "entries": entries["api_format"],
+        "meta_information": meta_info.to_json(),
+        "summary": get_study_summary(entries["form_format"], str(state), log),
+        "study_id": get_study_id(entries["form_format"]),
+    }
+
+    return study_data, entries["form_format"]
+
+
+def get_bulk_error_result(index, error):
+    """Result of a study which failed in a bulk request (same status codes as the error handlers)"""
+    if isinstance(error, NotUniqueError):
+        status_code = 409
+    elif isinstance(
+        error,
+        (
+            DynamicFormException,
+            StateMachineException,
+            RequestBodyException,
+            IdenticalPropertyException,
+        ),
+    ):
+        status_code = 422
+    else:
+        status_code = 400
+
+    return {
+        "index": index,
+        "status": status_code,
+        "error_type": str(error.__class__.__name__),
+        "message": str(error),
+    }
+
+
+def get_write_error_result(index, write_error):
+    """Result of a study rejected by MongoDB in a bulk insert (writeErrors item)"""
+    # 11000: duplicate key (unique index of Study.study_id)
+    if write_error.get("code") == 11000:
+        return get_bulk_error_result(
+            index,
+            NotUniqueError(
+                f"The property 'study_id' needs to be unique across all studies"
+            ),
+        )
+
+    return {
+        "index": index,
+        "status": 400,
+        "error_type": "BulkWriteError",
+        "message": write_error.get("errmsg", ""),
+    }
+
+
+def get_study_id(form_format):
+    """Value of the "study_id" entry, stored in Study.study_id (unique index)"""
+    study_id = form_format.get("study_id")
+    return str(study_id) if study_id is not None else None
+
+
+def validate_forms_data(forms_data, form_names, forms):
+    """
+    Validate many entries (form format) against their form (form_names[i])
+    Large batches are validated in a pool of processes (see VALIDATION_PROCESSES)
+    Parameters:
+        - forms (dict): form classes by form name, used in the current process
+    Returns the errors as (index, exception)
+    """
+    pool = app.validation_pool
+    if pool is not None and len(forms_data) >= pool.min_batch_size:
+        return pool.validate_forms(forms_data, form_names)
+
+    errors = []
+    for i, (form_data, form_name) in enumerate(zip(forms_data, form_names)):
+        try:
+            validate_form_format_against_form(
+                form_name, form_data, form_cls=forms[form_name]
+            )
+        except RequestBodyException as e:
+            errors.append((i, e))
+
+    return errors
 
 
 def validate_form_format_against_form(form_name, form_data, form_cls=None):
@@ -515,25 +868,104 @@ def validate_form_format_against_form(form_name, form_data, form_cls=None):
         )
 
 
-def index_study_if_es(study, entries, action):
+def index_study_if_es(study, entries, action, entity_paths=None, last_modified=None):
+    """
+    Write the study in the ES outbox, sent to Elastic Search by the outbox flusher
+    action ("add" or "update") is kept for the callers, both are "index" operations
+    The document is built with the maps of the in-process reference registry (no request to the API)
+    If entity_paths is given (changed nested entities, see es_bulk.get_entity_update), only
+    these entities are sent
+    last_modified: time of the change (default: study.summary.last_modified), used as version
+    Deprecated studies are not indexed (removed from the index when deprecated)
+    """
     if app.config["ES"]["USE"]:
-        study_to_index = marshal(study, study_model_prop_id)
-        study_to_index["entries"] = entries
-        index_study(app.config, study_to_index, action)
+        if study.meta_information is not None and study.meta_information.deprecated:
+            return
 
+        study_json = marshal(study, study_model_prop_id)
+        if last_modified is None and study.summary is not None:
+            last_modified = study.summary.last_modified
+
+        study_to_index = get_study_document(
+            study_json, entries, app.reference_registry.get_es_maps(), last_modified
+        )
+
+        if entity_paths:
+            update = get_entity_update(study_to_index, entity_paths)
+            if update is not None:
+                enqueue_es_update(study.id, update)
+                return
+
+        enqueue_es_operation(study.id, "index", study_to_index)
+
+
+def get_study_es_document(study_id):
+    """Full ES document of a study, from the DB (None if the study doesn't exist or is deprecated)"""
+    raw_studies = list(
+        get_raw_studies(
+            Study.objects(id=study_id, meta_information__deprecated__ne=True)
+        )
+    )
+    if len(raw_studies) == 0:
+        return None
+
+    study_json = raw_study_to_json(raw_studies[0])
+    study_converter = FormatConverter(
+        app.reference_registry.get_property_map(key="id", value="name")
+    )
+    study_converter.add_api_format(study_json["entries"])
+
+    return get_study_document(
+        study_json,
+        study_converter.get_form_format(),
+        app.reference_registry.get_es_maps(),
+        (raw_studies[0].get("summary") or {}).get("last_modified"),
+    )
+
+
+def get_state_machine():
+    """
+    State machine of the current request (or job), the same snapshot is used by the whole request
+    even if a new version of the states is loaded meanwhile
+    """
+    if "state_machine" not in g:
+        g.state_machine = app.state_registry.get_state_machine()
+    return g.state_machine
+
+
+def update_study(
+    study, study_converter, payload, message, user=None, entity_paths=None
+):
+    """
+    Steps to update study state, metadata and upload to DB
+    entity_paths: paths of the changed nested entities, only these are re-indexed in the entity
+    and sample indexes and sent to Elastic Search (ex: [[("datasets", dataset_uuid)]]). The whole
+    study is if None.
+    The state is not evaluated again if it was already evaluated by a previous write and its
+    strategies read none of the changed top-level properties (ex: "datasets").
+    """
+    form_format = study_converter.get_form_format()
 
-def update_study(study, study_converter, payload, message, user=None):
-    """ Steps to update study state, metadata and upload to DB """
     # 1. Determine current state and evaluate next state
     state_name = str(study.meta_information.state)
-
-    app.study_state_machine.load_state(state_name=state_name)
-    app.study_state_machine.change_state(**study_converter.get_form_format())
-    new_state = app.study_state_machine.current_state
+    if entity_paths is not None:
+        changed_props = {path[0][0] for path in entity_paths}
+    else:
+        changed_props = None
+
+    state_machine = get_state_machine()
+    new_state = state_machine.change_state(
+        state_name,
+        form_format,
+        changed_props=changed_props,
+        evaluated_state=study.meta_information.evaluated_state,
+    )
 
     # 2. Update metadata / Create and append meta information to the study
     meta_info = MetaInformation(
-        state=state_name, change_log=study.meta_information.change_log
+        state=state_name,
+        change_log=study.meta_information.change_log,
+        evaluated_state=state_machine.get_evaluated_state(state_name, new_state),
     )
 
     if payload is not None:
@@ -553,46 +985,63 @@ def update_study(study, study_converter, payload, message, user=None):
     study_data = {
         "entries": study_converter.get_api_format(),
         "meta_information": meta_info.to_json(),
+        "summary": get_study_summary(form_format, str(new_state), log),
+        "study_id": get_study_id(form_format),
     }
 
     # 3. Update data in database
     study.update(**study_data)
+    update_entity_index(study.id, form_format, entity_paths)
+    update_sample_index(study.id, form_format.get("samples") or [], entity_paths)
 
     # Index study on ES
-    index_study_if_es(study, study_converter.get_form_format(), "update")
+    index_study_if_es(
+        study,
+        form_format,
+        "update",
+        entity_paths=entity_paths,
+        last_modified=log.timestamp,
+    )
 
 
-def check_alternate_pk_unicity(entries, pseudo_apks, prop_map):
+def get_alternate_pk_values(prop_name, prop_id):
     """
-    Another dirty mongoDB aggregation to enforce unicity of certain entry properties.
+    Another dirty mongoDB aggregation to get all the values of a pseudo alternate pk (one pass)
     """
-    for prop_name in pseudo_apks:
-        prop_id = prop_map[prop_name]
-        pipeline = [
-            # Keep the wanted field
-            {
-                "$addFields": {
-                    prop_name: {
-                        "$filter": {
-                            "input": "$entries",
-                            "as": "entry",
-                            "cond": {
-                                "$eq": [{"$toString": "$$entry.property"}, prop_id]
-                            },
-                        }
+    pipeline = [
+        # Keep the wanted field
+        {
+            "$addFields": {
+                prop_name: {
+                    "$filter": {
+                        "input": "$entries",
+                        "as": "entry",
+                        "cond": {"$eq": [{"$toString": "$$entry.property"}, prop_id]},
                     }
                 }
-            },
-            # Take first (and only) element of filtered entries
-            {"$addFields": {prop_name: {"$arrayElemAt": [f"${prop_name}", 0]}}},
-            # Get the actual entry value
-            {"$addFields": {prop_name: f"${prop_name}.value"}},
-            {"$group": {"_id": 1, prop_name: {"$addToSet": f"${prop_name}"}}},
-            {"$project": {prop_name: 1, "_id": 0}},
-        ]
+            }
+        },
+        # Take first (and only) element of filtered entries
+        {"$addFields": {prop_name: {"$arrayElemAt": [f"${prop_name}", 0]}}},
+        # Get the actual entry value
+        {"$addFields": {prop_name: f"${prop_name}.value"}},
+        {"$group": {"_id": 1, prop_name: {"$addToSet": f"${prop_name}"}}},
+        {"$project": {prop_name: 1, "_id": 0}},
+    ]
+
+    for result in Study.objects().aggregate(pipeline):
+        return set(result[prop_name])
 
-        existing_list = Study.objects().aggregate(pipeline).next()[prop_name]
-        if entries[prop_name] in existing_list:
+    return set()
+
+
+def check_alternate_pk_unicity(entries, pseudo_apks, prop_map):
+    """
+    Enforce unicity of certain entry properties across all studies
+    """
+    for prop_name in pseudo_apks:
+        existing_values = get_alternate_pk_values(prop_name, prop_map[prop_name])
+        if entries[prop_name] in existing_values:
             raise Exception(
                 f"The property '{prop_name}' needs to be unique across all studies"
             )
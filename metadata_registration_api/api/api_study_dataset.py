@@ -21,11 +21,13 @@ from .api_study import (
     nested_study_entry_model_prop_id,
 )
 from .api_study import validate_form_format_against_form, update_study
-from .decorators import token_required
+from .decorators import token_required, idempotent
 from ..model import Study
 from ..mongo_utils import (
     find_study_id_from_lvl1_uuid,
     find_study_id_and_lvl1_uuid_from_lvl2_uuid,
+    get_raw_study,
+    raw_study_to_json,
 )
 
 api = Namespace("Datasets", description="Dataset related operations")
@@ -49,8 +51,7 @@ class ApiStudyDataset(Resource):
         """Fetch a list of all datasets for a given study"""
         args = self._get_parser.parse_args()
 
-        study = Study.objects().get(id=study_id)
-        study_json = marshal(study, study_model)
+        study_json = raw_study_to_json(get_raw_study(study_id, fields=["entries"]))
 
         prop_map = get_property_map(key="id", value="name")
 
@@ -70,6 +71,7 @@ class ApiStudyDataset(Resource):
             return []
 
     @token_required
+    @idempotent
     @api.expect(nested_study_entry_model_prop_id)
     def post(self, study_id, user=None):
         """Add a new dataset for a given study"""
@@ -128,7 +130,14 @@ class ApiStudyDataset(Resource):
 
         # 5. Update study state, data and upload on DB
         message = "Added dataset"
-        update_study(study, study_converter, payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            payload,
+            message,
+            user,
+            entity_paths=[[("datasets", dataset_uuid)]],
+        )
         return {"message": message, "uuid": dataset_uuid}, 201
 
 
@@ -153,20 +162,16 @@ class ApiStudyDatasetId(Resource):
         args = self._get_parser.parse_args()
 
         prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
 
         # Used for helper route using only dataset_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "dataset", dataset_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("dataset", dataset_uuid)
             if study_id is None:
                 raise Exception(
                     f"Dataset not found in any study (uuid = {dataset_uuid})"
                 )
 
-        study = Study.objects().get(id=study_id)
-        study_json = marshal(study, study_model)
+        study_json = raw_study_to_json(get_raw_study(study_id, fields=["entries"]))
 
         # The converter is used for its get_entry_by_name() method
         study_converter = FormatConverter(mapper=prop_id_to_name)
@@ -192,9 +197,7 @@ class ApiStudyDatasetId(Resource):
 
         # Used for helper route using only dataset_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "dataset", dataset_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("dataset", dataset_uuid)
             if study_id is None:
                 raise Exception(
                     f"Dataset not found in any study (uuid = {dataset_uuid})"
@@ -256,20 +259,24 @@ class ApiStudyDatasetId(Resource):
 
         # 7. Update study state, data and upload on DB
         message = "Updated dataset"
-        update_study(study, study_converter, payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            payload,
+            message,
+            user,
+            entity_paths=[[("datasets", dataset_uuid)]],
+        )
         return {"message": message}
 
     @token_required
     def delete(self, dataset_uuid, study_id=None, user=None):
         """Delete a dataset from a study given its unique identifier"""
         prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
 
         # Used for helper route using only dataset_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "dataset", dataset_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("dataset", dataset_uuid)
             if study_id is None:
                 raise Exception(
                     f"Dataset not found in any study (uuid = {dataset_uuid})"
@@ -291,7 +298,14 @@ class ApiStudyDatasetId(Resource):
 
         # 3. Update study state, data and upload on DB
         message = f"Deleted dataset"
-        update_study(study, study_converter, api.payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            api.payload,
+            message,
+            user,
+            entity_paths=[[("datasets", dataset_uuid)]],
+        )
 
         return {"message": message}
 
@@ -316,20 +330,16 @@ class ApiStudyPE(Resource):
         args = self._get_parser.parse_args()
 
         prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
 
         # Used for helper route using only dataset_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "dataset", dataset_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("dataset", dataset_uuid)
             if study_id is None:
                 raise Exception(
                     f"Dataset not found in any study (uuid = {dataset_uuid})"
                 )
 
-        study = Study.objects().get(id=study_id)
-        study_json = marshal(study, study_model)
+        study_json = raw_study_to_json(get_raw_study(study_id, fields=["entries"]))
 
         # The converter is used for its get_entry_by_name() method
         study_converter = FormatConverter(mapper=prop_id_to_name)
@@ -354,6 +364,7 @@ class ApiStudyPE(Resource):
             return []
 
     @token_required
+    @idempotent
     @api.expect(nested_study_entry_model_prop_id)
     def post(self, dataset_uuid, study_id=None, user=None):
         """Add a new processing event for a given dataset"""
@@ -362,9 +373,7 @@ class ApiStudyPE(Resource):
 
         # Used for helper route using only dataset_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "dataset", dataset_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("dataset", dataset_uuid)
             if study_id is None:
                 raise Exception(
                     f"Dataset not found in any study (uuid = {dataset_uuid})"
@@ -434,7 +443,14 @@ class ApiStudyPE(Resource):
 
         # 7. Update study state, data and upload on DB
         message = "Added processing event"
-        update_study(study, study_converter, payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            payload,
+            message,
+            user,
+            entity_paths=[[("datasets", dataset_uuid), ("process_events", pe_uuid)]],
+        )
         return {"message": message, "uuid": pe_uuid}, 201
 
 
@@ -464,7 +480,6 @@ class ApiStudyPEId(Resource):
         args = self._get_parser.parse_args()
 
         prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
 
         # Used for helper route using only pe_uuid
         if dataset_uuid is None:
@@ -472,8 +487,6 @@ class ApiStudyPEId(Resource):
                 lvl1_prop="dataset",
                 lvl2_prop="process_event",
                 lvl2_uuid=pe_uuid,
-                prop_name_to_id=prop_name_to_id,
-                prop_id_to_name=prop_id_to_name,
             )
             if study_id is None or dataset_uuid is None:
                 raise Exception(
@@ -482,16 +495,13 @@ class ApiStudyPEId(Resource):
 
         # Used for helper route using only dataset_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "dataset", dataset_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("dataset", dataset_uuid)
             if study_id is None:
                 raise Exception(
                     f"Dataset not found in any study (uuid = {dataset_uuid})"
                 )
 
-        study = Study.objects().get(id=study_id)
-        study_json = marshal(study, study_model)
+        study_json = raw_study_to_json(get_raw_study(study_id, fields=["entries"]))
 
         # The converter is used for its get_entry_by_name() method
         study_converter = FormatConverter(mapper=prop_id_to_name)
@@ -528,8 +538,6 @@ class ApiStudyPEId(Resource):
                 lvl1_prop="dataset",
                 lvl2_prop="process_event",
                 lvl2_uuid=pe_uuid,
-                prop_name_to_id=prop_name_to_id,
-                prop_id_to_name=prop_id_to_name,
             )
             if study_id is None or dataset_uuid is None:
                 raise Exception(
@@ -538,9 +546,7 @@ class ApiStudyPEId(Resource):
 
         # Used for helper route using only dataset_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "dataset", dataset_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("dataset", dataset_uuid)
             if study_id is None:
                 raise Exception(
                     f"Dataset not found in any study (uuid = {dataset_uuid})"
@@ -604,14 +610,20 @@ class ApiStudyPEId(Resource):
 
         # 8. Update study state, data and upload on DB
         message = "Updated processing event"
-        update_study(study, study_converter, payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            payload,
+            message,
+            user,
+            entity_paths=[[("datasets", dataset_uuid), ("process_events", pe_uuid)]],
+        )
         return {"message": message}
 
     @token_required
     def delete(self, pe_uuid, study_id=None, dataset_uuid=None, user=None):
         """Delete a processing event given its unique identifier"""
         prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
 
         # Used for helper route using only pe_uuid
         if dataset_uuid is None:
@@ -619,8 +631,6 @@ class ApiStudyPEId(Resource):
                 lvl1_prop="dataset",
                 lvl2_prop="process_event",
                 lvl2_uuid=pe_uuid,
-                prop_name_to_id=prop_name_to_id,
-                prop_id_to_name=prop_id_to_name,
             )
             if study_id is None or dataset_uuid is None:
                 raise Exception(
@@ -629,9 +639,7 @@ class ApiStudyPEId(Resource):
 
         # Used for helper route using only dataset_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "dataset", dataset_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("dataset", dataset_uuid)
             if study_id is None:
                 raise Exception(
                     f"Dataset not found in any study (uuid = {dataset_uuid})"
@@ -659,6 +667,13 @@ class ApiStudyPEId(Resource):
 
         # 4. Update study state, data and upload on DB
         message = f"Deleted processing event"
-        update_study(study, study_converter, api.payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            api.payload,
+            message,
+            user,
+            entity_paths=[[("datasets", dataset_uuid), ("process_events", pe_uuid)]],
+        )
 
         return {"message": message}
@@ -1,6 +1,10 @@
+import json
+import tempfile
+
 from flask import current_app as app
+from flask import request
 from flask_restx import Namespace, Resource, marshal, fields
-from flask_restx import reqparse
+from flask_restx import reqparse, inputs
 
 from metadata_registration_lib.api_utils import (
     reverse_map,
@@ -15,7 +19,13 @@ from metadata_registration_lib.sample_utils import (
     validate_sample_against_form,
 )
 
-from metadata_registration_api.api.api_utils import get_property_map
+from metadata_registration_api.api.api_utils import (
+    CachedFormatConverter,
+    get_property_map,
+    iter_ndjson_records,
+    iter_csv_records,
+    iter_batches,
+)
 from .api_study import (
     entry_format_param,
     entry_model_prop_id,
@@ -24,8 +34,17 @@ from .api_study import (
 )
 from .api_study import update_study
 from .api_study_dataset import find_study_id_from_lvl1_uuid
-from .decorators import token_required
+from .decorators import token_required, idempotent
+from ..errors import RequestBodyException
 from ..model import Study
+from ..mongo_utils import (
+    get_raw_study,
+    raw_study_to_json,
+    get_sample_index,
+    get_sample_keys,
+    has_sample_index,
+    find_sample_uuids,
+)
 
 api = Namespace("Samples", description="Sample related operations")
 
@@ -89,9 +108,21 @@ samples_model_payload = api.inherit(
         "replace": fields.Boolean(
             default=False, description=f"Replace existing samples"
         ),
+        "async": fields.Boolean(
+            default=False,
+            description="Process the upload in a background job (returns a job id)",
+        ),
     },
 )
 
+# Default form used to validate each entity of a sample
+default_sample_form_names = {
+    "treatment_ind": "treatment",
+    "individual": "individual",
+    "treatment_sam": "treatment",
+    "sample": "sample",
+}
+
 
 # Routes
 # ----------------------------------------------------------------------------------------------------------------------
@@ -101,93 +132,97 @@ samples_model_payload = api.inherit(
 @api.param("study_id", "The study identifier")
 class ApiStudySamples(Resource):
     @token_required
+    @idempotent
     @api.expect(samples_model_payload)
+    @api.response(201, "Success (samples added)")
+    @api.response(202, "Accepted (background job created, see /jobs)")
     def post(self, study_id, user=None):
         """Add multiple new samples for a given study"""
         payload = api.payload
 
-        prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
-
-        # 1. Split payload
-        entries_list = payload["entries"]
-        entry_format = payload.get("entry_format", "api")
-        replace = payload.get("replace", False)
-        validate_dict, forms = get_samples_validation_forms(payload)
-
-        if entry_format == "form":
-            prop_name_to_syns = get_property_map(key="name", value="synonyms")
-        else:
-            prop_name_to_syns = None
-
-        # 2. Get study data
-        study = Study.objects().get(id=study_id)
-        study_json = marshal(study, study_model)
+        if payload.get("async", False):
+            # Fail early if the study does not exist
+            Study.objects(id=study_id).only("id").get()
 
-        study_converter = FormatConverter(mapper=prop_id_to_name)
-        study_converter.add_api_format(study_json["entries"])
-
-        # 3. Unify UUIDs with existing entities (including nested ones)
-        new_samples_form_format = []
-        for entries in entries_list:
-            # Format and clean entity
-            sample_converter, _ = get_entity_converter(
-                entries,
-                entry_format,
-                prop_id_to_name,
-                prop_name_to_id,
-                replace_synonyms=True,
-                prop_name_to_syns=prop_name_to_syns,
+            job = app.job_queue.submit(
+                "add_samples", add_samples, study_id, payload, user=user
             )
-            new_samples_form_format.append(sample_converter.get_form_format())
+            return {"message": "Job created", "job_id": str(job.id)}, 202
 
-        new_samples_form_format = unify_sample_entities_uuids(
-            existing_samples=study_converter.get_form_format().get("samples", []),
-            new_samples=new_samples_form_format,
-        )
+        return add_samples(study_id, payload, user), 201
 
-        # 4. Append new samples to "samples" in study
-        if replace:
-            study_converter.remove_entries(prop_names=["samples"])
-
-        sample_uuids = []
-        for sample_form_format in new_samples_form_format:
-            # Format and clean entity
-            sample_converter, _ = get_entity_converter(
-                entries=sample_form_format,
-                entry_format="form",
-                prop_id_to_name=None,
-                prop_name_to_id=prop_name_to_id,
-                replace_synonyms=False,
-            )
-
-            # Generate UUID (redundant, UUIDs already generated by unify_sample_entities_uuids)
-            sample_converter, sample_uuid = add_uuid_entry_if_missing(
-                sample_converter, prop_name_to_id
-            )
 
-            study_converter = add_entity_to_study_nested_list(
-                study_converter=study_converter,
-                entity_converter=sample_converter,
-                prop_name_to_id=prop_name_to_id,
-                study_list_prop="samples",
-            )
-
-            sample_uuids.append(sample_uuid)
+@api.route("/id/<study_id>/samples/stream")
+@api.param("study_id", "The study identifier")
+class ApiStudySamplesStream(Resource):
+    _post_parser = reqparse.RequestParser()
+    _post_parser.add_argument("entry_format", **entry_format_param)
+    _post_parser.add_argument(
+        "replace",
+        type=inputs.boolean,
+        location="args",
+        default=False,
+        help="Replace existing samples",
+    )
+    _post_parser.add_argument(
+        "validate",
+        type=str,
+        location="args",
+        action="append",
+        choices=tuple(default_sample_form_names.keys()),
+        help="Entities validated against their default form",
+    )
+    _post_parser.add_argument(
+        "batch_size",
+        type=int,
+        location="args",
+        default=500,
+        help="Number of samples unified and validated at once",
+    )
+    _post_parser.add_argument(
+        "manual_user", type=str, location="args", help="User name for the change log"
+    )
 
-            # 5. Validate data against form
-            validate_sample_against_form(
-                sample_converter.get_form_format(), validate_dict, forms
+    @token_required
+    @api.doc(parser=_post_parser)
+    @api.response(201, "Success (samples added)")
+    def post(self, study_id, user=None):
+        """
+        Add multiple new samples for a given study from a NDJSON or CSV body
+        NDJSON: one sample per line (list of entries in API format or dict in form format)
+        CSV: one sample per row, one column per property (form format only)
+        """
+        args = self._post_parser.parse_args()
+
+        if request.mimetype == "application/x-ndjson":
+            records = iter_ndjson_records(request.stream)
+        elif request.mimetype == "text/csv":
+            if args["entry_format"] != "form":
+                raise RequestBodyException("CSV samples must be in form format.")
+            records = iter_csv_records(request.stream)
+        else:
+            raise RequestBodyException(
+                f"Unsupported content type '{request.mimetype}' "
+                "(expected application/x-ndjson or text/csv)."
             )
 
-        # 6. Check unicity of specified properties
-        check_samples_unicity(study_converter.get_form_format()["samples"])
-        custom_sample_validation(study_converter.get_form_format()["samples"])
-
-        # 7. Update study state, data and upload on DB
-        message = f"Added {len(sample_uuids)} samples (replace = {replace})"
-        update_study(study, study_converter, payload, message, user)
-        return {"message": message, "uuids": sample_uuids}, 201
+        validate = args["validate"] or []
+        payload = {
+            "validate": {e: e in validate for e in default_sample_form_names},
+            "form_names": default_sample_form_names,
+            "manual_meta_information": {"user": args["manual_user"]},
+        }
+
+        result = add_samples_from_stream(
+            study_id,
+            records,
+            entry_format=args["entry_format"],
+            replace=args["replace"],
+            payload=payload,
+            batch_size=args["batch_size"],
+            user=user,
+        )
+        return result, 201
 
 
 @api.route("/id/<study_id>/samples")
@@ -211,8 +246,7 @@ class ApiStudySample(Resource):
         """Fetch a list of all samples for a given study"""
         args = self._get_parser.parse_args()
 
-        study = Study.objects().get(id=study_id)
-        study_json = marshal(study, study_model)
+        study_json = raw_study_to_json(get_raw_study(study_id, fields=["entries"]))
 
         prop_map = get_property_map(key="id", value="name")
 
@@ -232,6 +266,7 @@ class ApiStudySample(Resource):
             return []
 
     @token_required
+    @idempotent
     @api.expect(sample_model_payload)
     def post(self, study_id, user=None):
         """Add a new sample for a given study"""
@@ -254,34 +289,25 @@ class ApiStudySample(Resource):
         study = Study.objects().get(id=study_id)
         study_json = marshal(study, study_model)
 
-        study_converter = FormatConverter(mapper=prop_id_to_name)
+        study_converter = CachedFormatConverter(mapper=prop_id_to_name)
         study_converter.add_api_format(study_json["entries"])
 
         # 3. Unify UUIDs with existing entities (including nested ones)
-        # Format and clean entity
-        sample_converter, _ = get_entity_converter(
-            entries,
-            entry_format,
-            prop_id_to_name,
-            prop_name_to_id,
-            replace_synonyms=True,
-            prop_name_to_syns=prop_name_to_syns,
+        # Format and clean entity (the only conversion of the sample)
+        sample_converter, sample_form_format = convert_sample(
+            entries, entry_format, prop_id_to_name, prop_name_to_id, prop_name_to_syns
         )
-        new_sample_form_format = sample_converter.get_form_format()
 
-        [new_sample_form_format] = unify_sample_entities_uuids(
-            existing_samples=study_converter.get_form_format().get("samples", []),
-            new_samples=[new_sample_form_format],
+        [new_sample_form_format] = SampleUnifier(study, study_converter).unify(
+            study_converter, [sample_form_format]
         )
 
         # 4. Append new samples to "samples" in study
-        # Format and clean entity
-        sample_converter, _ = get_entity_converter(
-            entries=new_sample_form_format,
-            entry_format="form",
-            prop_id_to_name=None,
-            prop_name_to_id=prop_name_to_id,
-            replace_synonyms=False,
+        sample_converter = set_unified_uuids(
+            sample_converter,
+            sample_form_format,
+            new_sample_form_format,
+            prop_name_to_id,
         )
 
         # Generate UUID (redundant, UUIDs already generated by unify_sample_entities_uuids)
@@ -298,14 +324,25 @@ class ApiStudySample(Resource):
 
         # 5. Validate data against form + unicity
         validate_sample_against_form(
-            sample_converter.get_form_format(), validate_dict, forms
+            get_stored_sample_form_format(
+                sample_converter, new_sample_form_format, sample_uuid
+            ),
+            validate_dict,
+            forms,
         )
         check_samples_unicity(study_converter.get_form_format()["samples"])
         custom_sample_validation(study_converter.get_form_format()["samples"])
 
         # 6. Update study state, data and upload on DB
         message = "Added sample"
-        update_study(study, study_converter, payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            payload,
+            message,
+            user,
+            entity_paths=[[("samples", sample_uuid)]],
+        )
         return {"message": message, "uuid": sample_uuid}, 201
 
     @token_required
@@ -321,7 +358,7 @@ class ApiStudySample(Resource):
         study = Study.objects().get(id=study_id)
         study_json = marshal(study, study_model)
 
-        study_converter = FormatConverter(mapper=prop_id_to_name)
+        study_converter = CachedFormatConverter(mapper=prop_id_to_name)
         study_converter.add_api_format(study_json["entries"])
 
         # 2. Delete samples
@@ -331,13 +368,26 @@ class ApiStudySample(Resource):
             samples_entry = study_converter.get_entry_by_name("samples")
             for sample_uuid in sample_uuids:
                 samples_entry.value.delete_nested_entry("uuid", sample_uuid)
+            # The samples were deleted in place
+            study_converter.invalidate()
 
             if len(samples_entry.value.value) == 0:
                 study_converter.remove_entries(prop_names=["samples"])
 
         # 3. Update study state, data and upload on DB
         message = "Deleted samples"
-        update_study(study, study_converter, api.payload, message, user)
+        if sample_uuids is None:
+            entity_paths = None
+        else:
+            entity_paths = [[("samples", u)] for u in sample_uuids]
+        update_study(
+            study,
+            study_converter,
+            api.payload,
+            message,
+            user,
+            entity_paths=entity_paths,
+        )
 
         return {"message": message}
 
@@ -363,18 +413,14 @@ class ApiStudySampleId(Resource):
         args = self._get_parser.parse_args()
 
         prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
 
         # Used for helper route using only sample_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "sample", sample_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("sample", sample_uuid)
             if study_id is None:
                 raise Exception(f"Sample not found in any study (uuid = {sample_uuid})")
 
-        study = Study.objects().get(id=study_id)
-        study_json = marshal(study, study_model)
+        study_json = raw_study_to_json(get_raw_study(study_id, fields=["entries"]))
 
         # The converter is used for its get_entry_by_name() method
         study_converter = FormatConverter(mapper=prop_id_to_name)
@@ -400,9 +446,7 @@ class ApiStudySampleId(Resource):
 
         # Used for helper route using only sample_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "sample", sample_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("sample", sample_uuid)
             if study_id is None:
                 raise Exception(f"Sample not found in any study (uuid = {sample_uuid})")
 
@@ -422,7 +466,7 @@ class ApiStudySampleId(Resource):
         study = Study.objects().get(id=study_id)
         study_json = marshal(study, study_model)
 
-        study_converter = FormatConverter(mapper=prop_id_to_name)
+        study_converter = CachedFormatConverter(mapper=prop_id_to_name)
         study_converter.add_api_format(study_json["entries"])
 
         # 3. Get current sample data
@@ -434,8 +478,8 @@ class ApiStudySampleId(Resource):
         sample_converter.entries = sample_nested_entry.value
 
         # 4. Unify UUIDs with existing entities (including nested ones)
-        # Format and clean entity
-        new_sample_converter, _ = get_entity_converter(
+        # Format and clean entity, get entries to remove (the only conversion of the sample)
+        new_sample_converter, entries_to_remove = get_entity_converter(
             entries,
             entry_format,
             prop_id_to_name,
@@ -443,22 +487,18 @@ class ApiStudySampleId(Resource):
             replace_synonyms=True,
             prop_name_to_syns=prop_name_to_syns,
         )
+        sample_form_format = new_sample_converter.get_form_format()
 
-        new_sample_form_format = new_sample_converter.get_form_format()
-
-        [new_sample_form_format] = unify_sample_entities_uuids(
-            existing_samples=study_converter.get_form_format().get("samples", []),
-            new_samples=[new_sample_form_format],
+        [new_sample_form_format] = SampleUnifier(study, study_converter).unify(
+            study_converter, [sample_form_format]
         )
 
-        # 5. Clean new data and get entries to remove
-        # Format and clean entity
-        new_sample_converter, entries_to_remove = get_entity_converter(
-            entries=new_sample_form_format,
-            entry_format="form",
-            prop_id_to_name=None,
-            prop_name_to_id=prop_name_to_id,
-            replace_synonyms=False,
+        # 5. Set the unified UUIDs in the new data
+        new_sample_converter = set_unified_uuids(
+            new_sample_converter,
+            sample_form_format,
+            new_sample_form_format,
+            prop_name_to_id,
         )
 
         # 6. Update current sample by adding, updating and deleting entries
@@ -467,6 +507,7 @@ class ApiStudySampleId(Resource):
         sample_converter.add_or_update_entries(new_sample_converter.entries)
         sample_converter.remove_entries(entries=entries_to_remove)
         sample_nested_entry.value = sample_converter.entries
+        study_converter.invalidate()
 
         # 7. Validate data against form + unicity
         validate_sample_against_form(
@@ -477,20 +518,24 @@ class ApiStudySampleId(Resource):
 
         # 8. Update study state, data and upload on DB
         message = "Updated sample"
-        update_study(study, study_converter, payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            payload,
+            message,
+            user,
+            entity_paths=[[("samples", sample_uuid)]],
+        )
         return {"message": message}
 
     @token_required
     def delete(self, sample_uuid, study_id=None, user=None):
         """Delete a sample from a study given its unique identifier"""
         prop_id_to_name = get_property_map(key="id", value="name")
-        prop_name_to_id = reverse_map(prop_id_to_name)
 
         # Used for helper route using only sample_uuid
         if study_id is None:
-            study_id = find_study_id_from_lvl1_uuid(
-                "sample", sample_uuid, prop_name_to_id
-            )
+            study_id = find_study_id_from_lvl1_uuid("sample", sample_uuid)
             if study_id is None:
                 raise Exception(f"Sample not found in any study (uuid = {sample_uuid})")
 
@@ -498,23 +543,450 @@ class ApiStudySampleId(Resource):
         study = Study.objects().get(id=study_id)
         study_json = marshal(study, study_model)
 
-        study_converter = FormatConverter(mapper=prop_id_to_name)
+        study_converter = CachedFormatConverter(mapper=prop_id_to_name)
         study_converter.add_api_format(study_json["entries"])
 
         # 2. Delete specific entity
         samples_entry = study_converter.get_entry_by_name("samples")
         samples_entry.value.delete_nested_entry("uuid", sample_uuid)
+        # The sample was deleted in place
+        study_converter.invalidate()
 
         if len(samples_entry.value.value) == 0:
             study_converter.remove_entries(prop_names=["samples"])
 
         # 3. Update study state, data and upload on DB
         message = f"Deleted sample"
-        update_study(study, study_converter, api.payload, message, user)
+        update_study(
+            study,
+            study_converter,
+            api.payload,
+            message,
+            user,
+            entity_paths=[[("samples", sample_uuid)]],
+        )
 
         return {"message": message}
 
 
+def add_samples(study_id, payload, user=None, progress=None):
+    """
+    Add multiple new samples to a study (POST /samples/multiple), also used by background jobs
+
+    Args:
+        study_id (str): Study identifier
+        payload (dict): API payload (see samples_model_payload)
+        user (User): User adding the samples
+        progress (function): Optional callback progress(n_done, n_total) called after each step
+
+    Returns:
+        [dict]: message and the UUIDs of the added samples
+    """
+    prop_id_to_name = get_property_map(key="id", value="name")
+    prop_name_to_id = reverse_map(prop_id_to_name)
+
+    # 1. Split payload
+    entries_list = payload["entries"]
+    entry_format = payload.get("entry_format", "api")
+    replace = payload.get("replace", False)
+    validate_dict, forms = get_samples_validation_forms(payload)
+
+    if entry_format == "form":
+        prop_name_to_syns = get_property_map(key="name", value="synonyms")
+    else:
+        prop_name_to_syns = None
+
+    # 2. Get study data
+    study = Study.objects().get(id=study_id)
+    study_json = marshal(study, study_model)
+
+    study_converter = CachedFormatConverter(mapper=prop_id_to_name)
+    study_converter.add_api_format(study_json["entries"])
+
+    # 3. Format and clean the new samples (the only conversion of each sample)
+    new_samples = []
+    n_steps = 2 * len(entries_list)
+    for i, entries in enumerate(entries_list):
+        new_samples.append(
+            convert_sample(
+                entries,
+                entry_format,
+                prop_id_to_name,
+                prop_name_to_id,
+                prop_name_to_syns,
+            )
+        )
+
+        if progress is not None:
+            progress(i + 1, n_steps)
+
+    unifier = SampleUnifier(study, study_converter)
+
+    # 4. Unify UUIDs with existing entities (including nested ones), append new samples to
+    # "samples" in study and validate them
+    if replace:
+        study_converter.remove_entries(prop_names=["samples"])
+
+    def sample_progress(n_added):
+        if progress is not None:
+            progress(len(entries_list) + n_added, n_steps)
+
+    study_converter, _, sample_uuids = append_samples(
+        study_converter,
+        new_samples,
+        unifier,
+        prop_name_to_id,
+        validate_dict,
+        forms,
+        payload.get("form_names"),
+        progress=sample_progress,
+    )
+
+    # 5. Check unicity of specified properties
+    check_samples_unicity(study_converter.get_form_format()["samples"])
+    custom_sample_validation(study_converter.get_form_format()["samples"])
+
+    # 6. Update study state, data and upload on DB
+    message = f"Added {len(sample_uuids)} samples (replace = {replace})"
+    # Only the added samples are sent to Elastic Search (all of them if replaced)
+    entity_paths = None if replace else [[("samples", u)] for u in sample_uuids]
+    update_study(
+        study, study_converter, payload, message, user, entity_paths=entity_paths
+    )
+    return {"message": message, "uuids": sample_uuids}
+
+
+def add_samples_from_stream(
+    study_id, records, entry_format, replace, payload, batch_size, user=None
+):
+    """
+    Add multiple new samples to a study from an iterable of records (streamed request body)
+    The records are spilled one by one to a temporary staging file, then converted, merged into
+    the study and validated batch by batch: the request body is never held in memory.
+    The study itself is written once at the end (its state and the unicity of the samples are
+    checked on the whole study), so the memory used grows with the size of the study after the
+    upload (bounded by the 16 MB MongoDB document limit), not with the batch size.
+
+    Args:
+        study_id (str): Study identifier
+        records (iterable): Sample entries (API or form format)
+        entry_format (str): Format of the records (api or form)
+        replace (bool): Replace existing samples
+        payload (dict): "validate", "form_names" and "manual_meta_information" (see sample_model_payload)
+        batch_size (int): Number of samples merged and validated at once
+        user (User): User adding the samples
+
+    Returns:
+        [dict]: message and the UUIDs of the added samples
+    """
+    prop_id_to_name = get_property_map(key="id", value="name")
+    prop_name_to_id = reverse_map(prop_id_to_name)
+    validate_dict, forms = get_samples_validation_forms(payload)
+
+    if entry_format == "form":
+        prop_name_to_syns = get_property_map(key="name", value="synonyms")
+    else:
+        prop_name_to_syns = None
+
+    # 1. Get study data (before reading the stream)
+    study = Study.objects().get(id=study_id)
+    study_json = marshal(study, study_model)
+
+    study_converter = CachedFormatConverter(mapper=prop_id_to_name)
+    study_converter.add_api_format(study_json["entries"])
+
+    with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as staging:
+        # 2. Spill the records to the staging file as they are read
+        n_samples = 0
+        for entries in records:
+            staging.write(json.dumps(entries) + "\n")
+            n_samples += 1
+
+        if n_samples == 0:
+            raise RequestBodyException("The request body does not contain any sample.")
+
+        staging.seek(0)
+
+        # 3. Convert, unify UUIDs, append to the study and validate batch by batch
+        unifier = SampleUnifier(study, study_converter)
+
+        if replace:
+            study_converter.remove_entries(prop_names=["samples"])
+
+        sample_uuids = []
+        for batch in iter_batches(iter_ndjson_records(staging), batch_size):
+            new_samples = [
+                convert_sample(
+                    entries,
+                    entry_format,
+                    prop_id_to_name,
+                    prop_name_to_id,
+                    prop_name_to_syns,
+                )
+                for entries in batch
+            ]
+            study_converter, _, batch_uuids = append_samples(
+                study_converter,
+                new_samples,
+                unifier,
+                prop_name_to_id,
+                validate_dict,
+                forms,
+                payload.get("form_names"),
+            )
+            sample_uuids.extend(batch_uuids)
+
+    # 4. Check unicity of specified properties
+    check_samples_unicity(study_converter.get_form_format()["samples"])
+    custom_sample_validation(study_converter.get_form_format()["samples"])
+
+    # 5. Update study state, data and upload on DB
+    message = f"Added {len(sample_uuids)} samples (replace = {replace})"
+    # Only the added samples are sent to Elastic Search (all of them if replaced)
+    entity_paths = None if replace else [[("samples", u)] for u in sample_uuids]
+    update_study(
+        study, study_converter, payload, message, user, entity_paths=entity_paths
+    )
+    return {"message": message, "uuids": sample_uuids}
+
+
+def append_samples(
+    study_converter,
+    new_samples,
+    unifier,
+    prop_name_to_id,
+    validate_dict,
+    forms,
+    form_names,
+    progress=None,
+):
+    """
+    Unify the UUIDs of new samples with existing ones, append them to the study and validate them
+
+    Args:
+        study_converter (FormatConverter): Study the samples are added to
+        new_samples (list): New samples as (converter, form format), see convert_sample()
+        unifier (SampleUnifier): Used to unify the UUIDs with existing samples (and previous batches)
+        prop_name_to_id (dict): Property map
+        validate_dict (dict): Which entities should be validated
+        forms (dict): Forms used for validation
+        form_names (dict): Names of the forms used for validation
+        progress (function): Optional callback progress(n_added) called after each sample
+
+    Returns:
+        [FormatConverter]: Updated study
+        [list]: New samples (form format) with unified UUIDs
+        [list]: UUIDs of the new samples
+    """
+    new_samples_form_format = unifier.unify(
+        study_converter, [sample_form_format for _, sample_form_format in new_samples]
+    )
+
+    sample_uuids = []
+    samples_to_validate = []
+    for i, (
+        (sample_converter, sample_form_format),
+        new_sample_form_format,
+    ) in enumerate(zip(new_samples, new_samples_form_format)):
+        sample_converter = set_unified_uuids(
+            sample_converter,
+            sample_form_format,
+            new_sample_form_format,
+            prop_name_to_id,
+        )
+
+        # Generate UUID (redundant, UUIDs already generated by unify_sample_entities_uuids)
+        sample_converter, sample_uuid = add_uuid_entry_if_missing(
+            sample_converter, prop_name_to_id
+        )
+
+        study_converter = add_entity_to_study_nested_list(
+            study_converter=study_converter,
+            entity_converter=sample_converter,
+            prop_name_to_id=prop_name_to_id,
+            study_list_prop="samples",
+        )
+
+        sample_uuids.append(sample_uuid)
+        samples_to_validate.append(
+            get_stored_sample_form_format(
+                sample_converter, new_sample_form_format, sample_uuid
+            )
+        )
+
+        if progress is not None:
+            progress(i + 1)
+
+    # The samples were appended in place
+    if isinstance(study_converter, CachedFormatConverter):
+        study_converter.invalidate()
+
+    # Validate data against forms
+    validate_samples(samples_to_validate, validate_dict, forms, form_names)
+
+    return study_converter, new_samples_form_format, sample_uuids
+
+
+def convert_sample(
+    entries, entry_format, prop_id_to_name, prop_name_to_id, prop_name_to_syns
+):
+    """
+    Format and clean a new sample, its only conversion: the converter is added to the study and
+    its form format is used for the unification and the validation
+    Returns (converter, form format)
+    """
+    sample_converter, _ = get_entity_converter(
+        entries,
+        entry_format,
+        prop_id_to_name,
+        prop_name_to_id,
+        replace_synonyms=True,
+        prop_name_to_syns=prop_name_to_syns,
+    )
+    return sample_converter, sample_converter.get_form_format()
+
+
+def set_unified_uuids(
+    sample_converter, sample_form_format, new_sample_form_format, prop_name_to_id
+):
+    """
+    Set the UUIDs of the unified sample (see SampleUnifier.unify) in its converter
+    unify_sample_entities_uuids() only sets UUIDs: the entries it changed (the sample UUID and the
+    nested entities) are built from the unified form format, the others are kept as converted
+    """
+    changed = {
+        prop_name: value
+        for prop_name, value in new_sample_form_format.items()
+        if sample_form_format.get(prop_name) != value
+    }
+    if changed:
+        changed_converter = FormatConverter(mapper=prop_name_to_id)
+        changed_converter.add_form_format(changed)
+        sample_converter.add_or_update_entries(changed_converter.entries)
+
+    return sample_converter
+
+
+def get_stored_sample_form_format(
+    sample_converter, new_sample_form_format, sample_uuid
+):
+    """
+    Form format of a sample as added to the study: the unified form format (cleaned entries with
+    their UUIDs), unless the sample UUID was generated after the unification
+    """
+    if new_sample_form_format.get("uuid") == sample_uuid:
+        return new_sample_form_format
+
+    return sample_converter.get_form_format()
+
+
+def validate_samples(samples_form_format, validate_dict, forms, form_names):
+    """
+    Validate samples against their forms
+    Large batches are validated in a pool of processes (see VALIDATION_PROCESSES)
+    """
+    pool = app.validation_pool
+    if pool is not None and forms and len(samples_form_format) >= pool.min_batch_size:
+        pool.validate_samples(
+            samples_form_format,
+            validate_dict,
+            {entity: form_names[entity] for entity in forms},
+        )
+    else:
+        for sample_form_format in samples_form_format:
+            validate_sample_against_form(sample_form_format, validate_dict, forms)
+
+
+class SampleUnifier:
+    """
+    Unify the UUIDs of new samples with the existing samples of a study
+    unify_sample_entities_uuids() only needs the existing samples sharing a key with the new ones
+    (same sample_id, same nested entity, see get_sample_keys). These are found with the sample
+    index (SampleIndex collection), so that only these are converted to form format instead of all
+    the existing samples.
+    """
+
+    def __init__(self, study, study_converter):
+        self.study_id = str(study.id)
+        # Keys of the samples added by the previous calls (not in the sample index yet)
+        self.index = {}
+
+        # Kept even if the samples are replaced, new samples are still unified with them
+        self.initial_samples_entry = study_converter.get_entry_by_name("samples")
+
+        self.indexed = self.has_stored_index()
+        if not self.indexed and self.initial_samples_entry is not None:
+            # Study written before the sample index existed
+            self.add_samples(self.initial_samples_entry.get_form_format())
+
+    def has_stored_index(self):
+        return has_sample_index(self.study_id)
+
+    def find_stored_uuids(self, keys):
+        """UUIDs of the samples of the sample index sharing at least one key"""
+        return find_sample_uuids(self.study_id, keys)
+
+    def add_samples(self, samples_form_format):
+        for item in get_sample_index(samples_form_format):
+            self.index.setdefault(item["key"], set()).add(item["uuid"])
+
+    def get_existing_samples(self, study_converter, keys):
+        """Existing samples (form format) sharing at least one key with the new samples"""
+        uuids = self.find_stored_uuids(keys) if self.indexed else set()
+        for key in keys:
+            uuids.update(self.index.get(key, set()))
+
+        # Samples added by the previous batches are only in the current entry
+        samples_entries = [study_converter.get_entry_by_name("samples")]
+        if self.initial_samples_entry is not samples_entries[0]:
+            samples_entries.append(self.initial_samples_entry)
+
+        existing_samples = []
+        for uuid in sorted(uuids):
+            for samples_entry in samples_entries:
+                sample_nested_entry = find_sample_nested_entry(samples_entry, uuid)
+                if sample_nested_entry is not None:
+                    existing_samples.append(sample_nested_entry.get_form_format())
+                    break
+
+        return existing_samples
+
+    def unify(self, study_converter, new_samples_form_format):
+        """Returns the new samples with unified UUIDs (added to the index for the next calls)"""
+        # The keys don't depend on the UUIDs: computed once for the lookup and the index
+        new_samples_keys = [get_sample_keys(s) for s in new_samples_form_format]
+
+        new_samples_form_format = unify_sample_entities_uuids(
+            existing_samples=self.get_existing_samples(
+                study_converter, set().union(*new_samples_keys)
+            ),
+            new_samples=new_samples_form_format,
+        )
+
+        for sample, keys in zip(new_samples_form_format, new_samples_keys):
+            if sample.get("uuid"):
+                for key in keys:
+                    self.index.setdefault(key, set()).add(sample["uuid"])
+
+        return new_samples_form_format
+
+
+def find_sample_nested_entry(samples_entry, sample_uuid):
+    """NestedEntry of a sample in a "samples" entry, None if not found"""
+    if samples_entry is None:
+        return None
+
+    try:
+        sample_nested_entry, _ = samples_entry.value.find_nested_entry(
+            "uuid", sample_uuid
+        )
+    except Exception:
+        # Not in this entry
+        return None
+
+    return sample_nested_entry
+
+
 def get_samples_validation_forms(payload):
     """
     Args:
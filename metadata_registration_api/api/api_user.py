@@ -183,6 +183,7 @@ class ApiUserId(Resource):
         # Needed to hash password
         entry.clean()
         entry.save()
+        app.user_cache.invalidate(entry.id)
         return {"message": f"Update entry '{entry.firstname}'"}
 
     @token_required
@@ -194,6 +195,7 @@ class ApiUserId(Resource):
         force_delete = args["complete"]
 
         entry = User.objects(id=id).get()
+        app.user_cache.invalidate(entry.id)
         if not force_delete:
             entry.update(is_active=False)
             return {"message": f"Inactivated entry '{entry.firstname}'"}
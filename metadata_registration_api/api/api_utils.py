@@ -1,13 +1,18 @@
+import csv
 from dataclasses import dataclass
 from datetime import datetime
+import json
 import os
+import re
 import requests
 from typing import Optional
 from urllib.parse import urljoin
 
 from flask import current_app as app
 
-from metadata_registration_lib.api_utils import map_key_value
+from metadata_registration_lib.api_utils import FormatConverter, map_key_value
+
+from metadata_registration_api.errors import RequestBodyException
 
 
 @dataclass()
@@ -22,19 +27,108 @@ class ChangeLog:
 
 
 class MetaInformation:
-    def __init__(self, state: str, change_log=None):
+    def __init__(self, state: str, change_log=None, evaluated_state=None):
 
         if change_log and not isinstance(change_log, list):
             raise AttributeError("Change log has to be an instance of list")
 
         self.state = state
         self.change_log = change_log if change_log else list()
+        self.evaluated_state = evaluated_state
 
     def add_log(self, log: ChangeLog):
         self.change_log.append(log.to_dict())
 
     def to_json(self):
-        return {"state": self.state, "change_log": self.change_log}
+        meta_info = {"state": self.state, "change_log": self.change_log}
+        if self.evaluated_state is not None:
+            meta_info["evaluated_state"] = self.evaluated_state
+        return meta_info
+
+
+def get_study_summary(form_format, state, log: ChangeLog):
+    """
+    Compute the summary stored with a study (entity counts, state and last change)
+    Parameters:
+        - form_format (dict): study entries in form format
+        - state (str): current state of the study
+        - log (ChangeLog): change log of the last modification
+    """
+    datasets = form_format.get("datasets") or []
+
+    return {
+        "n_datasets": len(datasets),
+        "n_pes": sum(len(d.get("process_events") or []) for d in datasets),
+        "n_samples": len(form_format.get("samples") or []),
+        "state": state,
+        "last_modified": log.timestamp,
+        "last_editor": log.manual_user or (str(log.user_id) if log.user_id else None),
+    }
+
+
+class CachedFormatConverter(FormatConverter):
+    """
+    FormatConverter caching its API and form format views until the entries change
+    The cache is invalidated by the mutating methods of the converter and when "entries" is set.
+    Call invalidate() after changing the entries in place (ex: add_entity_to_study_nested_list(),
+    entries found with get_entry_by_name()).
+    The cached views are shared: they must not be modified by the caller.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._api_format = None
+        self._form_format = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def entries(self):
+        return self.__dict__.get("_entries")
+
+    @entries.setter
+    def entries(self, entries):
+        self.invalidate()
+        self.__dict__["_entries"] = entries
+
+    def invalidate(self):
+        self._api_format = None
+        self._form_format = None
+
+    def _mutate(self, method, *args, **kwargs):
+        # Invalidate after too, in case the method reads a view while mutating
+        self.invalidate()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.invalidate()
+
+    def get_api_format(self, *args, **kwargs):
+        if args or kwargs:
+            return super().get_api_format(*args, **kwargs)
+        if self._api_format is None:
+            self._api_format = super().get_api_format()
+        return self._api_format
+
+    def get_form_format(self, *args, **kwargs):
+        if args or kwargs:
+            return super().get_form_format(*args, **kwargs)
+        if self._form_format is None:
+            self._form_format = super().get_form_format()
+        return self._form_format
+
+    def add_api_format(self, *args, **kwargs):
+        return self._mutate(super().add_api_format, *args, **kwargs)
+
+    def add_form_format(self, *args, **kwargs):
+        return self._mutate(super().add_form_format, *args, **kwargs)
+
+    def add_or_update_entries(self, *args, **kwargs):
+        return self._mutate(super().add_or_update_entries, *args, **kwargs)
+
+    def remove_entries(self, *args, **kwargs):
+        return self._mutate(super().remove_entries, *args, **kwargs)
+
+    def sort_from_form(self, *args, **kwargs):
+        return self._mutate(super().sort_from_form, *args, **kwargs)
 
 
 def get_json(url, headers={}):
@@ -76,3 +170,60 @@ def get_mask(request):
     mask_header = app.config["RESTX_MASK_HEADER"]
     mask = request.headers.get(mask_header)
     return mask
+
+
+def iter_ndjson_records(stream):
+    """
+    Parse a NDJSON stream (binary or text) one line at a time
+    Empty lines are skipped
+    """
+    for line_number, line in enumerate(stream, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise RequestBodyException(f"Invalid JSON on line {line_number}.") from e
+
+
+def iter_csv_records(stream):
+    """
+    Parse a CSV stream (binary or text, first row = header) one row at a time
+    Empty cells are skipped
+    Each column is a top-level property: nested entities (ex: a "individuals.sex" column)
+    can't be expressed in CSV and raise a RequestBodyException
+    """
+    lines = (l.decode("utf-8") if isinstance(l, bytes) else l for l in stream)
+
+    reader = csv.DictReader(lines)
+    for column in reader.fieldnames or []:
+        if re.search(r"[.\[\]]", column):
+            raise RequestBodyException(
+                f"Invalid CSV column '{column}': nested entities can't be expressed in CSV "
+                "(send the samples as NDJSON)."
+            )
+
+    for row in reader:
+        if None in row:
+            raise RequestBodyException(
+                f"CSV line {reader.line_num} has more cells than the header."
+            )
+        yield {key: value for key, value in row.items() if value not in ("", None)}
+
+
+def iter_batches(records, batch_size):
+    """Group an iterable into lists of at most batch_size items"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
@@ -1,14 +1,21 @@
+from datetime import datetime, timedelta
 from functools import wraps
+import hashlib
 import logging
-import jwt
 from jwt import DecodeError
 from jwt.exceptions import InvalidSignatureError
 
 from flask import current_app as app, request
 
 from metadata_registration_api.api import api
-from metadata_registration_api.model import User
-from metadata_registration_api.errors import TokenException
+from mongoengine.errors import NotUniqueError
+
+from metadata_registration_api.model import IdempotencyRecord
+from metadata_registration_api.errors import (
+    TokenException,
+    IdempotencyKeyException,
+    RequestBodyException,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -38,19 +45,140 @@ def token_required(f):
                 f"generated through log in."
             )
         try:
-            payload = jwt.decode(
-                token,
-                app.secret_key,
-                algorithms="HS256",
-            )
+            # Signature checked once per token (see user_cache.py)
+            payload = app.user_cache.get_payload(token)
         except InvalidSignatureError and DecodeError as e:
             raise TokenException(
                 f"Your given token is invalid. Your can receive a valid token bt login."
             ) from e
 
-        # Get the user and pass it to the request
-        user = User.objects(id=payload["user_id"]).first()
+        # Get the user (cached) and pass it to the request
+        user = app.user_cache.get_user(payload["user_id"])
 
         return f(self, user=user, *args, **kwargs)
 
     return decorated
+
+
+def idempotent(f):
+    """
+    A decorator to replay the stored response of a write request sent again with the same
+    Idempotency-Key header (ex: client retry after a timeout), without processing it again
+    Has to be applied after token_required (the keys are scoped per user)
+    A request still "processing" after IDEMPOTENCY_LEASE seconds (crashed worker) is processed
+    again by the next retry
+    """
+
+    # Add header documentation to swagger
+    f = api.doc(
+        params={
+            "Idempotency-Key": {
+                "in": "header",
+                "type": "string",
+                "description": "Unique key of the request, retries with the same key "
+                "return the stored response (kept 24 hours)",
+            }
+        }
+    )(f)
+
+    @wraps(f)
+    def decorated(self, *args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return f(self, *args, **kwargs)
+
+        user = kwargs.get("user")
+        user_id = user.id if user else None
+        request_hash = get_request_hash()
+        lease = timedelta(seconds=app.config["IDEMPOTENCY_LEASE"])
+
+        try:
+            record = IdempotencyRecord(
+                key=key,
+                user_id=user_id,
+                request_hash=request_hash,
+                created=datetime.now(),
+                lease_expires=get_lease_expires(lease),
+            ).save(force_insert=True)
+        except NotUniqueError:
+            record = IdempotencyRecord.objects(key=key, user_id=user_id).first()
+            if record is None:
+                raise IdempotencyKeyException(
+                    f"The request with the Idempotency-Key '{key}' just failed, please retry."
+                )
+            if record.request_hash != request_hash:
+                raise RequestBodyException(
+                    f"The Idempotency-Key '{key}' was already used for a different request."
+                )
+            if record.status == "processing":
+                if not take_over_record(record, lease):
+                    raise IdempotencyKeyException(
+                        f"The request with the Idempotency-Key '{key}' is still being processed."
+                    )
+                logger.warning(
+                    f"Process again the request with the Idempotency-Key '{key}' (lease expired)"
+                )
+            else:
+                logger.info(f"Replay response of request with Idempotency-Key '{key}'")
+                return record.response, record.status_code
+
+        try:
+            result = f(self, *args, **kwargs)
+        except Exception:
+            # Failed requests can be retried with the same key (unless taken over meanwhile)
+            IdempotencyRecord.objects(
+                id=record.id, lease_expires=record.lease_expires
+            ).delete()
+            raise
+
+        if isinstance(result, tuple):
+            response, status_code = result[0], result[1]
+        else:
+            response, status_code = result, 200
+
+        record.update(
+            set__status="completed",
+            set__response=response,
+            set__status_code=status_code,
+        )
+        return response, status_code
+
+    return decorated
+
+
+def take_over_record(record, lease):
+    """
+    Take over a "processing" record whose lease expired (the worker processing it crashed)
+    Returns False if the lease is still valid or if another retry took the record over first
+    """
+    # Records written before the lease existed: lease from their creation
+    lease_expires = record.lease_expires or record.created + lease
+    if lease_expires > datetime.now():
+        return False
+
+    new_lease_expires = get_lease_expires(lease)
+    n_updated = IdempotencyRecord.objects(
+        id=record.id, status="processing", lease_expires=record.lease_expires
+    ).update(set__lease_expires=new_lease_expires)
+    if n_updated == 0:
+        return False
+
+    record.lease_expires = new_lease_expires
+    return True
+
+
+def get_lease_expires(lease):
+    """End of a new lease, in milliseconds like the dates stored in MongoDB (compared on update)"""
+    lease_expires = datetime.now() + lease
+    return lease_expires.replace(microsecond=lease_expires.microsecond // 1000 * 1000)
+
+
+def get_request_hash():
+    """Hash of the method, path, query string and body of the current request"""
+    request_hash = hashlib.sha256()
+    for part in [request.method, request.path, request.query_string.decode()]:
+        request_hash.update(part.encode())
+        request_hash.update(b"\0")
+    request_hash.update(request.get_data(cache=True))
+
+    return request_hash.hexdigest()
@@ -12,14 +12,25 @@ import time
 
 from flask import Flask, request, g
 from flask_cors import CORS
-from mongoengine import connect
 
 from metadata_registration_api.datastores import MongoEngineDataStore
-from metadata_registration_api.mongo_utils import get_states
+from metadata_registration_api.jobs import JobQueue
+from metadata_registration_api.mongo_pool import (
+    PoolMetrics,
+    connect_mongo,
+    get_pool_config,
+    get_read_preferences,
+    get_route_read_preference,
+)
+from metadata_registration_api.es_bulk import get_es_config
+from metadata_registration_api.es_outbox import EsOutboxFlusher
+from metadata_registration_api.reference_registry import ReferenceRegistry
+from metadata_registration_api.state_registry import StateRegistry
+from metadata_registration_api.user_cache import UserCache
+from metadata_registration_api.validation_pool import ValidationPool
 from metadata_registration_api.api import api
 
 from dynamic_form import FormManager
-from study_state_machine import context
 
 logger = logging.getLogger(__name__)
 
@@ -72,6 +83,12 @@ def config_app(app):
     app.config["MONGODB_USERNAME"] = os.environ["MONGODB_USERNAME"]
     app.config["MONGODB_PASSWORD"] = os.environ["MONGODB_PASSWORD"]
     app.config["MONGODB_CONNECT"] = False
+    # Connection pool and query time limit (see mongo_pool.py)
+    app.config["MONGODB_POOL"] = get_pool_config()
+    # Read preferences of the GET requests by path prefix (ex: "/studies=secondaryPreferred:120")
+    app.config["MONGODB_READ_PREFERENCES"] = get_read_preferences(
+        os.environ.get("MONGODB_READ_PREFERENCES")
+    )
 
     # Load mongo collection names
     app.config["MONGODB_COL_PROPERTY"] = os.environ["MONGODB_COL_PROPERTY"]
@@ -82,19 +99,53 @@ def config_app(app):
     app.config["MONGODB_COL_STATE"] = os.environ["MONGODB_COL_STATE"]
 
     # Elastic search
-    app.config["ES"] = {
-        "HOST": os.environ.get("ES_HOST"),
-        "PORT": os.environ.get("ES_PORT"),
-        "INDEX": os.environ.get("ES_INDEX"),
-        "SECURE": strtobool(os.environ.get("ES_SECURE", "false")),
-        "USERNAME": os.environ.get("ES_USERNAME"),
-        "PASSWORD": os.environ.get("ES_PASSWORD"),
-        "USE": os.environ.get("ES_USE"),
-    }
+    app.config["ES"] = get_es_config()
+    # Minimum number of seconds between two checks of the states collection version
+    app.config["STATE_CHECK_INTERVAL"] = float(
+        os.environ.get("STATE_CHECK_INTERVAL", "5")
+    )
+    # Maximum age (seconds) of the in-process copy of the properties and CVs
+    app.config["REFERENCE_REGISTRY_MAX_AGE"] = float(
+        os.environ.get("REFERENCE_REGISTRY_MAX_AGE", "60")
+    )
+    # Maximum age (seconds) of the users cached by token_required
+    app.config["USER_CACHE_MAX_AGE"] = float(os.environ.get("USER_CACHE_MAX_AGE", "60"))
+    app.config["MONGODB_COL_ES_OUTBOX"] = os.environ.get(
+        "MONGODB_COL_ES_OUTBOX", "es_outbox"
+    )
+
+    # Nested entities of the studies (uuid lookups)
+    app.config["MONGODB_COL_ENTITY_INDEX"] = os.environ.get(
+        "MONGODB_COL_ENTITY_INDEX", "entity_index"
+    )
+    # Identity keys of the samples (unification of the sample UUIDs)
+    app.config["MONGODB_COL_SAMPLE_INDEX"] = os.environ.get(
+        "MONGODB_COL_SAMPLE_INDEX", "sample_index"
+    )
 
     # UNICITY CHECKS (format = "a,b;c,d" meaning the combinations a,b and c,d must me unique)
     app.config["UNIQUE_SAMPLE_PROPS"] = os.environ.get("UNIQUE_SAMPLE_PROPS")
 
+    # Background jobs (ex: large sample uploads)
+    app.config["MONGODB_COL_JOB"] = os.environ.get("MONGODB_COL_JOB", "job")
+    app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", "2"))
+
+    # Stored responses of requests sent with an Idempotency-Key header
+    app.config["MONGODB_COL_IDEMPOTENCY"] = os.environ.get(
+        "MONGODB_COL_IDEMPOTENCY", "idempotency_record"
+    )
+    # Seconds after which a request still "processing" is considered dead (crashed worker) and can
+    # be taken over by a retry, must be longer than the longest request
+    app.config["IDEMPOTENCY_LEASE"] = float(os.environ.get("IDEMPOTENCY_LEASE", "600"))
+
+    # Validation of large sample batches in a pool of processes (0 = disabled)
+    app.config["VALIDATION_PROCESSES"] = int(
+        os.environ.get("VALIDATION_PROCESSES", "0")
+    )
+    app.config["VALIDATION_MIN_BATCH_SIZE"] = int(
+        os.environ.get("VALIDATION_MIN_BATCH_SIZE", "200")
+    )
+
 
 def create_app():
     app = Flask(__name__)
@@ -105,12 +156,16 @@ def create_app():
     # Restplus API
     app.config["ERROR_404_HELP"] = False
 
-    app.mongo_client = connect(
+    # Single client (connection pool) shared by MongoEngine, the raw pymongo reads and the jobs
+    app.mongo_pool_metrics = PoolMetrics()
+    app.mongo_client = connect_mongo(
         app.config["MONGODB_DB"],
         host=app.config["MONGODB_HOST"],
         port=app.config["MONGODB_PORT"],
         username=app.config["MONGODB_USERNAME"],
         password=app.config["MONGODB_PASSWORD"],
+        pool_config=app.config["MONGODB_POOL"],
+        pool_metrics=app.mongo_pool_metrics,
     )
 
     # There might be a better way to set the collection names
@@ -122,6 +177,11 @@ def create_app():
         Form,
         User,
         Study,
+        Job,
+        IdempotencyRecord,
+        EsOutbox,
+        EntityIndex,
+        SampleIndex,
     )
 
     # noinspection PyProtectedMember
@@ -134,6 +194,16 @@ def create_app():
     User._meta["collection"] = app.config["MONGODB_COL_USER"]
     # noinspection PyProtectedMember
     Study._meta["collection"] = app.config["MONGODB_COL_STUDY"]
+    # noinspection PyProtectedMember
+    Job._meta["collection"] = app.config["MONGODB_COL_JOB"]
+    # noinspection PyProtectedMember
+    IdempotencyRecord._meta["collection"] = app.config["MONGODB_COL_IDEMPOTENCY"]
+    # noinspection PyProtectedMember
+    EsOutbox._meta["collection"] = app.config["MONGODB_COL_ES_OUTBOX"]
+    # noinspection PyProtectedMember
+    EntityIndex._meta["collection"] = app.config["MONGODB_COL_ENTITY_INDEX"]
+    # noinspection PyProtectedMember
+    SampleIndex._meta["collection"] = app.config["MONGODB_COL_SAMPLE_INDEX"]
 
     api.init_app(
         app,
@@ -146,6 +216,16 @@ def create_app():
         "Any issue reports or feature requests are appreciated.",
     )
 
+    # Send the reads of the GET requests to the configured members (primary by default)
+    if app.config["MONGODB_READ_PREFERENCES"]:
+        # pylint: disable=unused-variable
+        @app.before_request
+        def set_read_preference():
+            if request.method in ["GET", "HEAD"]:
+                g.read_preference = get_route_read_preference(
+                    app.config["MONGODB_READ_PREFERENCES"], request.path
+                )
+
     # Log each request
     if app.config["LOG_ALL_REQUESTS"]:
         # pylint: disable=unused-variable
@@ -178,8 +258,46 @@ def create_app():
     data_store = MongoEngineDataStore(form_model=Form)
     app.form_manager = FormManager(data_store=data_store, initial_load=False)
 
-    available_states = get_states(app=app, q={})
-    app.study_state_machine = context.Context(available_states=available_states)
+    if app.config["VALIDATION_PROCESSES"] > 0:
+        app.validation_pool = ValidationPool(
+            data_store=data_store,
+            processes=app.config["VALIDATION_PROCESSES"],
+            min_batch_size=app.config["VALIDATION_MIN_BATCH_SIZE"],
+        )
+    else:
+        app.validation_pool = None
+
+    # States read through the pooled client and cached (see state_registry.py)
+    app.state_registry = StateRegistry(
+        app.mongo_client[app.config["MONGODB_DB"]][app.config["MONGODB_COL_STATE"]],
+        check_interval=app.config["STATE_CHECK_INTERVAL"],
+    )
+    # Load and compile the states now (a new version is swapped in by the registry)
+    app.state_registry.get_state_machine()
+
+    app.job_queue = JobQueue(app=app, max_workers=app.config["JOB_WORKERS"])
+
+    app.reference_registry = ReferenceRegistry(
+        max_age=app.config["REFERENCE_REGISTRY_MAX_AGE"]
+    )
+
+    # Verified tokens and their users (see user_cache.py)
+    app.user_cache = UserCache(app.secret_key, max_age=app.config["USER_CACHE_MAX_AGE"])
+
+    # Send the study changes written in the ES outbox to Elastic Search
+    if app.config["ES"]["USE"]:
+        from metadata_registration_api.api.api_study import get_study_es_document
+
+        def get_document(study_id):
+            with app.app_context():
+                return get_study_es_document(study_id)
+
+        app.es_outbox_flusher = EsOutboxFlusher(
+            app.config["ES"],
+            batch_size=app.config["ES"]["BULK_SIZE"],
+            interval=app.config["ES"]["FLUSH_INTERVAL"],
+            get_document=get_document,
+        ).start()
 
     logger.info(f"Created Flask API and exposed {url}")
 
@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenException(Exception):
+    """The call was not attempted, the circuit is open"""
+
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing service for a while
+    - closed: calls are made, failure_threshold consecutive failures open the circuit
+    - open: calls are refused for reset_timeout seconds
+    - half_open: a single probe call is made, it closes the circuit if it succeeds, else the
+    circuit is open again
+    """
+
+    def __init__(
+        self, name, failure_threshold=5, reset_timeout=30, clock=time.monotonic
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._n_failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == "open" and self._is_reset_timeout_over():
+                return "half_open"
+            return self._state
+
+    def _is_reset_timeout_over(self):
+        return self.clock() - self._opened_at >= self.reset_timeout
+
+    def allow_request(self):
+        """Returns True if a call can be made now (reserves the probe call when half open)"""
+        with self._lock:
+            if self._state == "closed":
+                return True
+
+            if self._state == "open" and self._is_reset_timeout_over():
+                self._state = "half_open"
+                logger.info(f"Circuit {self.name} half open, probing")
+
+            if self._state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+
+            return False
+
+    def release(self):
+        """Give back the probe call reserved by allow_request() without making it"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != "closed":
+                logger.info(f"Circuit {self.name} closed")
+            self._state = "closed"
+            self._n_failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._n_failures += 1
+            self._probing = False
+            if self._state == "half_open" or self._n_failures >= self.failure_threshold:
+                if self._state != "open":
+                    logger.warning(
+                        f"Circuit {self.name} open for {self.reset_timeout}s "
+                        f"after {self._n_failures} failures"
+                    )
+                self._state = "open"
+                self._opened_at = self.clock()
+
+    def call(self, func, *args, **kwargs):
+        """Call func through the breaker, raises CircuitOpenException if the circuit is open"""
+        if not self.allow_request():
+            raise CircuitOpenException(f"Circuit {self.name} is open")
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+
+        self.record_success()
+        return result
@@ -0,0 +1,94 @@
+"""
+Index the nested entities of the studies written before the entity index existed
+
+    python -m metadata_registration_api.entity_index_backfill [--batch-size 500]
+
+Run once after deploying the entity index (the uuid lookups of /ids and of the routes without
+study id only read the EntityIndex collection): new and updated studies are always indexed.
+The studies without any indexed entity are streamed from MongoDB (raw pymongo dicts), converted
+to form format and their entities inserted in batches. Running it again is harmless.
+Uses the same environment variables as the app (MONGODB_*).
+"""
+import argparse
+import logging
+import sys
+
+from metadata_registration_lib.api_utils import FormatConverter
+
+from .es_reindex import connect_from_env
+from .model import EntityIndex, Study
+from .mongo_utils import (
+    get_entity_index,
+    get_raw_studies,
+    insert_entity_index,
+    raw_study_to_json,
+)
+from .reference_registry import ReferenceRegistry
+
+logger = logging.getLogger(__name__)
+
+
+def get_study_entity_index(raw_study, prop_id_to_name):
+    """Entities of a raw study, with their "study_id" (see mongo_utils.get_entity_index)"""
+    study_json = raw_study_to_json(raw_study)
+    study_converter = FormatConverter(prop_id_to_name)
+    study_converter.add_api_format(study_json["entries"])
+
+    return [
+        {"study_id": study_json["id"], **e}
+        for e in get_entity_index(study_converter.get_form_format())
+    ]
+
+
+def index_studies_without_entity_index(prop_id_to_name, batch_size=500):
+    """Index the nested entities of the studies without any indexed entity"""
+    indexed_study_ids = set(EntityIndex.objects().distinct("study_id"))
+    raw_studies = get_raw_studies(Study.objects(), fields=["id", "entries"])
+
+    n_indexed = 0
+    entity_index = []
+    for raw_study in raw_studies:
+        if str(raw_study["_id"]) in indexed_study_ids:
+            continue
+
+        entity_index.extend(get_study_entity_index(raw_study, prop_id_to_name))
+        n_indexed += 1
+        if n_indexed % batch_size == 0:
+            insert_entity_index(entity_index)
+            logger.info(f"{n_indexed} studies indexed")
+            entity_index = []
+
+    insert_entity_index(entity_index)
+
+    return n_indexed
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Index the nested entities of the studies written before the entity index existed"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of studies indexed per bulk insert",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    connect_from_env()
+
+    registry = ReferenceRegistry()
+    n_indexed = index_studies_without_entity_index(
+        registry.get_property_map(key="id", value="name"), batch_size=args.batch_size
+    )
+    logger.info(f"Entity index computed for {n_indexed} studies")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
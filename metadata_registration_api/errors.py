@@ -12,3 +12,7 @@ class RequestBodyException(ApiBaseException):
 
 class TokenException(ApiBaseException):
     pass
+
+
+class IdempotencyKeyException(ApiBaseException):
+    pass
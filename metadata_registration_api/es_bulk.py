@@ -0,0 +1,286 @@
+import copy
+import json
+import os
+from distutils.util import strtobool
+
+import requests
+
+from metadata_registration_lib import es_utils
+
+
+def get_es_config():
+    """Elastic Search configuration (app.config["ES"]) from the environment variables"""
+    return {
+        "HOST": os.environ.get("ES_HOST"),
+        "PORT": os.environ.get("ES_PORT"),
+        "INDEX": os.environ.get("ES_INDEX"),
+        "SECURE": strtobool(os.environ.get("ES_SECURE", "false")),
+        "USERNAME": os.environ.get("ES_USERNAME"),
+        "PASSWORD": os.environ.get("ES_PASSWORD"),
+        "USE": os.environ.get("ES_USE"),
+        # Outbox flusher (see es_outbox.py)
+        "BULK_SIZE": int(os.environ.get("ES_BULK_SIZE", "500")),
+        "FLUSH_INTERVAL": float(os.environ.get("ES_FLUSH_INTERVAL", "1")),
+        # Timeouts (seconds) of the requests to Elastic Search
+        "CONNECT_TIMEOUT": float(os.environ.get("ES_CONNECT_TIMEOUT", "3")),
+        "TIMEOUT": float(os.environ.get("ES_TIMEOUT", "30")),
+        # Circuit breaker of the outbox flusher (see circuit_breaker.py)
+        "BREAKER_FAILURES": int(os.environ.get("ES_BREAKER_FAILURES", "5")),
+        "BREAKER_RESET_TIMEOUT": float(
+            os.environ.get("ES_BREAKER_RESET_TIMEOUT", "30")
+        ),
+    }
+
+
+def get_es_url(es_config):
+    """
+    Base URL of the Elastic Search cluster
+    Parameters:
+        - es_config (dict): app.config["ES"] configuration dict
+    """
+    http_prefix = "https" if es_config["SECURE"] else "http"
+    return f"{http_prefix}://{es_config['HOST']}:{es_config['PORT']}"
+
+
+def get_es_timeout(es_config, timeout=None):
+    """(connect, read) timeout of a request, the read timeout can be overridden"""
+    return (
+        es_config.get("CONNECT_TIMEOUT", 3),
+        timeout or es_config.get("TIMEOUT", 30),
+    )
+
+
+def get_es_auth(es_config):
+    if es_config.get("USERNAME"):
+        return (es_config["USERNAME"], es_config["PASSWORD"])
+    return None
+
+
+def get_bulk_body(index, operations):
+    """
+    NDJSON body of a _bulk request
+    Parameters:
+        - index (str): Elastic Search index
+        - operations (list): dicts with "action" ("index", "update" or "delete"), "id" and
+        "document" (study for "index", update body for "update")
+    """
+    lines = []
+    for operation in operations:
+        lines.append(
+            json.dumps({operation["action"]: {"_index": index, "_id": operation["id"]}})
+        )
+        if operation["action"] in ["index", "update"]:
+            lines.append(json.dumps(operation["document"], default=str))
+
+    return "\n".join(lines) + "\n"
+
+
+def send_bulk(es_config, operations, timeout=None):
+    """
+    Send operations to Elastic Search in one _bulk request
+    Returns the error of each operation (None if it succeeded), in the same order
+    Raises an exception if the request itself failed (connection error, HTTP error)
+    """
+    if len(operations) == 0:
+        return []
+
+    res = requests.post(
+        f"{get_es_url(es_config)}/_bulk",
+        data=get_bulk_body(es_config["INDEX"], operations).encode(),
+        headers={"Content-Type": "application/x-ndjson"},
+        auth=get_es_auth(es_config),
+        timeout=get_es_timeout(es_config, timeout),
+    )
+    res.raise_for_status()
+
+    errors = []
+    for operation, item in zip(operations, res.json()["items"]):
+        result = item[operation["action"]]
+        status = result.get("status", 500)
+
+        # Deleting a study which is not indexed is not an error
+        if 200 <= status < 300 or (operation["action"] == "delete" and status == 404):
+            errors.append(None)
+        else:
+            errors.append(str(result.get("error", f"Status {status}")))
+
+    return errors
+
+
+def get_study_document(study_json, form_format, es_maps, last_modified=None):
+    """
+    Elastic Search document of a study, built by metadata_registration_lib.es_utils: same
+    document as es_utils.index_study, but the property and CV maps are passed in memory
+    instead of being fetched from the API endpoints
+    Parameters:
+        - study_json (dict): marshalled study (study_model_prop_id)
+        - form_format (dict): study entries in form format (not modified)
+        - es_maps (dict): maps built by ReferenceRegistry.get_es_maps()
+        - last_modified (datetime): Study.summary.last_modified, stored as the document version
+    """
+    study_data = dict(study_json)
+    study_data["entries"] = copy.deepcopy(form_format)
+
+    document = es_utils.prepare_study_data(
+        study_data,
+        prop_name_to_cv_name=es_maps["prop_name_to_cv_name"],
+        cv_items_map=es_maps["cv_items_map"],
+    )
+    document["version"] = get_es_version(last_modified)
+    return document
+
+
+def get_es_version(last_modified):
+    """
+    Version of a study in the index (compared with MongoDB by es_reconcile)
+    Milliseconds precision, like the dates stored in MongoDB
+    """
+    if last_modified is None:
+        return None
+    return last_modified.isoformat(timespec="milliseconds")
+
+
+# Replace (or add) and remove nested entities of the indexed study, found by their uuid path
+ENTITY_UPDATE_SCRIPT = """
+for (change in params.changes) {
+  def node = ctx._source.entries;
+  for (step in change.path) {
+    def parent = null;
+    if (node[step.prop] != null) {
+      for (entity in node[step.prop]) {
+        if (entity.uuid == step.uuid) { parent = entity; }
+      }
+    }
+    if (parent == null) {
+      throw new IllegalArgumentException('Entity not found: ' + step.uuid);
+    }
+    node = parent;
+  }
+  if (node[change.prop] == null) { node[change.prop] = []; }
+  def entities = node[change.prop];
+  int index = -1;
+  for (int i = 0; i < entities.size(); i++) {
+    if (entities[i].uuid == change.uuid) { index = i; }
+  }
+  if (change.entity == null) {
+    if (index >= 0) { entities.remove(index); }
+  } else if (index >= 0) {
+    entities[index] = change.entity;
+  } else {
+    entities.add(change.entity);
+  }
+}
+ctx._source.meta_information = params.meta_information;
+ctx._source.version = params.version;
+"""
+
+
+def get_update_body(update):
+    """Body of a scripted "update" operation from its params (see get_entity_update)"""
+    return {
+        "script": {"source": ENTITY_UPDATE_SCRIPT, "lang": "painless", "params": update}
+    }
+
+
+def get_entity_update(document, entity_paths):
+    """
+    Params of a partial update replacing only the changed nested entities of an indexed study
+    The entities are taken from the full document of the study (see get_study_document): they
+    have the same layout as in the index
+    Returns None if an entity parent can't be found (the whole study must be indexed)
+    Parameters:
+        - document (dict): ES document of the study after the change
+        - entity_paths (list): path of each changed entity, as a list of (list_prop, uuid)
+        from the study. Ex: [("datasets", dataset_uuid), ("process_events", pe_uuid)]
+    """
+    if not isinstance(document.get("entries"), dict):
+        return None
+
+    changes = []
+    for entity_path in entity_paths:
+        node = document["entries"]
+        for list_prop, uuid in entity_path[:-1]:
+            node = find_entity(node.get(list_prop), uuid)
+            if node is None:
+                return None
+
+        list_prop, uuid = entity_path[-1]
+        changes.append(
+            {
+                "path": [{"prop": p, "uuid": u} for p, u in entity_path[:-1]],
+                "prop": list_prop,
+                "uuid": uuid,
+                # None: the entity was deleted
+                "entity": find_entity(node.get(list_prop), uuid),
+            }
+        )
+
+    return {
+        "changes": changes,
+        "meta_information": document.get("meta_information"),
+        "version": document.get("version"),
+    }
+
+
+def find_entity(entities, uuid):
+    for entity in entities or []:
+        if isinstance(entity, dict) and entity.get("uuid") == uuid:
+            return entity
+    return None
+
+
+def mget_versions(es_config, study_ids, timeout=None):
+    """Version of the indexed studies: {study_id: version}, studies not indexed are missing"""
+    if len(study_ids) == 0:
+        return {}
+
+    res = requests.post(
+        f"{get_es_url(es_config)}/{es_config['INDEX']}/_mget",
+        params={"_source_includes": "version"},
+        json={"ids": study_ids},
+        auth=get_es_auth(es_config),
+        timeout=get_es_timeout(es_config, timeout),
+    )
+    res.raise_for_status()
+
+    return {
+        doc["_id"]: doc.get("_source", {}).get("version")
+        for doc in res.json()["docs"]
+        if doc.get("found")
+    }
+
+
+def iter_indexed_ids(es_config, batch_size=1000, timeout=None):
+    """Ids of all the indexed studies by batch of batch_size (scroll)"""
+    es_url = get_es_url(es_config)
+    auth = get_es_auth(es_config)
+
+    res = requests.post(
+        f"{es_url}/{es_config['INDEX']}/_search",
+        params={"scroll": "5m"},
+        json={"size": batch_size, "_source": False, "sort": ["_doc"]},
+        auth=auth,
+        timeout=get_es_timeout(es_config, timeout),
+    )
+    res.raise_for_status()
+    result = res.json()
+
+    try:
+        while len(result["hits"]["hits"]) > 0:
+            yield [hit["_id"] for hit in result["hits"]["hits"]]
+
+            res = requests.post(
+                f"{es_url}/_search/scroll",
+                json={"scroll": "5m", "scroll_id": result["_scroll_id"]},
+                auth=auth,
+                timeout=get_es_timeout(es_config, timeout),
+            )
+            res.raise_for_status()
+            result = res.json()
+    finally:
+        requests.delete(
+            f"{es_url}/_search/scroll",
+            json={"scroll_id": result["_scroll_id"]},
+            auth=auth,
+            timeout=get_es_timeout(es_config, timeout),
+        )
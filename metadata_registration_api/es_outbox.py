@@ -0,0 +1,290 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from mongoengine.queryset.visitor import Q
+
+from .circuit_breaker import CircuitBreaker
+from .es_bulk import get_update_body, send_bulk
+from .model import EsOutbox
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_es_operation(study_id, action, document=None):
+    """
+    Write the Elastic Search operation of a study in the outbox (replaces the pending one)
+    Parameters:
+        - study_id (str): id of the study
+        - action (str): "index" or "delete"
+        - document (dict): Study data in form format (action = "index"), if None the document
+          is built from MongoDB when the operation is sent (see EsOutboxFlusher.load_documents)
+    """
+    now = datetime.now()
+    EsOutbox.objects(study_id=str(study_id)).update_one(
+        upsert=True,
+        set__action=action,
+        set__document=document or {},
+        set__updates=[],
+        inc__version=1,
+        set__attempts=0,
+        set__next_attempt_at=now,
+        set__updated=now,
+        unset__last_error=True,
+    )
+
+
+def enqueue_es_update(study_id, update):
+    """
+    Add a partial update of a study to the outbox (applied after the pending operation)
+    Parameters:
+        - study_id (str): id of the study
+        - update (dict): script params built by es_bulk.get_entity_update
+    """
+    now = datetime.now()
+    EsOutbox.objects(study_id=str(study_id)).update_one(
+        upsert=True,
+        set_on_insert__action="update",
+        push__updates=update,
+        inc__version=1,
+        set__attempts=0,
+        set__next_attempt_at=now,
+        set__updated=now,
+        unset__last_error=True,
+    )
+
+
+def get_outbox_operations(outbox):
+    """_bulk operations of an outbox document: the pending operation, then the partial updates"""
+    if outbox.action == "delete":
+        return [{"action": "delete", "id": outbox.study_id}]
+
+    operations = []
+    if outbox.action == "index":
+        operations.append(
+            {"action": "index", "id": outbox.study_id, "document": outbox.document}
+        )
+    for update in outbox.updates:
+        operations.append(
+            {
+                "action": "update",
+                "id": outbox.study_id,
+                "document": get_update_body(update),
+            }
+        )
+
+    return operations
+
+
+class EsOutboxFlusher:
+    """
+    Send the pending operations of the outbox to Elastic Search with _bulk requests
+    Several flushers (ex: one per gunicorn worker) can run at the same time: each operation is
+    claimed atomically for a lease before being sent. Failed operations are retried with an
+    exponential backoff. A study whose partial updates fail (ex: not indexed yet) is indexed in
+    full if get_document is given.
+    The _bulk requests go through a circuit breaker: while Elastic Search is down, nothing is
+    claimed and the operations stay in the outbox (a single batch probes Elastic Search).
+    """
+
+    def __init__(
+        self,
+        es_config,
+        batch_size=500,
+        interval=1,
+        lease_seconds=60,
+        backoff_seconds=2,
+        max_backoff_seconds=600,
+        get_document=None,
+        breaker=None,
+    ):
+        """
+        Args:
+            get_document: get_document(study_id) returns the full document of a study (None if the
+            study doesn't exist anymore or is deprecated: it is removed from the index)
+            breaker (CircuitBreaker): default from es_config (BREAKER_FAILURES, BREAKER_RESET_TIMEOUT)
+        """
+        self.es_config = es_config
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease_seconds = lease_seconds
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.get_document = get_document
+        self.breaker = breaker or CircuitBreaker(
+            "elastic_search",
+            failure_threshold=es_config.get("BREAKER_FAILURES", 5),
+            reset_timeout=es_config.get("BREAKER_RESET_TIMEOUT", 30),
+        )
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="es-outbox-flusher", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                n_sent = self.flush_once()
+            except Exception:
+                logger.exception("Failed to flush the Elastic Search outbox")
+                n_sent = 0
+
+            # Keep flushing while the outbox is full, else wait
+            if n_sent < self.batch_size:
+                self._stop.wait(self.interval)
+
+    def claim(self, limit=None):
+        """Claim up to limit (default batch_size) due operations, returns the claimed outbox documents"""
+        now = datetime.now()
+        claimed_until = now + timedelta(seconds=self.lease_seconds)
+
+        not_claimed = Q(claimed_until=None) | Q(claimed_until__lt=now)
+
+        candidates = (
+            EsOutbox.objects(not_claimed, next_attempt_at__lte=now)
+            .order_by("next_attempt_at")
+            .limit(limit or self.batch_size)
+        )
+
+        claimed = []
+        for outbox in candidates:
+            n_updated = EsOutbox.objects(
+                not_claimed, id=outbox.id, version=outbox.version
+            ).update_one(set__claimed_until=claimed_until)
+            if n_updated == 1:
+                claimed.append(outbox)
+
+        return claimed
+
+    def flush_once(self):
+        """Send one batch of operations, returns the number of operations sent"""
+        # Circuit open: keep the operations in the outbox
+        if not self.breaker.allow_request():
+            return 0
+
+        # Half open: probe Elastic Search with a single operation
+        limit = 1 if self.breaker.state == "half_open" else self.batch_size
+        try:
+            claimed = self.load_documents(self.claim(limit))
+        except Exception:
+            self.breaker.release()
+            raise
+
+        if len(claimed) == 0:
+            # Nothing sent: give back the probe if half open
+            self.breaker.release()
+            return 0
+
+        outbox_operations = [get_outbox_operations(o) for o in claimed]
+        operations = [op for ops in outbox_operations for op in ops]
+
+        try:
+            op_errors = iter(send_bulk(self.es_config, operations))
+        except Exception as e:
+            logger.warning(f"Elastic Search _bulk request failed: {e}")
+            self.breaker.record_failure()
+            op_errors = iter([str(e)] * len(operations))
+        else:
+            self.breaker.record_success()
+
+        # First error of the operations of each outbox document
+        errors = []
+        for ops in outbox_operations:
+            outbox_errors = [next(op_errors) for _ in ops]
+            errors.append(next((e for e in outbox_errors if e is not None), None))
+
+        for outbox, error in zip(claimed, errors):
+            if error is None:
+                # Only remove the sent version (a newer operation may have been written since)
+                n_deleted = EsOutbox.objects(
+                    id=outbox.id, version=outbox.version
+                ).delete()
+                if n_deleted == 0:
+                    EsOutbox.objects(id=outbox.id).update_one(unset__claimed_until=True)
+            elif outbox.updates and self.get_document is not None:
+                self.index_in_full(outbox, error)
+            else:
+                self.retry_later(outbox, error)
+
+        n_errors = len([e for e in errors if e is not None])
+        if n_errors > 0:
+            logger.warning(f"{n_errors} Elastic Search operations failed, retry later")
+
+        return len(claimed)
+
+    def load_documents(self, claimed):
+        """
+        Build the documents of the "index" operations written without document (ex: rejected by
+        a reindex), returns the outbox documents ready to be sent (the others are retried later)
+        """
+        ready = []
+        for outbox in claimed:
+            if outbox.action != "index" or outbox.document:
+                ready.append(outbox)
+                continue
+
+            try:
+                if self.get_document is None:
+                    raise Exception("No get_document to build the document")
+                document = self.get_document(outbox.study_id)
+            except Exception as e:
+                logger.warning(
+                    f"Failed to build the document of {outbox.study_id}: {e}"
+                )
+                self.retry_later(outbox, str(e))
+                continue
+
+            # Only sent, not saved: built again if it has to be retried
+            # No document: the study is deleted or deprecated, it must not be indexed
+            outbox.action = "index" if document is not None else "delete"
+            outbox.document = document or {}
+            # Already in the current document
+            outbox.updates = []
+            ready.append(outbox)
+
+        return ready
+
+    def index_in_full(self, outbox, error):
+        """Replace the failed partial updates by the full document of the study"""
+        try:
+            document = self.get_document(outbox.study_id)
+        except Exception as e:
+            logger.warning(f"Failed to build the document of {outbox.study_id}: {e}")
+            self.retry_later(outbox, error)
+            return
+
+        # Still the failed version: a newer operation is sent as is
+        # No document: the study is deleted or deprecated, it must not be indexed
+        EsOutbox.objects(id=outbox.id, version=outbox.version).update_one(
+            set__action="index" if document is not None else "delete",
+            set__document=document or {},
+            set__updates=[],
+            inc__version=1,
+            set__next_attempt_at=datetime.now(),
+            set__last_error=error,
+            unset__claimed_until=True,
+        )
+        EsOutbox.objects(id=outbox.id).update_one(unset__claimed_until=True)
+
+    def retry_later(self, outbox, error):
+        backoff = min(
+            self.backoff_seconds * 2 ** outbox.attempts, self.max_backoff_seconds
+        )
+        EsOutbox.objects(id=outbox.id, version=outbox.version).update_one(
+            inc__attempts=1,
+            set__next_attempt_at=datetime.now() + timedelta(seconds=backoff),
+            set__last_error=error,
+            unset__claimed_until=True,
+        )
+        # A newer version is retried right away
+        EsOutbox.objects(id=outbox.id, version__ne=outbox.version).update_one(
+            unset__claimed_until=True
+        )
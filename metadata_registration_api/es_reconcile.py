@@ -0,0 +1,236 @@
+"""
+Compare the Elastic Search index with the studies stored in MongoDB and repair the differences
+
+    python -m metadata_registration_api.es_reconcile [--dry-run] [--metrics metrics.json]
+
+The studies are streamed from MongoDB by batch (only their id, deprecated flag and version), the
+versions of the same studies are fetched from the index with _mget. Each indexed study stores its
+version (Study.summary.last_modified, see es_bulk.get_es_version): only the missing or outdated
+studies are converted and indexed again (also the studies without version, written before the
+summary existed: indexed on each run until they are written again). Deprecated studies still indexed and indexed studies not
+in MongoDB anymore are deleted. Studies with a pending operation in the ES outbox are skipped.
+Uses the same environment variables as the app (MONGODB_*, ES_*).
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from .es_bulk import get_es_config, get_es_version, iter_indexed_ids, mget_versions
+from .es_reindex import STUDY_FIELDS, connect_from_env, get_operations, send_or_enqueue
+from .model import EsOutbox, Study
+from .mongo_utils import get_raw_studies
+from .reference_registry import ReferenceRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class Reconciler:
+    """
+    Reconciliation of the index in two passes:
+        1. MongoDB -> index: missing, outdated and deprecated studies
+        2. index -> MongoDB: orphan studies (deleted from MongoDB)
+    The drift metrics are counted in self.metrics
+    """
+
+    def __init__(
+        self, es_config, prop_id_to_name, es_maps, batch_size=1000, dry_run=False
+    ):
+        self.es_config = es_config
+        self.prop_id_to_name = prop_id_to_name
+        self.es_maps = es_maps
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+
+        self.metrics = {
+            "n_checked": 0,
+            "n_in_sync": 0,
+            "n_pending": 0,
+            "n_missing": 0,
+            "n_outdated": 0,
+            "n_deprecated": 0,
+            "n_orphans": 0,
+            "n_repaired": 0,
+            "n_failed": 0,
+        }
+
+    def run(self):
+        start_time = time.monotonic()
+
+        for raw_studies in self.iter_study_batches():
+            self.reconcile_studies(raw_studies)
+            logger.info(f"{self.metrics['n_checked']} studies checked")
+
+        for study_ids in iter_indexed_ids(self.es_config, self.batch_size):
+            self.reconcile_indexed_ids(study_ids)
+
+        n_drift = sum(
+            self.metrics[k]
+            for k in ["n_missing", "n_outdated", "n_deprecated", "n_orphans"]
+        )
+        self.metrics["n_drift"] = n_drift
+        self.metrics["drift_ratio"] = round(
+            n_drift / max(self.metrics["n_checked"], 1), 6
+        )
+        self.metrics["elapsed"] = round(time.monotonic() - start_time, 3)
+
+        return self.metrics
+
+    def iter_study_batches(self):
+        """Id, deprecated flag and version of all the studies, by batch"""
+        raw_studies = get_raw_studies(
+            Study.objects().order_by("id"),
+            fields=["id", "meta_information.deprecated", "summary.last_modified"],
+        )
+
+        batch = []
+        for raw_study in raw_studies:
+            batch.append(raw_study)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def get_pending_ids(self, study_ids):
+        """Studies with an operation waiting in the ES outbox (will be sent by the app)"""
+        return {
+            outbox["study_id"]
+            for outbox in EsOutbox.objects(study_id__in=study_ids)
+            .only("study_id")
+            .as_pymongo()
+        }
+
+    def reconcile_studies(self, raw_studies):
+        study_ids = [str(s["_id"]) for s in raw_studies]
+        indexed_versions = mget_versions(self.es_config, study_ids)
+        pending_ids = self.get_pending_ids(study_ids)
+
+        to_index = []
+        to_delete = []
+        for raw_study, study_id in zip(raw_studies, study_ids):
+            self.metrics["n_checked"] += 1
+            deprecated = (raw_study.get("meta_information") or {}).get("deprecated")
+            version = get_es_version(
+                (raw_study.get("summary") or {}).get("last_modified")
+            )
+
+            if study_id in pending_ids:
+                self.metrics["n_pending"] += 1
+            elif deprecated:
+                if study_id in indexed_versions:
+                    self.metrics["n_deprecated"] += 1
+                    to_delete.append(study_id)
+                else:
+                    self.metrics["n_in_sync"] += 1
+            elif study_id not in indexed_versions:
+                self.metrics["n_missing"] += 1
+                to_index.append(raw_study["_id"])
+            elif version is None or indexed_versions[study_id] != version:
+                # No version on either side (study written before the summary or document
+                # indexed without version): can't be compared, indexed again
+                self.metrics["n_outdated"] += 1
+                to_index.append(raw_study["_id"])
+            else:
+                self.metrics["n_in_sync"] += 1
+
+        self.repair(to_index, to_delete)
+
+    def reconcile_indexed_ids(self, study_ids):
+        object_ids = []
+        orphan_ids = []
+        for study_id in study_ids:
+            try:
+                object_ids.append(ObjectId(study_id))
+            except InvalidId:
+                orphan_ids.append(study_id)
+
+        existing_ids = {
+            str(s["_id"])
+            for s in Study.objects(id__in=object_ids).only("id").as_pymongo()
+        }
+        pending_ids = self.get_pending_ids(study_ids)
+
+        orphan_ids += [
+            study_id
+            for study_id in study_ids
+            if study_id not in existing_ids
+            and study_id not in pending_ids
+            and study_id not in orphan_ids
+        ]
+        self.metrics["n_orphans"] += len(orphan_ids)
+        self.repair([], orphan_ids)
+
+    def repair(self, object_ids_to_index, ids_to_delete):
+        if self.dry_run:
+            return
+
+        operations = [
+            {"action": "delete", "id": study_id} for study_id in ids_to_delete
+        ]
+        if object_ids_to_index:
+            raw_studies = get_raw_studies(
+                Study.objects(id__in=object_ids_to_index), fields=STUDY_FIELDS
+            )
+            operations += get_operations(
+                raw_studies, self.prop_id_to_name, self.es_maps
+            )
+
+        if operations:
+            n_failed = send_or_enqueue(self.es_config, operations)
+            self.metrics["n_failed"] += n_failed
+            self.metrics["n_repaired"] += len(operations) - n_failed
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compare the Elastic Search index with MongoDB and repair the differences"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Number of studies compared per batch",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only report the drift metrics"
+    )
+    parser.add_argument("--metrics", help="Write the drift metrics in this JSON file")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    es_config = get_es_config()
+    if not es_config["HOST"] or not es_config["INDEX"]:
+        logger.error("ES_HOST and ES_INDEX must be set")
+        return 1
+
+    connect_from_env()
+
+    registry = ReferenceRegistry()
+    reconciler = Reconciler(
+        es_config,
+        registry.get_property_map(key="id", value="name"),
+        registry.get_es_maps(),
+        batch_size=args.batch_size,
+        dry_run=args.dry_run,
+    )
+    metrics = reconciler.run()
+
+    logger.info(f"Drift metrics: {json.dumps(metrics)}")
+    if args.metrics:
+        with open(args.metrics, "w") as metrics_file:
+            json.dump(metrics, metrics_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+"""
+Rebuild the Elastic Search index from the studies stored in MongoDB
+
+    python -m metadata_registration_api.es_reindex [--processes 4] [--concurrency 4]
+
+The non-deprecated studies are streamed from MongoDB (raw pymongo dicts, ordered by _id),
+converted to Elastic Search documents in a pool of processes and sent to Elastic Search with concurrent _bulk
+requests. The _id of the last indexed study is written in a checkpoint file after each batch: an
+interrupted reindex resumes from there (use --restart to ignore the checkpoint).
+Operations rejected by Elastic Search are written in the ES outbox and retried by the app, which
+rebuilds their document from MongoDB.
+Uses the same environment variables as the app (MONGODB_*, ES_*).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from bson import ObjectId
+
+from metadata_registration_lib.api_utils import FormatConverter
+
+from .es_bulk import get_es_config, get_study_document, send_bulk
+from .es_outbox import enqueue_es_operation
+from .model import (
+    ControlledVocabulary,
+    EntityIndex,
+    EsOutbox,
+    Property,
+    SampleIndex,
+    Study,
+)
+from .mongo_pool import connect_mongo, get_pool_config
+from .mongo_utils import get_raw_studies, raw_study_to_json
+from .reference_registry import ReferenceRegistry
+
+logger = logging.getLogger(__name__)
+
+
+# Worker side
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Property map {prop_id: prop_name} and ES maps (ReferenceRegistry.get_es_maps) of the worker process
+_worker_prop_id_to_name = None
+_worker_es_maps = None
+
+
+def _init_worker(prop_id_to_name, es_maps):
+    global _worker_prop_id_to_name, _worker_es_maps
+    _worker_prop_id_to_name = prop_id_to_name
+    _worker_es_maps = es_maps
+
+
+def _get_operations(raw_studies):
+    return get_operations(raw_studies, _worker_prop_id_to_name, _worker_es_maps)
+
+
+# Parent side
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Fields of the raw studies needed to build their document
+STUDY_FIELDS = ["id", "entries", "meta_information", "summary"]
+
+
+def get_operations(raw_studies, prop_id_to_name, es_maps):
+    """Convert a batch of raw studies to "index" operations (study with form format entries)"""
+    operations = []
+    for raw_study in raw_studies:
+        study_json = raw_study_to_json(raw_study)
+        study_converter = FormatConverter(prop_id_to_name)
+        study_converter.add_api_format(study_json["entries"])
+
+        document = get_study_document(
+            study_json,
+            study_converter.get_form_format(),
+            es_maps,
+            (raw_study.get("summary") or {}).get("last_modified"),
+        )
+        operations.append(
+            {"action": "index", "id": study_json["id"], "document": document}
+        )
+
+    return operations
+
+
+def send_or_enqueue(es_config, operations, timeout=60):
+    """
+    Send operations with a _bulk request, the rejected operations are written in the ES outbox
+    (retried by the app, with the current document of the study). Returns the number of rejected
+    operations.
+    """
+    try:
+        errors = send_bulk(es_config, operations, timeout=timeout)
+    except Exception as e:
+        errors = [str(e)] * len(operations)
+
+    n_failed = 0
+    for operation, error in zip(operations, errors):
+        if error is not None:
+            n_failed += 1
+            logger.warning(f"Study {operation['id']} not sent: {error}")
+            # Without document: built from MongoDB when sent, a newer operation written by the
+            # app since the study was read is never replaced by an older document
+            enqueue_es_operation(operation["id"], "index")
+
+    return n_failed
+
+
+def connect_from_env():
+    """Connect to MongoDB and set the collection names, like create_app"""
+    connect_mongo(
+        os.environ["MONGODB_DB"],
+        host=os.environ["MONGODB_HOST"],
+        port=int(os.environ["MONGODB_PORT"]),
+        username=os.environ["MONGODB_USERNAME"],
+        password=os.environ["MONGODB_PASSWORD"],
+        pool_config=get_pool_config(),
+    )
+
+    # noinspection PyProtectedMember
+    Property._meta["collection"] = os.environ["MONGODB_COL_PROPERTY"]
+    # noinspection PyProtectedMember
+    ControlledVocabulary._meta["collection"] = os.environ["MONGODB_COL_CTRL_VOC"]
+    # noinspection PyProtectedMember
+    Study._meta["collection"] = os.environ["MONGODB_COL_STUDY"]
+    # noinspection PyProtectedMember
+    EsOutbox._meta["collection"] = os.environ.get("MONGODB_COL_ES_OUTBOX", "es_outbox")
+    # noinspection PyProtectedMember
+    EntityIndex._meta["collection"] = os.environ.get(
+        "MONGODB_COL_ENTITY_INDEX", "entity_index"
+    )
+    # noinspection PyProtectedMember
+    SampleIndex._meta["collection"] = os.environ.get(
+        "MONGODB_COL_SAMPLE_INDEX", "sample_index"
+    )
+
+
+def read_checkpoint(path):
+    """Returns the _id of the last indexed study (None without checkpoint)"""
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)["last_id"]
+
+
+def write_checkpoint(path, last_id, n_done):
+    # Write then rename: an interrupted write never corrupts the checkpoint
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump({"last_id": last_id, "n_done": n_done}, checkpoint_file)
+    os.replace(tmp_path, path)
+
+
+def iter_raw_study_batches(last_id=None, batch_size=500):
+    """Non-deprecated raw studies by batch of batch_size, ordered by _id (after last_id)"""
+    queryset = Study.objects(meta_information__deprecated__ne=True).order_by("id")
+    if last_id is not None:
+        queryset = queryset.filter(id__gt=ObjectId(last_id))
+
+    batch = []
+    for raw_study in get_raw_studies(queryset, fields=STUDY_FIELDS):
+        batch.append(raw_study)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class Reindexer:
+    """
+    Pipeline: MongoDB cursor -> conversion (process pool) -> _bulk requests (thread pool)
+    About `processes` conversions and `concurrency` _bulk requests are in flight, so the
+    memory used doesn't depend on the number of studies. Batches are completed in order, which
+    keeps the checkpoint consistent (all the studies up to last_id are indexed).
+    """
+
+    def __init__(
+        self,
+        es_config,
+        prop_id_to_name,
+        es_maps,
+        processes=2,
+        concurrency=2,
+        batch_size=500,
+        checkpoint_path=None,
+        timeout=60,
+    ):
+        self.es_config = es_config
+        self.prop_id_to_name = prop_id_to_name
+        self.es_maps = es_maps
+        self.processes = processes
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.timeout = timeout
+
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_total = 0
+        self._start_time = None
+
+    def send(self, operations):
+        return send_or_enqueue(self.es_config, operations, timeout=self.timeout)
+
+    def run(self, last_id=None):
+        self.n_total = Study.objects(meta_information__deprecated__ne=True).count()
+        if last_id is not None:
+            self.n_done = Study.objects(
+                meta_information__deprecated__ne=True, id__lte=ObjectId(last_id)
+            ).count()
+        self._start_time = time.monotonic()
+
+        converting = deque()
+        sending = deque()
+
+        with ProcessPoolExecutor(
+            max_workers=self.processes,
+            initializer=_init_worker,
+            initargs=(self.prop_id_to_name, self.es_maps),
+        ) as converters, ThreadPoolExecutor(max_workers=self.concurrency) as senders:
+            for raw_studies in iter_raw_study_batches(last_id, self.batch_size):
+                batch_last_id = str(raw_studies[-1]["_id"])
+                converting.append(
+                    (batch_last_id, converters.submit(_get_operations, raw_studies))
+                )
+
+                while len(converting) > self.processes:
+                    self._send_next(converting, sending, senders)
+                while len(sending) > self.concurrency:
+                    self._complete_next(sending)
+
+            while converting:
+                self._send_next(converting, sending, senders)
+            while sending:
+                self._complete_next(sending)
+
+        logger.info(
+            f"Reindex done: {self.n_done} studies in {self.get_elapsed():.0f}s, "
+            f"{self.n_failed} written in the ES outbox"
+        )
+
+    def _send_next(self, converting, sending, senders):
+        batch_last_id, future = converting.popleft()
+        operations = future.result()
+        sending.append(
+            (batch_last_id, len(operations), senders.submit(self.send, operations))
+        )
+
+    def _complete_next(self, sending):
+        batch_last_id, n_operations, future = sending.popleft()
+        self.n_failed += future.result()
+        self.n_done += n_operations
+
+        if self.checkpoint_path:
+            write_checkpoint(self.checkpoint_path, batch_last_id, self.n_done)
+        self.log_progress()
+
+    def get_elapsed(self):
+        return time.monotonic() - self._start_time
+
+    def log_progress(self):
+        elapsed = self.get_elapsed()
+        rate = self.n_done / elapsed if elapsed > 0 else 0
+        logger.info(
+            f"{self.n_done}/{self.n_total} studies indexed ({rate:.0f}/s), "
+            f"{self.n_failed} failed"
+        )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the Elastic Search index from the studies stored in MongoDB"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 2,
+        help="Number of processes converting the studies to form format",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=2,
+        help="Number of _bulk requests sent at the same time",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of studies per _bulk request",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default="es_reindex.checkpoint",
+        help="File storing the last indexed study (used to resume)",
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="Ignore the checkpoint and start over"
+    )
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    es_config = get_es_config()
+    if not es_config["HOST"] or not es_config["INDEX"]:
+        logger.error("ES_HOST and ES_INDEX must be set")
+        return 1
+
+    connect_from_env()
+
+    last_id = None if args.restart else read_checkpoint(args.checkpoint)
+    if last_id is not None:
+        logger.info(f"Resume after study {last_id} ({args.checkpoint})")
+
+    registry = ReferenceRegistry()
+    reindexer = Reindexer(
+        es_config,
+        registry.get_property_map(key="id", value="name"),
+        registry.get_es_maps(),
+        processes=args.processes,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+    )
+    reindexer.run(last_id)
+
+    # Done: the next run is a full reindex
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
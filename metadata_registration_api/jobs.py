@@ -0,0 +1,94 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .model import Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Local (in-process) job queue
+    The jobs are stored in MongoDB and processed by a pool of worker threads inside an app context
+    """
+
+    def __init__(self, app, max_workers=2, progress_interval=1):
+        """
+        Args:
+            app: Flask app used to push an app context for each job
+            max_workers (int): Number of jobs processed at the same time
+            progress_interval (float): Minimum number of seconds between two progress updates on the DB
+        """
+        self.app = app
+        self.progress_interval = progress_interval
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+
+    def submit(self, job_type, func, *args, user=None, **kwargs):
+        """
+        Create a job and process it in the background
+        func(*args, progress=callback, **kwargs) is called by a worker and must return a dict (job result)
+        callback(n_done, n_total) can be called by func to report its progress
+        """
+        job = Job(
+            job_type=job_type,
+            user_id=user.id if user else None,
+            created=datetime.now(),
+        )
+        job.save()
+
+        self._executor.submit(self._run, job.id, func, args, kwargs)
+        return job
+
+    def _run(self, job_id, func, args, kwargs):
+        with self.app.app_context():
+            Job.objects(id=job_id).update(
+                set__status="running", set__started=datetime.now()
+            )
+
+            try:
+                result = func(
+                    *args, progress=self.get_progress_callback(job_id), **kwargs
+                )
+            except Exception as error:
+                logger.exception(f"Job {job_id} failed")
+                Job.objects(id=job_id).update(
+                    set__status="failed",
+                    set__error={
+                        "error_type": str(error.__class__.__name__),
+                        "message": str(error),
+                    },
+                    set__finished=datetime.now(),
+                )
+            else:
+                Job.objects(id=job_id).update(
+                    set__status="succeeded",
+                    set__result=result,
+                    set__finished=datetime.now(),
+                )
+
+    def get_progress_callback(self, job_id):
+        """Callback saving the progress of a job, throttled to one DB update per progress_interval"""
+        last_update = None
+
+        def progress(n_done, n_total):
+            nonlocal last_update
+
+            # Let other greenlets run between two steps of a CPU bound job (gevent worker)
+            time.sleep(0)
+
+            now = time.monotonic()
+            if (
+                last_update is not None
+                and n_done < n_total
+                and now - last_update < self.progress_interval
+            ):
+                return
+
+            last_update = now
+            Job.objects(id=job_id).update(set__n_done=n_done, set__n_total=n_total)
+
+        return progress
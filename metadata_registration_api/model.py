@@ -4,6 +4,8 @@ from mongoengine import Document, EmbeddedDocument
 from mongoengine.fields import *
 from mongoengine.errors import ValidationError
 
+from .mongo_pool import ConfiguredQuerySet
+
 
 """
 This module defines document object mapping (DOM) of a set of administrative resources. 
@@ -43,7 +45,11 @@ class TopLevelDocument(Document):
     def clean(self):
         self.name = to_snake_case(self.name)
 
-    meta = {"allow_inheritance": True, "abstract": True}
+    meta = {
+        "allow_inheritance": True,
+        "abstract": True,
+        "queryset_class": ConfiguredQuerySet,
+    }
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -177,6 +183,8 @@ class User(Document):
         if not is_hashed(self.password):
             self.password = generate_password_hash(self.password)
 
+    meta = {"queryset_class": ConfiguredQuerySet}
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 
@@ -198,8 +206,144 @@ class MetaInformation(EmbeddedDocument):
     state = StringField()
     deprecated = BooleanField(default=False)
     change_log = EmbeddedDocumentListField(History)
+    # Key of the state evaluated by the last write without transition (see state_machine.StateMachine)
+    evaluated_state = StringField()
+
+
+class Summary(EmbeddedDocument):
+    """Lightweight study summary, maintained on every study write (no need to load the entries)"""
+
+    n_datasets = IntField()
+    n_pes = IntField()
+    n_samples = IntField()
+    state = StringField()
+    last_modified = DateTimeField()
+    last_editor = StringField()
 
 
 class Study(Document):
     entries = EmbeddedDocumentListField(StudyEntry)
     meta_information = EmbeddedDocumentField(MetaInformation)
+    summary = EmbeddedDocumentField(Summary)
+    # Value of the "study_id" entry (pseudo alternate pk), unique across all studies
+    study_id = StringField()
+
+    meta = {
+        "indexes": [
+            {
+                "fields": ["study_id"],
+                "unique": True,
+                # Studies without study_id (null) are not indexed
+                "partialFilterExpression": {"study_id": {"$type": "string"}},
+            }
+        ],
+        "queryset_class": ConfiguredQuerySet,
+    }
+
+
+class EntityIndex(Document):
+    """
+    Nested entity of a study (ex: dataset, process event, sample), maintained on every study write
+    Only the changed entities are re-indexed (see mongo_utils.update_entity_index)
+    """
+
+    study_id = StringField(required=True)
+    uuid = StringField(required=True)
+    prop = StringField()
+    parent_uuid = StringField()
+    level = IntField()
+    # Ancestors from the level 1 entity to the parent: [{"prop": ..., "uuid": ...}, ...]
+    path = ListField(DictField())
+
+    meta = {"indexes": ["uuid", "study_id"], "queryset_class": ConfiguredQuerySet}
+
+
+class SampleIndex(Document):
+    """
+    Identity key of a sample of a study or of one of its nested entities (see mongo_utils.get_sample_keys)
+    Only the changed samples are re-indexed (see mongo_utils.update_sample_index)
+    """
+
+    study_id = StringField(required=True)
+    key = StringField(required=True)
+    # UUID of the sample
+    uuid = StringField(required=True)
+
+    meta = {
+        "indexes": [("study_id", "key"), ("study_id", "uuid")],
+        "queryset_class": ConfiguredQuerySet,
+    }
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class Job(Document):
+    """Background job (ex: large sample upload) processed outside of the HTTP request"""
+
+    job_type = StringField(required=True)
+    status = StringField(
+        required=True,
+        default="queued",
+        choices=["queued", "running", "succeeded", "failed"],
+    )
+    user_id = ReferenceField(User)
+    # Progress of the job, n_done out of n_total units (ex: samples)
+    n_done = IntField(default=0)
+    n_total = IntField()
+    result = DictField()
+    error = DictField()
+    created = DateTimeField()
+    started = DateTimeField()
+    finished = DateTimeField()
+
+    meta = {"queryset_class": ConfiguredQuerySet}
+
+
+class IdempotencyRecord(Document):
+    """Response of a write request sent with an Idempotency-Key header, replayed on retries"""
+
+    key = StringField(required=True)
+    user_id = ReferenceField(User)
+    # Hash of the method, path, query string and body of the request
+    request_hash = StringField(required=True)
+    status = StringField(
+        required=True, default="processing", choices=["processing", "completed"]
+    )
+    response = DynamicField()
+    status_code = IntField()
+    created = DateTimeField(required=True)
+    # While "processing": the request is taken over by a retry after this time (crashed worker)
+    lease_expires = DateTimeField()
+
+    meta = {
+        "indexes": [
+            {"fields": ["key", "user_id"], "unique": True},
+            # Records are removed by MongoDB after 24 hours
+            {"fields": ["created"], "expireAfterSeconds": 24 * 3600},
+        ],
+        "queryset_class": ConfiguredQuerySet,
+    }
+
+
+class EsOutbox(Document):
+    """
+    Pending Elastic Search operation of a study, written with the study and sent by the outbox flusher
+    One document per study: a new operation replaces the pending one (coalescing)
+    """
+
+    study_id = StringField(required=True, unique=True)
+    action = StringField(required=True, choices=["index", "update", "delete"])
+    # Study in form format (action = "index")
+    document = DictField()
+    # Partial updates (script params) applied after the document (action = "index" or "update")
+    updates = ListField(DictField())
+    # Incremented by every new operation, the flusher only removes the version it has sent
+    version = IntField(default=0)
+    attempts = IntField(default=0)
+    next_attempt_at = DateTimeField()
+    claimed_until = DateTimeField()
+    last_error = StringField()
+    updated = DateTimeField()
+
+    meta = {"indexes": ["next_attempt_at"], "queryset_class": ConfiguredQuerySet}
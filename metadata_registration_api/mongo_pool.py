@@ -0,0 +1,280 @@
+"""
+Single MongoDB connection of a process (app worker, reindex, reconciliation or state jobs)
+
+connect_mongo() registers the MongoClient as the MongoEngine default connection: the documents,
+the raw pymongo helpers (Study._get_collection(), app.mongo_client) and the background jobs all
+use its connection pool. The pool is configured with the MONGODB_* environment variables below
+(pymongo default when not set).
+
+Each gunicorn worker has its own pool: with gevent, up to worker_connections requests wait for at
+most MONGODB_MAX_POOL_SIZE connections, so the server sees up to (workers x max pool size)
+connections. PoolMetrics (/monitoring/mongo_pool) shows the connections in use and the time spent
+waiting for one, to size the pool.
+
+The reads of the GET requests can be sent to the secondaries (MONGODB_READ_PREFERENCES): the read
+preference of the longest matching path prefix is applied to the MongoEngine queries of the
+request. Writes and the reads of the other requests (read-after-write) always use the primary.
+"""
+import os
+import threading
+import time
+
+from flask import g, has_app_context
+from mongoengine import QuerySet, connect
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
+)
+
+# Default maxTimeMS of the queries made through MongoEngine (None: no limit)
+_max_time_ms = None
+
+
+def get_optional_int(env_variable):
+    value = os.environ.get(env_variable)
+    return int(value) if value not in [None, ""] else None
+
+
+def get_pool_config():
+    """Connection pool configuration (app.config["MONGODB_POOL"]) from the environment variables"""
+    return {
+        "MAX_POOL_SIZE": get_optional_int("MONGODB_MAX_POOL_SIZE"),
+        "MIN_POOL_SIZE": get_optional_int("MONGODB_MIN_POOL_SIZE"),
+        # Maximum time (ms) a request waits for a free connection
+        "WAIT_QUEUE_TIMEOUT_MS": get_optional_int("MONGODB_WAIT_QUEUE_TIMEOUT_MS"),
+        "SERVER_SELECTION_TIMEOUT_MS": get_optional_int(
+            "MONGODB_SERVER_SELECTION_TIMEOUT_MS"
+        ),
+        "CONNECT_TIMEOUT_MS": get_optional_int("MONGODB_CONNECT_TIMEOUT_MS"),
+        "SOCKET_TIMEOUT_MS": get_optional_int("MONGODB_SOCKET_TIMEOUT_MS"),
+        # Server side time limit of the MongoEngine queries
+        "MAX_TIME_MS": get_optional_int("MONGODB_MAX_TIME_MS"),
+    }
+
+
+def connect_mongo(
+    db, host, port, username, password, pool_config=None, pool_metrics=None
+):
+    """
+    Connect MongoEngine and return the MongoClient to use for any other access
+    Parameters:
+        - pool_config (dict): see get_pool_config()
+        - pool_metrics (PoolMetrics): listener of the connection pool events
+    """
+    global _max_time_ms
+    pool_config = pool_config or {}
+    _max_time_ms = pool_config.get("MAX_TIME_MS")
+
+    options = {
+        "maxPoolSize": pool_config.get("MAX_POOL_SIZE"),
+        "minPoolSize": pool_config.get("MIN_POOL_SIZE"),
+        "waitQueueTimeoutMS": pool_config.get("WAIT_QUEUE_TIMEOUT_MS"),
+        "serverSelectionTimeoutMS": pool_config.get("SERVER_SELECTION_TIMEOUT_MS"),
+        "connectTimeoutMS": pool_config.get("CONNECT_TIMEOUT_MS"),
+        "socketTimeoutMS": pool_config.get("SOCKET_TIMEOUT_MS"),
+    }
+    options = {k: v for k, v in options.items() if v is not None}
+    if pool_metrics is not None:
+        options["event_listeners"] = [pool_metrics]
+
+    return connect(
+        db, host=host, port=port, username=username, password=password, **options
+    )
+
+
+READ_PREFERENCE_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+# Minimum max staleness accepted by MongoDB (seconds)
+MIN_MAX_STALENESS = 90
+
+
+def get_read_preferences(value):
+    """
+    Read preferences by path prefix, longest prefix first
+    Format: "<path prefix>=<mode>[:<max staleness seconds>];..."
+    ex: "/studies=secondaryPreferred:120;/studies/id=primary;/properties=nearest"
+    """
+    read_preferences = []
+    for item in (value or "").split(";"):
+        if not item.strip():
+            continue
+
+        prefix, _, preference = item.strip().partition("=")
+        mode, _, max_staleness = preference.partition(":")
+        if mode not in READ_PREFERENCE_MODES:
+            raise ValueError(
+                f"Unknown read preference {mode} for {prefix}, "
+                f"expected one of {list(READ_PREFERENCE_MODES)}"
+            )
+
+        if mode == "primary":
+            if max_staleness:
+                raise ValueError(f"No max staleness with the primary mode ({prefix})")
+            read_preference = Primary()
+        else:
+            max_staleness = int(max_staleness) if max_staleness else -1
+            if max_staleness != -1 and max_staleness < MIN_MAX_STALENESS:
+                raise ValueError(
+                    f"The max staleness of {prefix} must be at least {MIN_MAX_STALENESS}s"
+                )
+            read_preference = READ_PREFERENCE_MODES[mode](max_staleness=max_staleness)
+
+        read_preferences.append((prefix.rstrip("/") or "/", read_preference))
+
+    return sorted(read_preferences, key=lambda p: len(p[0]), reverse=True)
+
+
+def get_route_read_preference(read_preferences, path):
+    """Read preference of the longest prefix matching path (None if no prefix matches)"""
+    for prefix, read_preference in read_preferences:
+        if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+            return read_preference
+    return None
+
+
+class ConfiguredQuerySet(QuerySet):
+    """
+    QuerySet applying the connection settings to its cursors and aggregations, unless set on the
+    queryset (or given to aggregate()):
+    - maxTimeMS: MONGODB_MAX_TIME_MS
+    - read preference: the one of the current request (g.read_preference), primary by default
+    """
+
+    @property
+    def _cursor(self):
+        is_new = self._cursor_obj is None
+        if is_new and self._read_preference is None and has_app_context():
+            self._read_preference = g.get("read_preference")
+
+        cursor = super()._cursor
+        if is_new and self._max_time_ms is None and _max_time_ms:
+            cursor.max_time_ms(_max_time_ms)
+        return cursor
+
+    def aggregate(self, pipeline, *suppl_pipeline, **kwargs):
+        queryset = self
+        if self._read_preference is None and has_app_context():
+            read_preference = g.get("read_preference")
+            if read_preference is not None:
+                queryset = self.read_preference(read_preference)
+
+        if "maxTimeMS" not in kwargs:
+            max_time_ms = self._max_time_ms or _max_time_ms
+            if max_time_ms:
+                kwargs["maxTimeMS"] = max_time_ms
+
+        return super(ConfiguredQuerySet, queryset).aggregate(
+            pipeline, *suppl_pipeline, **kwargs
+        )
+
+
+class PoolMetrics(ConnectionPoolListener):
+    """Counters of the connection pool events, by server address"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+        # Start of the pending check out of the current thread (greenlet with gevent)
+        self._local = threading.local()
+
+    def _get_pool(self, address):
+        key = f"{address[0]}:{address[1]}"
+        if key not in self._pools:
+            self._pools[key] = {
+                "n_open": 0,
+                "n_in_use": 0,
+                "max_in_use": 0,
+                "n_created": 0,
+                "n_closed": 0,
+                "n_cleared": 0,
+                "n_checkouts": 0,
+                "n_checkout_failures": {},
+                "wait_ms_total": 0.0,
+                "wait_ms_max": 0.0,
+            }
+        return self._pools[key]
+
+    def _get_wait_ms(self):
+        start = getattr(self._local, "checkout_start", None)
+        self._local.checkout_start = None
+        return (time.monotonic() - start) * 1000 if start is not None else 0.0
+
+    def pool_created(self, event):
+        with self._lock:
+            self._get_pool(event.address)
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._get_pool(event.address)["n_cleared"] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            pool = self._get_pool(event.address)
+            pool["n_created"] += 1
+            pool["n_open"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            pool = self._get_pool(event.address)
+            pool["n_closed"] += 1
+            pool["n_open"] -= 1
+
+    def connection_check_out_started(self, event):
+        self._local.checkout_start = time.monotonic()
+
+    def connection_check_out_failed(self, event):
+        wait_ms = self._get_wait_ms()
+        with self._lock:
+            failures = self._get_pool(event.address)["n_checkout_failures"]
+            failures[event.reason] = failures.get(event.reason, 0) + 1
+            self._add_wait(event.address, wait_ms)
+
+    def connection_checked_out(self, event):
+        wait_ms = self._get_wait_ms()
+        with self._lock:
+            pool = self._get_pool(event.address)
+            pool["n_checkouts"] += 1
+            pool["n_in_use"] += 1
+            pool["max_in_use"] = max(pool["max_in_use"], pool["n_in_use"])
+            self._add_wait(event.address, wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._get_pool(event.address)["n_in_use"] -= 1
+
+    def _add_wait(self, address, wait_ms):
+        pool = self._get_pool(address)
+        pool["wait_ms_total"] += wait_ms
+        pool["wait_ms_max"] = max(pool["wait_ms_max"], wait_ms)
+
+    def get_metrics(self):
+        """Copy of the counters of each pool (this process only)"""
+        with self._lock:
+            pools = {}
+            for address, pool in self._pools.items():
+                pool = dict(pool, n_checkout_failures=dict(pool["n_checkout_failures"]))
+                n_waits = pool["n_checkouts"] + sum(
+                    pool["n_checkout_failures"].values()
+                )
+                pool["wait_ms_avg"] = round(pool["wait_ms_total"] / max(n_waits, 1), 3)
+                pool["wait_ms_total"] = round(pool["wait_ms_total"], 3)
+                pool["wait_ms_max"] = round(pool["wait_ms_max"], 3)
+                pools[address] = pool
+
+        return {"pid": os.getpid(), "pools": pools}
@@ -1,339 +1,347 @@
-from pymongo import MongoClient
+import hashlib
+import json
+import re
 
-from metadata_registration_lib.api_utils import FormatConverter, NestedListEntry
+from .model import EntityIndex, SampleIndex, Study
 
-from .model import Study
 
+################################################
+##### Raw reads
+################################################
+def get_raw_studies(queryset=None, fields=None):
+    """
+    Returns studies as raw pymongo dicts, skipping the construction of
+    MongoEngine documents (and their nested EmbeddedDocument instances)
+    Parameters:
+        - queryset (QuerySet): filtered Study queryset (default: all studies)
+        - fields (list): restrict the loaded fields (MongoEngine field names)
+    """
+    if queryset is None:
+        queryset = Study.objects()
+    if fields:
+        queryset = queryset.only(*fields)
+    return queryset.as_pymongo()
 
-def get_client(app):
-    if app.config["MONGODB_USERNAME"] and app.config["MONGODB_PASSWORD"]:
-        return MongoClient(
-            host=app.config["MONGODB_HOST"],
-            port=app.config["MONGODB_PORT"],
-            username=app.config["MONGODB_USERNAME"],
-            password=app.config["MONGODB_PASSWORD"],
-            authSource=app.config["MONGODB_DB"],
-            authMechanism="SCRAM-SHA-1",
-        )
+
+def get_raw_study(study_id, fields=None):
+    """Returns a single study as a raw pymongo dict (raise DoesNotExist if not found)"""
+    return get_raw_studies(Study.objects(id=study_id), fields=fields).get()
+
+
+def raw_study_to_json(raw_study, properties=None):
+    """
+    Convert a raw study (pymongo dict) to the response shape of the study
+    marshal models, without instantiating any MongoEngine document
+    Parameters:
+        - raw_study (dict): study as returned by get_raw_studies
+        - properties (dict): {prop_id: marshalled property}. If given, the
+        entries properties are expanded (study_model), otherwise they are
+        reduced to their id (study_model_prop_id)
+    """
+    return {
+        "entries": [
+            raw_entry_to_json(entry, properties)
+            for entry in raw_study.get("entries", [])
+        ],
+        "meta_information": raw_meta_information_to_json(
+            raw_study.get("meta_information")
+        ),
+        "id": str(raw_study["_id"]),
+    }
+
+
+def raw_entry_to_json(raw_entry, properties=None):
+    prop_id = raw_entry.get("property")
+    prop_id = str(prop_id) if prop_id is not None else None
+
+    if properties is not None:
+        prop = properties.get(prop_id)
     else:
-        return MongoClient(
-            host=app.config["MONGODB_HOST"],
-            port=app.config["MONGODB_PORT"],
-            authSource=app.config["MONGODB_DB"],
-        )
+        prop = prop_id
 
+    return {"property": prop, "value": raw_entry.get("value")}
 
-def get_states(app, q={}):
-    """Returns states as list of dict directly from MongoDB"""
-    client = get_client(app)
-    db = client[app.config["MONGODB_DB"]]
-    cur = db[app.config["MONGODB_COL_STATE"]]
-    results = cur.find(q)
 
-    return list(results)
+def raw_meta_information_to_json(raw_meta_info):
+    if raw_meta_info is None:
+        return {"state": None, "deprecated": None, "change_log": None}
+
+    change_log = []
+    for log in raw_meta_info.get("change_log", []):
+        timestamp = log.get("timestamp")
+        change_log.append(
+            {
+                "user_id": str(log["user_id"]) if log.get("user_id") else None,
+                "manual_user": log.get("manual_user"),
+                "action": log.get("action"),
+                "timestamp": timestamp.isoformat() if timestamp else None,
+            }
+        )
+
+    return {
+        "state": raw_meta_info.get("state"),
+        "deprecated": raw_meta_info.get("deprecated", False),
+        "change_log": change_log,
+    }
 
 
 ################################################
-##### Agregations
+##### Entity index
 ################################################
-def find_study_id_from_lvl1_uuid(lvl1_prop, lvl1_uuid, prop_name_to_id):
-    """Find parent study id given a lvl1_uuid (ex: dataset_uuid)"""
-    study_id = None
+def get_entity_index(form_format, entity_path=None):
+    """
+    List the nested entities of a study (stored in the EntityIndex collection)
+    A nested entity is a dict with a "uuid" entry, found in the value of a
+    property (ex: "datasets", "process_events"), at any depth.
+    Each entity stores its precomputed ancestor path (without the study), so
+    any entity can be resolved without walking the study tree.
+    entity_path: only list this entity and its descendants (ex: [("datasets", dataset_uuid)]),
+    nothing if the entity doesn't exist (anymore)
+    """
+    entity_index = []
 
-    aggregated_studies = get_aggregated_studies(
-        prop_map=prop_name_to_id, level_1=lvl1_prop
-    )
+    def add_entities(entries, path):
+        for prop_name, value in entries.items():
+            if isinstance(value, dict):
+                entities = [value]
+            elif isinstance(value, list):
+                entities = value
+            else:
+                continue
 
-    for study in aggregated_studies:
-        if lvl1_uuid in study[f"{lvl1_prop}s_uuids"]:
-            return study["id"]
+            entity_prop = get_entity_prop(prop_name, value)
+            for entity in entities:
+                if not isinstance(entity, dict) or not entity.get("uuid"):
+                    continue
+                entity_index.append(
+                    {
+                        "uuid": entity["uuid"],
+                        "prop": entity_prop,
+                        "parent_uuid": path[-1]["uuid"] if path else None,
+                        "level": len(path) + 1,
+                        "path": path,
+                    }
+                )
+                add_entities(
+                    entity, path + [{"prop": entity_prop, "uuid": entity["uuid"]}]
+                )
 
-    return study_id
+    if entity_path is None:
+        add_entities(form_format, [])
+        return entity_index
 
+    # Walk down to the entity, collecting its ancestors
+    entries, path = form_format, []
+    for i, (prop_name, uuid) in enumerate(entity_path):
+        value = entries.get(prop_name)
+        entity = None
+        for candidate in value if isinstance(value, list) else [value]:
+            if isinstance(candidate, dict) and candidate.get("uuid") == uuid:
+                entity = candidate
+                break
 
-def find_study_id_and_lvl1_uuid_from_lvl2_uuid(
-    lvl1_prop, lvl2_prop, lvl2_uuid, prop_name_to_id, prop_id_to_name
-):
-    """Find parent study and lvl1 uuid (ex: Dataset) given a lvl2 uuid (ex: Processing event)"""
-    study_id = None
-    lvl1_uuid = None
+        if entity is None:
+            return []
+
+        if i < len(entity_path) - 1:
+            path = path + [{"prop": get_entity_prop(prop_name, value), "uuid": uuid}]
+            entries = entity
+
+    add_entities({prop_name: [entity] if isinstance(value, list) else entity}, path)
+    return entity_index
 
-    aggregated_studies = get_aggregated_studies(
-        prop_map=prop_name_to_id,
-        level_1=lvl1_prop,
-        level_2=lvl2_prop,
-    )
 
-    for potential_study in aggregated_studies:
-        if lvl2_uuid in potential_study[f"{lvl2_prop}s_uuids"]:
-            study = potential_study
-            study_id = study["id"]
-            break
+def get_entity_prop(prop_name, value):
+    """Property name of the entities of a property (singular, ex: "datasets" -> "dataset")"""
+    if isinstance(value, list):
+        # List property names are plural
+        return re.sub(r"s$", "", prop_name)
+    return prop_name
+
+
+def update_entity_index(study_id, form_format, entity_paths=None):
+    """
+    Update the entity index of a study after a write
+    Only the entities of entity_paths (changed nested entities, ex: [[("datasets", dataset_uuid)]])
+    and their descendants are re-indexed, all the entities of the study if None
+    """
+    study_id = str(study_id)
+
+    if entity_paths is None:
+        EntityIndex.objects(study_id=study_id).delete()
+        entity_index = get_entity_index(form_format)
     else:
-        return study_id, lvl1_uuid
+        uuids = [entity_path[-1][1] for entity_path in entity_paths]
+        EntityIndex.objects(
+            __raw__={
+                "study_id": study_id,
+                "$or": [{"uuid": {"$in": uuids}}, {"path.uuid": {"$in": uuids}}],
+            }
+        ).delete()
 
-    lvl1_list_entry = NestedListEntry(FormatConverter(prop_id_to_name)).add_api_format(
-        study["datasets"]
-    )
+        entity_index = []
+        for entity_path in entity_paths:
+            entity_index.extend(get_entity_index(form_format, entity_path))
 
-    for lvl1_nested_entry in lvl1_list_entry.value:
-        lvl1_uuid = lvl1_nested_entry.get_entry_by_name("uuid").value
-        lvl1_entry = lvl1_nested_entry.get_entry_by_name(f"{lvl2_prop}s")
+    insert_entity_index([{"study_id": study_id, **e} for e in entity_index])
 
-        try:
-            lvl1_entry.value.find_nested_entry("uuid", lvl2_uuid)
-            return study_id, lvl1_uuid
-        except:
-            pass  # Lvl 2 entity not in this lvl 1 entity
 
-    return study_id, lvl1_uuid
+def insert_entity_index(entity_index):
+    """Insert entities (see get_entity_index) with their "study_id" in the entity index"""
+    if len(entity_index) > 0:
+        EntityIndex._get_collection().insert_many(entity_index, ordered=False)
 
 
-def get_aggregated_studies(prop_map, level_1="dataset", level_2=None):
+def find_entities_from_uuids(uuids):
     """
-    Super messy and dirty mongoDB aggregation to save time finding a study
-    from a dataset_uuid.
-    Note to future self: so sorry about that but no worry, Elastic Search will replace that.
-    If level_2 = None, only prop1_uuids will be returned
-    If level_2 = True, only prop1 entities with at least one prop2 entity will be returned
+    Resolve nested entity uuids (of mixed levels) with a single indexed query
+    Returns {uuid: {"study_id", "prop", "parent_uuid", "level", "path"}} for the uuids found
+    The path is the full list of ancestors: [study, level 1 entity, ..., entity]
     """
-    # TODO: This should go away when we index all studies in form format with Elastic Search
-    prop1 = level_1
-    prop1_plur = f"{prop1}s"
-
-    pipeline_lvl1 = [
-        # Keep only prop1 entry
-        {
-            "$addFields": {
-                prop1_plur: {
-                    "$filter": {
-                        "input": "$entries",
-                        "as": "entry",
-                        "cond": {
-                            "$eq": [
-                                {"$toString": "$$entry.property"},
-                                prop_map[prop1_plur],
-                            ]
-                        },
-                    }
-                }
-            }
-        },
-        # Keep studies with at least one prop1
-        {"$match": {f"{prop1_plur}.0": {"$exists": True}}},
-        # Take first (and only) element of filtered entries
-        {"$addFields": {prop1_plur: {"$arrayElemAt": [f"${prop1_plur}", 0]}}},
-        # Get the actual list of lvl1 entities from the lvl1 entities entry value
-        {"$addFields": {prop1_plur: f"${prop1_plur}.value"}},
-        # Prop 1 UUIDs: Keep only prop1_uuid entries (exactly 1)
-        {
-            "$addFields": {
-                f"{prop1_plur}_uuids": {
-                    "$map": {
-                        "input": f"${prop1_plur}",
-                        "as": prop1,
-                        "in": {
-                            "$filter": {
-                                "input": f"$${prop1}",
-                                "as": f"{prop1}_entry",
-                                "cond": {
-                                    "$eq": [
-                                        f"$${prop1}_entry.property",
-                                        prop_map["uuid"],
-                                    ]
-                                },
-                            }
-                        },
-                    }
-                }
-            }
-        },
-        # prop1 UUIDs: Take first (and only) element of filtered entries
-        {
-            "$addFields": {
-                f"{prop1_plur}_uuids": {
-                    "$map": {
-                        "input": f"${prop1_plur}_uuids",
-                        "as": prop1,
-                        "in": {"$arrayElemAt": [f"$${prop1}", 0]},
-                    }
-                }
-            }
-        },
-        # Prop1 UUIDs: make a flat list of UUIDs
-        {
-            "$addFields": {
-                f"{prop1_plur}_uuids": {
-                    "$map": {
-                        "input": f"${prop1_plur}_uuids",
-                        "as": "uuid_entry",
-                        "in": "$$uuid_entry.value",
-                    }
-                }
-            }
-        },
-    ]
-
-    if level_2 == None:
-        pipeline_lvl1_format = [
-            # Clean, project only wanted fields
+    entities = {}
+    for entity in EntityIndex.objects(uuid__in=uuids).as_pymongo():
+        entities.setdefault(
+            entity["uuid"],
             {
-                "$project": {
-                    "id": {"$toString": "$_id"},
-                    f"{prop1_plur}_uuids": 1,
-                    prop1_plur: 1,
-                    "_id": 0,
-                }
+                "study_id": entity["study_id"],
+                "prop": entity.get("prop"),
+                "parent_uuid": entity.get("parent_uuid"),
+                "level": entity.get("level"),
+                "path": [{"prop": "study", "id": entity["study_id"]}]
+                + entity.get("path", [])
+                + [{"prop": entity.get("prop"), "uuid": entity["uuid"]}],
             },
-        ]
-        pipeline = pipeline_lvl1 + pipeline_lvl1_format
-        aggregated_studies = Study.objects().aggregate(pipeline, allowDiskUse=True)
+        )
+
+    return entities
+
+
+def find_entity(uuid, prop, parent_prop=None):
+    """Returns the indexed entity (see find_entities_from_uuids) if it is a 'prop' entity"""
+    entity = find_entities_from_uuids([uuid]).get(uuid)
+
+    if entity is None or entity["prop"] != prop:
+        return None
+
+    parent = entity["path"][-2]
+    if parent_prop is not None and parent["prop"] != parent_prop:
+        return None
+
+    return entity
+
+
+def find_study_id_from_lvl1_uuid(lvl1_prop, lvl1_uuid):
+    """Find parent study id given a lvl1_uuid (ex: dataset_uuid)"""
+    entity = find_entity(lvl1_uuid, prop=lvl1_prop, parent_prop="study")
+    return entity["study_id"] if entity is not None else None
 
-        return aggregated_studies
 
+def find_study_id_and_lvl1_uuid_from_lvl2_uuid(lvl1_prop, lvl2_prop, lvl2_uuid):
+    """Find parent study and lvl1 uuid (ex: Dataset) given a lvl2 uuid (ex: Processing event)"""
+    entity = find_entity(lvl2_uuid, prop=lvl2_prop, parent_prop=lvl1_prop)
+    if entity is None or entity["level"] != 2:
+        return None, None
+
+    return entity["study_id"], entity["parent_uuid"]
+
+
+################################################
+##### Sample index
+################################################
+def get_entity_hash(entity):
+    """Hash of the content of a nested entity, UUIDs excluded (at any depth)"""
+
+    def strip_uuids(value):
+        if isinstance(value, dict):
+            return {k: strip_uuids(v) for k, v in value.items() if k != "uuid"}
+        elif isinstance(value, list):
+            return [strip_uuids(v) for v in value]
+        return value
+
+    content = json.dumps(strip_uuids(entity), sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def get_sample_keys(sample):
+    """
+    Keys identifying a sample (form format) and its nested entities:
+        - "sample_id:<sample_id>"
+        - "<prop>:<content hash>" for each nested entity (ex: individual, treatments)
+        - "<prop>.<x_id>:<value>" for the "*_id" properties of the nested entities
+    Two samples sharing a key can share UUIDs when new samples are unified with existing ones
+    """
+    keys = set()
+    if sample.get("sample_id") is not None:
+        keys.add(f"sample_id:{sample['sample_id']}")
+
+    def add_nested_keys(entries):
+        for prop_name, value in entries.items():
+            for entity in value if isinstance(value, list) else [value]:
+                if not isinstance(entity, dict):
+                    continue
+                keys.add(f"{prop_name}:{get_entity_hash(entity)}")
+                for key, key_value in entity.items():
+                    if key.endswith("_id") and isinstance(key_value, (str, int)):
+                        keys.add(f"{prop_name}.{key}:{key_value}")
+                add_nested_keys(entity)
+
+    add_nested_keys(sample)
+    return keys
+
+
+def get_sample_index(samples):
+    """
+    Index of the samples of a study (stored in the SampleIndex collection)
+    List of {"key": ..., "uuid": sample uuid}, see get_sample_keys()
+    """
+    return [
+        {"key": key, "uuid": sample["uuid"]}
+        for sample in samples
+        if sample.get("uuid")
+        for key in sorted(get_sample_keys(sample))
+    ]
+
+
+def update_sample_index(study_id, samples, entity_paths=None):
+    """
+    Update the sample index of a study after a write
+    Only the samples of entity_paths (ex: [[("samples", sample_uuid)]]) are re-indexed, all the
+    samples of the study if None. The other entity paths (ex: datasets) don't change the index.
+    """
+    study_id = str(study_id)
+
+    if entity_paths is not None:
+        uuids = {path[0][1] for path in entity_paths if path[0][0] == "samples"}
+        if len(uuids) == 0:
+            return
+
+    if entity_paths is None or not has_sample_index(study_id):
+        # Also for the studies written before the sample index existed
+        SampleIndex.objects(study_id=study_id).delete()
+        sample_index = get_sample_index(samples)
     else:
-        prop2 = level_2
-        prop2_plur = f"{prop2}s"
-        pipeline_lvl2 = [
-            # Prop 2 UUIDs: Keep only process_events entries (exactly 1)
-            {
-                "$addFields": {
-                    f"{prop1_plur}_for_{prop2}": {
-                        "$map": {
-                            "input": f"${prop1_plur}",
-                            "as": prop1,
-                            "in": {
-                                "$filter": {
-                                    "input": f"$${prop1}",
-                                    "as": f"{prop1}_entry",
-                                    "cond": {
-                                        "$eq": [
-                                            f"$${prop1}_entry.property",
-                                            prop_map[prop2_plur],
-                                        ]
-                                    },
-                                }
-                            },
-                        }
-                    }
-                }
-            },
-            # Prop 2 UUIDs: Take first (and only) element of filtered prop 1 entries
-            {
-                "$addFields": {
-                    f"{prop1_plur}_for_{prop2}": {
-                        "$map": {
-                            "input": f"${prop1_plur}_for_{prop2}",
-                            "as": prop1,
-                            "in": {"$arrayElemAt": [f"$${prop1}", 0]},
-                        }
-                    }
-                }
-            },
-            # Prop 2 UUIDs: make a flat list of processing events
-            {
-                "$addFields": {
-                    f"{prop1_plur}_for_{prop2}": {
-                        "$map": {
-                            "input": f"${prop1_plur}_for_{prop2}",
-                            "as": prop1,
-                            "in": f"$${prop1}.value",
-                        }
-                    }
-                }
-            },
-            # Prop 2 UUIDs: Keep only uuid entries (exactly 1)
-            {
-                "$addFields": {
-                    f"{prop1_plur}_for_{prop2}": {
-                        "$map": {
-                            "input": f"${prop1_plur}_for_{prop2}",
-                            "as": prop1,
-                            "in": {
-                                "$map": {
-                                    "input": f"$${prop1}",
-                                    "as": prop2,
-                                    "in": {
-                                        "$filter": {
-                                            "input": f"$${prop2}",
-                                            "as": f"{prop2}_entry",
-                                            "cond": {
-                                                "$eq": [
-                                                    f"$${prop2}_entry.property",
-                                                    prop_map["uuid"],
-                                                ]
-                                            },
-                                        }
-                                    },
-                                }
-                            },
-                        }
-                    }
-                }
-            },
-            # Prop 2: Take first (and only) element of filtered entries
-            {
-                "$addFields": {
-                    f"{prop1_plur}_for_{prop2}": {
-                        "$map": {
-                            "input": f"${prop1_plur}_for_{prop2}",
-                            "as": prop1,
-                            "in": {
-                                "$map": {
-                                    "input": f"$${prop1}",
-                                    "as": prop2,
-                                    "in": {"$arrayElemAt": [f"$${prop2}", 0]},
-                                }
-                            },
-                        }
-                    }
-                }
-            },
-            # Prop 2 UUIDs: make a flat list of UUIDs (per prop 1)
-            {
-                "$addFields": {
-                    f"{prop2_plur}_uuids": {
-                        "$map": {
-                            "input": f"${prop1_plur}_for_{prop2}",
-                            "as": prop1,
-                            "in": {
-                                "$map": {
-                                    "input": f"$${prop1}",
-                                    "as": prop2,
-                                    "in": f"$${prop2}.value",
-                                }
-                            },
-                        }
-                    }
-                }
-            },
-            # Prop 2 UUIDs: Flatten the UUID list (no separation per prop 1)
-            # It also removes the None but I have no idea why
-            {"$unwind": f"${prop2_plur}_uuids"},
-            {"$unwind": f"${prop2_plur}_uuids"},
-            {"$unwind": f"${prop1_plur}_uuids"},
-            {"$unwind": f"${prop1_plur}_uuids"},
-            {"$unwind": f"${prop1_plur}"},
-            {
-                "$group": {
-                    "_id": "$_id",
-                    f"{prop2_plur}_uuids": {"$addToSet": f"${prop2_plur}_uuids"},
-                    f"{prop1_plur}_uuids": {"$addToSet": f"${prop1_plur}_uuids"},
-                    prop1_plur: {"$addToSet": f"${prop1_plur}"},
-                }
-            },
-            # Clean, project only wanted fields
-            {
-                "$project": {
-                    "id": {"$toString": "$_id"},
-                    f"{prop1_plur}_uuids": 1,
-                    f"{prop2_plur}_uuids": 1,
-                    f"{prop1_plur}": 1,
-                    "_id": 0,
-                }
-            },
-        ]
-        pipeline = pipeline_lvl1 + pipeline_lvl2
-        aggregated_studies = Study.objects().aggregate(pipeline, allowDiskUse=True)
+        SampleIndex.objects(study_id=study_id, uuid__in=list(uuids)).delete()
+        sample_index = get_sample_index([s for s in samples if s.get("uuid") in uuids])
+
+    insert_sample_index([{"study_id": study_id, **item} for item in sample_index])
+
 
-        return aggregated_studies
+def insert_sample_index(sample_index):
+    """Insert sample keys (see get_sample_index) with their "study_id" in the sample index"""
+    if len(sample_index) > 0:
+        SampleIndex._get_collection().insert_many(sample_index, ordered=False)
+
+
+def has_sample_index(study_id):
+    """False for the studies without samples and the ones written before the sample index existed"""
+    return SampleIndex.objects(study_id=str(study_id)).first() is not None
+
+
+def find_sample_uuids(study_id, keys):
+    """UUIDs of the samples of a study sharing at least one key (see get_sample_keys)"""
+    if len(keys) == 0:
+        return set()
+
+    return set(
+        SampleIndex.objects(study_id=str(study_id), key__in=list(keys)).distinct("uuid")
+    )
@@ -0,0 +1,105 @@
+import threading
+import time
+
+from .model import ControlledVocabulary, Property
+
+
+class ReferenceRegistry:
+    """
+    In-process copy of the properties and controlled vocabularies, read directly from MongoDB
+    Used to build the maps needed by the Elastic Search documents without requests to the API.
+    The copy is reloaded after max_age seconds (changes made by other workers) or after
+    invalidate() (changes made by this worker).
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._properties = []
+        self._cvs = []
+        self._es_maps = None
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _load(self):
+        with self._lock:
+            if self._is_fresh():
+                return
+            self._properties = list(
+                Property.objects.only(
+                    "name", "label", "synonyms", "deprecated", "value_type"
+                ).as_pymongo()
+            )
+            self._cvs = list(
+                ControlledVocabulary.objects.only(
+                    "name", "label", "deprecated", "items"
+                ).as_pymongo()
+            )
+            self._es_maps = None
+            self._loaded_at = time.monotonic()
+
+    def _is_fresh(self):
+        return (
+            self._loaded_at is not None
+            and time.monotonic() - self._loaded_at < self.max_age
+        )
+
+    def get_properties(self):
+        """Raw properties (deprecated properties included)"""
+        if not self._is_fresh():
+            self._load()
+        return self._properties
+
+    def get_cvs(self):
+        """Raw controlled vocabularies (deprecated CVs included)"""
+        if not self._is_fresh():
+            self._load()
+        return self._cvs
+
+    def get_property_map(self, key, value):
+        """
+        Same map as api_utils.get_property_map (ex: key="id", value="name"), deprecated
+        properties included
+        """
+        return {get_field(p, key): get_field(p, value) for p in self.get_properties()}
+
+    def get_cv_items_map(self, key="name", value="label"):
+        """Same map as the /map_items endpoint: {cv_name: {item_key: item_value}}"""
+        return {
+            cv["name"]: {item[key]: item.get(value) for item in cv.get("items", [])}
+            for cv in self.get_cvs()
+            if not cv.get("deprecated", False)
+        }
+
+    def get_prop_name_to_cv_name(self):
+        """{prop_name: cv_name} for the properties with a controlled vocabulary"""
+        cv_id_to_name = {cv["_id"]: cv["name"] for cv in self.get_cvs()}
+
+        prop_name_to_cv_name = {}
+        for prop in self.get_properties():
+            value_type = prop.get("value_type") or {}
+            cv_id = value_type.get("controlled_vocabulary")
+            if value_type.get("data_type") == "ctrl_voc" and cv_id in cv_id_to_name:
+                prop_name_to_cv_name[prop["name"]] = cv_id_to_name[cv_id]
+
+        return prop_name_to_cv_name
+
+    def get_es_maps(self):
+        """
+        Maps used by es_bulk.get_study_document (can be sent to other processes)
+        Built once per load of the registry
+        """
+        if not self._is_fresh() or self._es_maps is None:
+            self._es_maps = {
+                "prop_name_to_cv_name": self.get_prop_name_to_cv_name(),
+                "cv_items_map": self.get_cv_items_map(key="name", value="label"),
+            }
+        return self._es_maps
+
+
+def get_field(raw_document, field):
+    if field == "id":
+        return str(raw_document["_id"])
+    return raw_document.get(field)
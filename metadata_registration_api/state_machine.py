@@ -0,0 +1,239 @@
+"""
+Stateless evaluation of the study states
+
+study_state_machine.context.Context keeps the current state in the instance: a Context shared by
+concurrent requests (greenlets) can have its state changed by another request between
+load_state() and current_state. StateMachine holds only the (precompiled) state definitions,
+the state is passed to each evaluation and the new state is returned.
+
+The expression strategies are compiled into predicates which know the top-level properties they
+read (ex: "len(kwargs.get('datasets', [])) > 0" reads "datasets"): only these values are passed
+to the expression.
+
+A write can skip the evaluation: the key of the state is stored with the study
+(meta_information.evaluated_state) when its strategies were evaluated without transition, and
+the next write skips them if the study is still in this state (same definition) and none of the
+properties they read changed. After a transition the key is not stored: a transition is a single
+hop, the state reached by the write was not evaluated against the entries yet.
+"""
+import ast
+import hashlib
+import json
+import logging
+
+from study_state_machine.errors import (
+    BehaviorNotAllowedException,
+    StateNotFoundException,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def get_read_properties(expression):
+    """
+    Top-level properties read by an expression through kwargs, supported forms:
+    kwargs.get("prop", ...), kwargs["prop"] and "prop" in kwargs
+    Returns None if kwargs is used in any other way (ex: len(kwargs)) or if args is used: the
+    expression may read any property
+    """
+    tree = ast.parse(expression, mode="eval")
+    parents = {
+        child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)
+    }
+
+    props = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Name) or node.id not in ["args", "kwargs"]:
+            continue
+        if node.id == "args":
+            return None
+
+        parent = parents.get(node)
+        grandparent = parents.get(parent)
+        if (
+            isinstance(parent, ast.Attribute)
+            and parent.attr == "get"
+            and isinstance(grandparent, ast.Call)
+            and grandparent.func is parent
+            and grandparent.args
+            and is_str_constant(grandparent.args[0])
+        ):
+            props.add(grandparent.args[0].value)
+        elif isinstance(parent, ast.Subscript) and is_str_constant(parent.slice):
+            props.add(parent.slice.value)
+        elif (
+            isinstance(parent, ast.Compare)
+            and len(parent.ops) == 1
+            and isinstance(parent.ops[0], (ast.In, ast.NotIn))
+            and parent.comparators[0] is node
+            and is_str_constant(parent.left)
+        ):
+            props.add(parent.left.value)
+        else:
+            return None
+
+    return props
+
+
+def is_str_constant(node):
+    return isinstance(node, ast.Constant) and isinstance(node.value, str)
+
+
+class Predicate:
+    """Expression strategy compiled once, evaluated on the properties it reads only"""
+
+    def __init__(self, expression, filename):
+        self.expression = expression
+        self.code = compile(expression, filename, "eval")
+        # None: may read any property
+        self.props = get_read_properties(expression)
+
+    def __call__(self, entries):
+        if self.props is None:
+            kwargs = entries
+        else:
+            kwargs = {p: entries[p] for p in self.props if p in entries}
+
+        # As globals: also visible in the comprehensions of the expression
+        return eval(self.code, {"args": (), "kwargs": kwargs})
+
+
+class CompiledState:
+    """State definition with its "expression" strategies compiled into predicates"""
+
+    def __init__(self, state_dict):
+        self.name = state_dict["name"]
+        self.state_dict = state_dict
+        self.strategies = {}
+        # Properties read by the strategies of each event (None: any property)
+        self.props = {}
+
+        for event in ["create_study", "change_state"]:
+            strategies = [
+                self.compile_strategy(strategy, event)
+                for strategy in state_dict.get(f"strategies_{event}") or []
+            ]
+            self.strategies[event] = strategies
+            self.props[event] = get_strategies_props(strategies)
+
+        # Changes with the definition of the strategies: a stored key of a previous definition
+        # never skips the evaluation
+        definition = json.dumps(
+            state_dict.get("strategies_change_state") or [], sort_keys=True, default=str
+        )
+        self.key = f"{self.name}:{hashlib.sha1(definition.encode()).hexdigest()[:12]}"
+
+    def compile_strategy(self, strategy, event):
+        strategy = dict(strategy)
+        if strategy["name"] == "expression":
+            strategy["predicate"] = Predicate(
+                strategy["value"], f"<{self.name}.strategies_{event}>"
+            )
+        return strategy
+
+    def evaluate(self, event, entries):
+        """
+        Same rules as Context.parse_strategies: the first true expression with a
+        "state_if_true" gives the new state, a "locked" strategy forbids any change
+        Returns the new state name or None
+        """
+        for strategy in self.strategies[event]:
+            if strategy["name"] == "expression":
+                if strategy["predicate"](entries):
+                    if "state_if_true" in strategy:
+                        return strategy["state_if_true"]
+
+            elif strategy["name"] == "locked":
+                message = (
+                    f"Not allowed to change to another state in state {self.name}."
+                )
+                message += f" This is a final state where modifications are not allowed anymore"
+                raise BehaviorNotAllowedException(message)
+
+        return None
+
+    def can_skip(self, evaluated_state, changed_props):
+        """
+        True if the "change_state" strategies can be skipped: this state was the last one evaluated
+        (evaluated_state is its key) and they read none of the changed_props
+        """
+        props = self.props["change_state"]
+        if evaluated_state != self.key or not changed_props or props is None:
+            return False
+        return props.isdisjoint(changed_props)
+
+
+def get_strategies_props(strategies):
+    """Properties read by the strategies, None if any property may be read"""
+    props = set()
+    for strategy in strategies:
+        if strategy["name"] == "expression":
+            if strategy["predicate"].props is None:
+                return None
+            props |= strategy["predicate"].props
+        elif strategy["name"] == "locked":
+            # Never skipped: any change is forbidden
+            return None
+
+    return props
+
+
+class StateMachine:
+    """
+    Immutable set of compiled states, safe to share between concurrent requests
+    Replaces the sequence load_state() / create_study() or change_state() / current_state
+    of study_state_machine.context.Context by a single call returning the new state
+    """
+
+    def __init__(self, available_states):
+        """
+        available_states: state definitions (list of dict), see study_state_machine.context.Context
+        """
+        self._states = {
+            state["name"]: CompiledState(state) for state in available_states
+        }
+
+    @property
+    def state_names(self):
+        return list(self._states.keys())
+
+    def get_state(self, state_name):
+        """
+        Returns the compiled state with the given name
+        :raise StateNotFoundException: If the state is not found
+        """
+        try:
+            return self._states[state_name]
+        except KeyError:
+            error_msg = f"Fail to find state (name: {state_name})"
+            logger.error(error_msg)
+            raise StateNotFoundException(error_msg)
+
+    def create_study(self, state_name, entries):
+        """State of a new study (entries in form format) created in state_name (initial state)"""
+        new_state = self.get_state(state_name).evaluate("create_study", entries)
+        return new_state if new_state is not None else state_name
+
+    def change_state(
+        self, state_name, entries, changed_props=None, evaluated_state=None
+    ):
+        """
+        State of a study in state_name after a change of its entries (form format)
+        changed_props: top-level properties changed by the write (ex: {"samples"}), None if unknown
+        evaluated_state: meta_information.evaluated_state of the study, see get_evaluated_state
+        """
+        state = self.get_state(state_name)
+        if state.can_skip(evaluated_state, changed_props):
+            return state_name
+
+        new_state = state.evaluate("change_state", entries)
+        return new_state if new_state is not None else state_name
+
+    def get_evaluated_state(self, state_name, new_state):
+        """
+        Value of meta_information.evaluated_state after change_state(state_name, ...) returned
+        new_state: the key of the evaluated state if the study stays in it, None after a transition
+        """
+        if new_state != state_name:
+            return None
+        return self.get_state(state_name).key
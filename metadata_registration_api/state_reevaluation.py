@@ -0,0 +1,321 @@
+"""
+Evaluate the state of the existing studies again, after a change of the state definitions
+
+    python -m metadata_registration_api.state_reevaluation [--processes 4] [--dry-run]
+
+The non-deprecated studies are streamed from MongoDB (raw pymongo dicts, ordered by _id), converted
+to form format and evaluated with the compiled state machine (strategies_change_state) in a pool of
+processes. Only the studies whose state changed are written back, with bulk update_one operations
+(the change is logged in the change log of the study). A study whose state was changed meanwhile by
+the app is not overwritten. The updated studies are indexed again if Elastic Search is used (ES_USE).
+Uses the same environment variables as the app (MONGODB_*, ES_*).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from bson import ObjectId
+from mongoengine.connection import get_db
+from pymongo import UpdateOne
+from study_state_machine.errors import BehaviorNotAllowedException
+
+from metadata_registration_lib.api_utils import FormatConverter
+
+from .es_bulk import get_es_config
+from .es_reindex import STUDY_FIELDS, connect_from_env, get_operations, send_or_enqueue
+from .model import Study
+from .mongo_utils import get_raw_studies, raw_study_to_json
+from .reference_registry import ReferenceRegistry
+from .state_machine import StateMachine
+
+logger = logging.getLogger(__name__)
+
+
+# Worker side
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Property map {prop_id: prop_name} and state machine of the worker process
+_worker_prop_id_to_name = None
+_worker_state_machine = None
+
+
+def _init_worker(prop_id_to_name, states):
+    global _worker_prop_id_to_name, _worker_state_machine
+    _worker_prop_id_to_name = prop_id_to_name
+    _worker_state_machine = StateMachine(available_states=states)
+
+
+def _evaluate_batch(raw_studies):
+    studies = []
+    for raw_study in raw_studies:
+        study_converter = FormatConverter(_worker_prop_id_to_name)
+        study_json = raw_study_to_json(raw_study)
+        study_converter.add_api_format(study_json["entries"])
+        studies.append(
+            (
+                study_json["id"],
+                study_json["meta_information"]["state"],
+                study_converter.get_form_format(),
+            )
+        )
+
+    return get_state_changes(studies, _worker_state_machine)
+
+
+# Parent side
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def get_state_changes(studies, state_machine):
+    """
+    Evaluate the state of a batch of studies
+    Parameters:
+        - studies (list): (study_id, state_name, form_format) of each study
+        - state_machine (StateMachine): compiled states
+    Returns {"changes": [(study_id, old_state, new_state)], "n_locked": int, "n_errors": int}
+    """
+    result = {"changes": [], "n_locked": 0, "n_errors": 0}
+    for study_id, state_name, form_format in studies:
+        try:
+            new_state = state_machine.change_state(state_name, form_format)
+        except BehaviorNotAllowedException:
+            # Final state, never changed
+            result["n_locked"] += 1
+            continue
+        except Exception as e:
+            logger.warning(f"State of study {study_id} not evaluated: {e}")
+            result["n_errors"] += 1
+            continue
+
+        if new_state != state_name:
+            result["changes"].append((study_id, state_name, new_state))
+
+    return result
+
+
+def get_state_updates(changes, timestamp):
+    """
+    update_one operations writing the new states
+    The state is only changed if it is still the evaluated one (not changed by the app meanwhile)
+    """
+    log = {"action": "Re-evaluated state", "timestamp": timestamp}
+    return [
+        UpdateOne(
+            {"_id": ObjectId(study_id), "meta_information.state": old_state},
+            {
+                "$set": {
+                    "meta_information.state": new_state,
+                    "summary.state": new_state,
+                    "summary.last_modified": timestamp,
+                },
+                "$push": {"meta_information.change_log": log},
+                # The new state was not evaluated against the entries yet
+                "$unset": {"meta_information.evaluated_state": ""},
+            },
+        )
+        for study_id, old_state, new_state in changes
+    ]
+
+
+def iter_raw_study_batches(batch_size=500):
+    """Non-deprecated raw studies (entries and state) by batch of batch_size, ordered by _id"""
+    queryset = Study.objects(meta_information__deprecated__ne=True).order_by("id")
+
+    batch = []
+    for raw_study in get_raw_studies(
+        queryset, fields=["id", "entries", "meta_information.state"]
+    ):
+        batch.append(raw_study)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class StateReevaluator:
+    """
+    Pipeline: MongoDB cursor -> conversion and evaluation (process pool) -> bulk update_one
+    About `processes` batches are in flight, so the memory used doesn't depend on the number of
+    studies. The counts are kept in self.counts.
+    """
+
+    def __init__(
+        self,
+        prop_id_to_name,
+        states,
+        processes=2,
+        batch_size=500,
+        dry_run=False,
+        es_config=None,
+        es_maps=None,
+    ):
+        """
+        Args:
+            states: state definitions (list of dict)
+            es_config: the updated studies are indexed again if given (with es_maps)
+        """
+        self.prop_id_to_name = prop_id_to_name
+        self.states = states
+        self.processes = processes
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.es_config = es_config
+        self.es_maps = es_maps
+
+        self.counts = {
+            "n_checked": 0,
+            "n_changed": 0,
+            "n_updated": 0,
+            "n_conflicts": 0,
+            "n_locked": 0,
+            "n_errors": 0,
+            "n_es_failed": 0,
+        }
+        self.transitions = {}
+        self.n_total = 0
+        self._start_time = None
+
+    def run(self):
+        self.n_total = Study.objects(meta_information__deprecated__ne=True).count()
+        self._start_time = time.monotonic()
+
+        evaluating = deque()
+        with ProcessPoolExecutor(
+            max_workers=self.processes,
+            initializer=_init_worker,
+            initargs=(self.prop_id_to_name, self.states),
+        ) as evaluators:
+            for raw_studies in iter_raw_study_batches(self.batch_size):
+                evaluating.append(
+                    (len(raw_studies), evaluators.submit(_evaluate_batch, raw_studies))
+                )
+                while len(evaluating) > self.processes:
+                    self._complete_next(evaluating)
+
+            while evaluating:
+                self._complete_next(evaluating)
+
+        self.counts["elapsed"] = round(self.get_elapsed(), 3)
+        logger.info(f"State re-evaluation done: {json.dumps(self.counts)}")
+        for transition, n_studies in sorted(self.transitions.items()):
+            logger.info(f"{transition}: {n_studies} studies")
+
+        return self.counts
+
+    def _complete_next(self, evaluating):
+        n_studies, future = evaluating.popleft()
+        result = future.result()
+
+        self.counts["n_checked"] += n_studies
+        self.counts["n_changed"] += len(result["changes"])
+        self.counts["n_locked"] += result["n_locked"]
+        self.counts["n_errors"] += result["n_errors"]
+        for _, old_state, new_state in result["changes"]:
+            transition = f"{old_state} -> {new_state}"
+            self.transitions[transition] = self.transitions.get(transition, 0) + 1
+
+        if result["changes"] and not self.dry_run:
+            self.write(result["changes"])
+
+        self.log_progress()
+
+    def write(self, changes):
+        bulk_result = Study._get_collection().bulk_write(
+            get_state_updates(changes, datetime.now()), ordered=False
+        )
+        self.counts["n_updated"] += bulk_result.modified_count
+        self.counts["n_conflicts"] += len(changes) - bulk_result.matched_count
+
+        if self.es_config is not None:
+            self.index(changes)
+
+    def index(self, changes):
+        """Send the updated studies to Elastic Search (the failed ones go to the ES outbox)"""
+        raw_studies = get_raw_studies(
+            Study.objects(
+                id__in=[study_id for study_id, _, _ in changes],
+                meta_information__deprecated__ne=True,
+            ),
+            fields=STUDY_FIELDS,
+        )
+        operations = get_operations(raw_studies, self.prop_id_to_name, self.es_maps)
+        if operations:
+            self.counts["n_es_failed"] += send_or_enqueue(self.es_config, operations)
+
+    def get_elapsed(self):
+        return time.monotonic() - self._start_time
+
+    def log_progress(self):
+        elapsed = self.get_elapsed()
+        rate = self.counts["n_checked"] / elapsed if elapsed > 0 else 0
+        logger.info(
+            f"{self.counts['n_checked']}/{self.n_total} studies evaluated ({rate:.0f}/s), "
+            f"{self.counts['n_changed']} changed, {self.counts['n_updated']} updated"
+        )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Evaluate the state of the existing studies again"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 2,
+        help="Number of processes evaluating the studies",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of studies per batch",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only report the state changes"
+    )
+    parser.add_argument("--counts", help="Write the counts in this JSON file")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    connect_from_env()
+    states = list(get_db()[os.environ["MONGODB_COL_STATE"]].find({}))
+    # Fail before starting the workers if a definition is invalid
+    StateMachine(available_states=states)
+
+    registry = ReferenceRegistry()
+    es_config = get_es_config()
+    # Same switch as the app (app.config["ES"]["USE"])
+    if not es_config["USE"]:
+        es_config = None
+
+    reevaluator = StateReevaluator(
+        registry.get_property_map(key="id", value="name"),
+        states,
+        processes=args.processes,
+        batch_size=args.batch_size,
+        dry_run=args.dry_run,
+        es_config=es_config,
+        es_maps=registry.get_es_maps() if es_config else None,
+    )
+    counts = reevaluator.run()
+
+    if args.counts:
+        with open(args.counts, "w") as counts_file:
+            json.dump(counts, counts_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from mongoengine.errors import DoesNotExist
+from pymongo.errors import OperationFailure
+
+from .state_machine import StateMachine
+
+logger = logging.getLogger(__name__)
+
+
+# Immutable view of the states collection at one version, with its compiled state machine
+StateSnapshot = namedtuple(
+    "StateSnapshot", ["version", "states", "by_id", "by_name", "state_machine"]
+)
+
+
+class StateRegistry:
+    """
+    In-memory copy of the states collection, read through the app's pooled MongoClient
+    The version of the collection (dbHash) is checked at most every check_interval seconds and
+    the states are only reloaded when it changed. Each reload builds a new snapshot (states and
+    compiled state machine) which replaces the previous one at once: a request holding a
+    snapshot keeps a consistent set of states, even if a new version is loaded meanwhile.
+    """
+
+    def __init__(self, collection, check_interval=5):
+        """
+        Args:
+            collection (pymongo.collection.Collection): states collection
+            check_interval (float): Minimum number of seconds between two version checks
+        """
+        self.collection = collection
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._last_check = None
+        self._n_loads = 0
+
+    def get_version(self):
+        """Hash of the collection content (None if dbHash is not allowed)"""
+        try:
+            result = self.collection.database.command(
+                "dbHash", collections=[self.collection.name]
+            )
+        except OperationFailure as e:
+            logger.debug(f"dbHash not available on the states collection: {e}")
+            return None
+        return result["collections"].get(self.collection.name, "empty")
+
+    def get_snapshot(self):
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._last_check < self.check_interval:
+            return self._snapshot
+
+        with self._lock:
+            if (
+                self._snapshot is None
+                or time.monotonic() - self._last_check >= self.check_interval
+            ):
+                self.refresh()
+            return self._snapshot
+
+    def refresh(self):
+        """Reload the states if the version of the collection changed"""
+        version = self.get_version()
+        self._last_check = time.monotonic()
+
+        # Without version (no dbHash), always reload
+        if self._snapshot is not None and version is not None:
+            if version == self._snapshot.version:
+                return
+
+        states = list(self.collection.find({}))
+        if self._snapshot is not None and states == self._snapshot.states:
+            return
+
+        try:
+            state_machine = StateMachine(available_states=states)
+        except Exception:
+            # Invalid definitions (ex: expression syntax error): keep the current version
+            if self._snapshot is None:
+                raise
+            logger.exception("Failed to compile the new states, keep the current ones")
+            return
+
+        self._n_loads += 1
+        self._snapshot = StateSnapshot(
+            version=version if version is not None else f"load-{self._n_loads}",
+            states=states,
+            by_id={str(state["_id"]): state for state in states},
+            by_name={state["name"]: state for state in states},
+            state_machine=state_machine,
+        )
+        logger.info(f"Loaded {len(states)} states (version {self._snapshot.version})")
+
+    def get_states(self):
+        return self.get_snapshot().states
+
+    def get_state_machine(self):
+        """State machine compiled from the current version of the states"""
+        return self.get_snapshot().state_machine
+
+    def get_by_id(self, state_id):
+        try:
+            return self.get_snapshot().by_id[str(state_id)]
+        except KeyError:
+            raise DoesNotExist(f"State not found (id: {state_id})")
+
+    def get_by_name(self, name):
+        try:
+            return self.get_snapshot().by_name[name]
+        except KeyError:
+            raise DoesNotExist(f"State not found (name: {name})")
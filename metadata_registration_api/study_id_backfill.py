@@ -0,0 +1,113 @@
+"""
+Copy the "study_id" entry of the studies written before Study.study_id existed
+
+    python -m metadata_registration_api.study_id_backfill [--batch-size 500]
+
+Run once after deploying Study.study_id: the unicity of study_id is enforced by its unique index,
+which ignores the studies without Study.study_id. New and updated studies are always written with it.
+The studies are streamed from MongoDB (raw pymongo dicts) and updated with bulk update_one
+operations. Duplicated study_ids are logged and left unset (to be fixed manually).
+Uses the same environment variables as the app (MONGODB_*).
+"""
+import argparse
+import logging
+import sys
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .es_reindex import connect_from_env
+from .model import Study
+from .mongo_utils import get_raw_studies
+from .reference_registry import ReferenceRegistry
+
+logger = logging.getLogger(__name__)
+
+
+def get_study_id_update(raw_study, study_id_prop_id):
+    """update_one operation setting Study.study_id from the "study_id" entry of a raw study"""
+    study_id = None
+    for entry in raw_study.get("entries", []):
+        if str(entry.get("property")) == study_id_prop_id:
+            study_id = entry.get("value")
+            break
+
+    return UpdateOne(
+        {"_id": raw_study["_id"], "study_id": {"$exists": False}},
+        {"$set": {"study_id": str(study_id) if study_id is not None else None}},
+    )
+
+
+def write_updates(updates, ids):
+    """
+    Write the updates of the studies ids[i]
+    Returns the number of updated studies and the ids of the studies with a duplicated study_id
+    """
+    try:
+        result = Study._get_collection().bulk_write(updates, ordered=False)
+        return result.modified_count, []
+    except BulkWriteError as e:
+        duplicates = [ids[error["index"]] for error in e.details["writeErrors"]]
+        return e.details["nModified"], duplicates
+
+
+def set_missing_study_ids(study_id_prop_id, batch_size=500):
+    """Set Study.study_id of the studies written before it existed"""
+    raw_studies = get_raw_studies(
+        Study.objects(study_id__exists=False), fields=["id", "entries"]
+    )
+
+    n_updated = 0
+    duplicates = []
+    updates, ids = [], []
+    for raw_study in raw_studies:
+        updates.append(get_study_id_update(raw_study, study_id_prop_id))
+        ids.append(str(raw_study["_id"]))
+        if len(updates) == batch_size:
+            n_batch, batch_duplicates = write_updates(updates, ids)
+            n_updated += n_batch
+            duplicates.extend(batch_duplicates)
+            logger.info(f"{n_updated} studies updated")
+            updates, ids = [], []
+
+    if updates:
+        n_batch, batch_duplicates = write_updates(updates, ids)
+        n_updated += n_batch
+        duplicates.extend(batch_duplicates)
+
+    return n_updated, duplicates
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Copy the study_id entry of the studies written before Study.study_id existed"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of studies per bulk write",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    connect_from_env()
+
+    registry = ReferenceRegistry()
+    n_updated, duplicates = set_missing_study_ids(
+        registry.get_property_map(key="name", value="id")["study_id"],
+        batch_size=args.batch_size,
+    )
+    logger.info(f"Study.study_id set for {n_updated} studies")
+
+    for study_id in duplicates:
+        logger.error(f"Duplicated study_id, Study.study_id not set (study {study_id})")
+    return 1 if duplicates else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+from .model import User
+
+
+def load_user(user_id):
+    return User.objects(id=user_id).first()
+
+
+class UserCache:
+    """
+    In-process cache of the verified access tokens and of their users, used by token_required
+    - token -> payload: kept until the token expires (its signature was checked once), at most
+    max_tokens tokens: the least recently used one is removed first
+    - user id -> user: kept max_age seconds or until invalidate(user_id) (changes made by this
+    worker). Changes made by other workers are seen after max_age seconds at most.
+    """
+
+    def __init__(self, secret_key, max_age=60, max_tokens=10000, load_user=load_user):
+        """
+        Args:
+            secret_key: key of the HS256 signature of the tokens
+            max_tokens (int): Maximum number of cached tokens. When it is reached, the expired
+            tokens are removed, then the least recently used ones
+            load_user: load_user(user_id) returns the user (None if not found)
+        """
+        self.secret_key = secret_key
+        self.max_age = max_age
+        self.max_tokens = max_tokens
+        self.load_user = load_user
+
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._payloads = OrderedDict()
+        self._users = {}
+
+    def get_payload(self, token):
+        """
+        Payload of a valid token
+        :raise jwt.InvalidTokenError: If the token is invalid or expired (not cached)
+        """
+        cached = self._payloads.get(token)
+        if cached is not None and cached[1] > time.time():
+            with self._lock:
+                if token in self._payloads:
+                    self._payloads.move_to_end(token)
+            return cached[0]
+
+        payload = jwt.decode(token, self.secret_key, algorithms="HS256")
+        # Valid until it expires (max_age seconds for a token without "exp")
+        expires_at = payload.get("exp", time.time() + self.max_age)
+
+        with self._lock:
+            self._payloads.pop(token, None)
+            if len(self._payloads) >= self.max_tokens:
+                now = time.time()
+                self._payloads = OrderedDict(
+                    (t, p) for t, p in self._payloads.items() if p[1] > now
+                )
+            while len(self._payloads) >= self.max_tokens:
+                self._payloads.popitem(last=False)
+            self._payloads[token] = (payload, expires_at)
+
+        return payload
+
+    def get_user(self, user_id):
+        user_id = str(user_id)
+        cached = self._users.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < self.max_age:
+            return cached[0]
+
+        user = self.load_user(user_id)
+        self._users[user_id] = (user, time.monotonic())
+        return user
+
+    def invalidate(self, user_id=None):
+        """Forget a user (all the users if None), the tokens stay valid"""
+        if user_id is None:
+            self._users = {}
+        else:
+            self._users.pop(str(user_id), None)
@@ -0,0 +1,182 @@
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Flask
+from dynamic_form import JsonFlaskParser
+
+from metadata_registration_lib.sample_utils import validate_sample_against_form
+
+from .errors import RequestBodyException
+
+logger = logging.getLogger(__name__)
+
+
+# Worker side
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Forms built in the worker process, by form template
+_worker_forms = {}
+
+
+def _init_worker():
+    """Push an app context in the worker (FlaskForm reads its config from the current app)"""
+    app = Flask(__name__)
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.app_context().push()
+
+
+def _get_worker_form(form_template):
+    key = json.dumps(form_template, sort_keys=True, default=str)
+    if key not in _worker_forms:
+        _, _worker_forms[key] = JsonFlaskParser().to_form(form_template)
+
+    return _worker_forms[key]
+
+
+def _validate_chunk(start, samples_form_format, validate_dict, form_templates):
+    """
+    Validate a chunk of samples, returns the errors as (sample index, RequestBodyException)
+    The errors are converted here: any exception raised by the validation can't be sent back
+    to the parent (not picklable)
+    """
+    forms = {
+        entity: _get_worker_form(template)
+        for entity, template in form_templates.items()
+    }
+
+    errors = []
+    for i, sample_form_format in enumerate(samples_form_format):
+        try:
+            validate_sample_against_form(sample_form_format, validate_dict, forms)
+        except Exception as e:
+            errors.append((start + i, RequestBodyException(str(e))))
+
+    return errors
+
+
+def _validate_forms_chunk(start, forms_data, form_names, form_templates):
+    """Validate a chunk of entries (form format) against their form, returns the errors as (index, RequestBodyException)"""
+    errors = []
+    for i, (form_data, form_name) in enumerate(zip(forms_data, form_names)):
+        try:
+            form_instance = _get_worker_form(form_templates[form_name])()
+            form_instance.process(data=form_data)
+            form_errors = None if form_instance.validate() else form_instance.errors
+        except Exception as e:
+            form_errors = str(e)
+
+        if form_errors is not None:
+            errors.append(
+                (
+                    start + i,
+                    RequestBodyException(
+                        f"Passed data did not validate with the form {form_name}: {form_errors}"
+                    ),
+                )
+            )
+
+    return errors
+
+
+# Parent side
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ValidationPool:
+    """
+    Pool of processes validating samples against their forms, outside of the (gevent) worker
+    Form classes can't be sent to other processes: the form templates are sent with each chunk
+    and the forms are built once per worker process
+    """
+
+    def __init__(self, data_store, processes=2, min_batch_size=200):
+        """
+        Args:
+            data_store (IDataStore): Data store used to load the form templates
+            processes (int): Number of worker processes
+            min_batch_size (int): Smaller batches are validated in the current process
+        """
+        self.data_store = data_store
+        self.processes = processes
+        self.min_batch_size = min_batch_size
+        self._executor = None
+
+    def _get_executor(self):
+        # Created on first use ("spawn": don't fork the Mongo client and the gevent hub)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+
+        return self._executor
+
+    def get_form_templates(self, form_names):
+        """Form templates {entity: template} from form names {entity: form_name}"""
+        return {
+            entity: self.data_store.load_form_by_name(form_name)
+            for entity, form_name in form_names.items()
+        }
+
+    def validate_samples(self, samples_form_format, validate_dict, form_names):
+        """
+        Validate samples split in chunks across the pool
+        Raises the error of the first sample (in the original order) which did not validate
+        """
+        if len(samples_form_format) == 0:
+            return
+
+        form_templates = self.get_form_templates(form_names)
+        chunk_size = -(-len(samples_form_format) // self.processes)
+
+        futures = [
+            self._get_executor().submit(
+                _validate_chunk,
+                start,
+                samples_form_format[start : start + chunk_size],
+                validate_dict,
+                form_templates,
+            )
+            for start in range(0, len(samples_form_format), chunk_size)
+        ]
+
+        # In a gevent worker, result() waits on a patched lock: the hub keeps serving other requests
+        errors = [error for future in futures for error in future.result()]
+        if errors:
+            logger.info(f"{len(errors)} samples did not validate")
+            _, first_error = min(errors, key=lambda e: e[0])
+            raise first_error
+
+    def validate_forms(self, forms_data, form_names):
+        """
+        Validate entries (form format, ex: whole studies) against their form, split in chunks
+        across the pool
+        Args:
+            forms_data (list): Entries in form format
+            form_names (list): Name of the form of each entries
+        Returns the errors as (index, exception), in the original order
+        """
+        if len(forms_data) == 0:
+            return []
+
+        form_templates = {
+            form_name: self.data_store.load_form_by_name(form_name)
+            for form_name in set(form_names)
+        }
+        chunk_size = -(-len(forms_data) // self.processes)
+
+        futures = [
+            self._get_executor().submit(
+                _validate_forms_chunk,
+                start,
+                forms_data[start : start + chunk_size],
+                form_names[start : start + chunk_size],
+                form_templates,
+            )
+            for start in range(0, len(forms_data), chunk_size)
+        ]
+
+        return [error for future in futures for error in future.result()]
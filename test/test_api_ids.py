@@ -0,0 +1,82 @@
+import requests
+from urllib.parse import urljoin
+
+from metadata_registration_api.model import EntityIndex
+from metadata_registration_api.mongo_utils import update_entity_index
+from test_api_base import BaseTestCase
+
+
+class IdsTestCase(BaseTestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        super(IdsTestCase, cls).setUpClass()
+        cls.resolve_endpoint = urljoin(cls.host, "/ids/resolve")
+
+    def setUp(self) -> None:
+        EntityIndex.objects().delete()
+
+    def test_resolve(self):
+        form_format = {
+            "datasets": [{"uuid": "d1", "process_events": [{"uuid": "p1"}]}],
+        }
+        update_entity_index("study_1", form_format)
+
+        res = requests.post(self.resolve_endpoint, json={"uuids": ["p1", "unknown"]})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [
+                {
+                    "uuid": "p1",
+                    "found": True,
+                    "study_id": "study_1",
+                    "parent_uuid": "d1",
+                    "prop": "process_event",
+                    "level": 2,
+                },
+                {
+                    "uuid": "unknown",
+                    "found": False,
+                    "study_id": None,
+                    "parent_uuid": None,
+                    "prop": None,
+                    "level": None,
+                },
+            ],
+            res.json(),
+        )
+
+    def test_resolve_invalid_body(self):
+        for body in [["p1"], {"uuids": "p1"}, {"uuids": [1, 2]}, {}]:
+            res = requests.post(self.resolve_endpoint, json=body)
+            self.assertEqual(res.status_code, 400, body)
+
+    def test_partial_update_of_the_entity_index(self):
+        form_format = {
+            "datasets": [
+                {"uuid": "d1", "process_events": [{"uuid": "p1"}]},
+                {"uuid": "d2"},
+            ],
+        }
+        update_entity_index("study_1", form_format)
+
+        # The PE p1 is moved from d1 to d2, only d1 and d2 are re-indexed
+        form_format["datasets"] = [
+            {"uuid": "d1"},
+            {"uuid": "d2", "process_events": [{"uuid": "p1"}]},
+        ]
+        update_entity_index(
+            "study_1", form_format, [[("datasets", "d1")], [("datasets", "d2")]]
+        )
+
+        entities = {e.uuid: e for e in EntityIndex.objects(study_id="study_1")}
+        self.assertEqual({"d1", "d2", "p1"}, set(entities))
+        self.assertEqual("d2", entities["p1"].parent_uuid)
+
+        # Deleted entities are removed with their descendants
+        form_format["datasets"] = [{"uuid": "d1"}]
+        update_entity_index("study_1", form_format, [[("datasets", "d2")]])
+
+        self.assertEqual(
+            ["d1"], [e.uuid for e in EntityIndex.objects(study_id="study_1")]
+        )
@@ -1,4 +1,9 @@
+from datetime import datetime, timedelta
+
 import requests
+from flask_restx import marshal
+from mongoengine.errors import NotUniqueError
+from pymongo.errors import BulkWriteError
 from dynamic_form.errors import DataStoreException
 from study_state_machine.errors import StateNotFoundException
 
@@ -6,6 +11,25 @@ from metadata_registration_api.errors import (
     RequestBodyException,
     IdenticalPropertyException,
 )
+from metadata_registration_api.api.api_study import (
+    study_model,
+    study_model_prop_id,
+    raw_studies_to_json,
+    get_write_error_result,
+)
+from metadata_registration_api.model import (
+    Property,
+    Study,
+    IdempotencyRecord,
+    SampleIndex,
+)
+from metadata_registration_api.mongo_utils import (
+    get_raw_studies,
+    get_raw_study,
+    raw_study_to_json,
+    update_sample_index,
+    find_sample_uuids,
+)
 from test_api_base import BaseTestCase
 from scripts import setup
 
@@ -66,6 +90,77 @@ class StudyExceptionTestCase(BaseTestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(res.json()["error_type"], IdenticalPropertyException.__name__)
 
+    def test_post_bulk_exceptions(self):
+        studies = [
+            {"form_name": "unknown", "initial_state": "", "entries": ""},
+            {"form_name": "user_login", "initial_state": "unknown", "entries": ""},
+            {
+                "form_name": "user_login",
+                "initial_state": "RegisteredState",
+                "entries": [{"property": "Test 1"}, {"property": "Test 1"}],
+            },
+        ]
+
+        res = requests.post(self.study_endpoint + "/bulk", json={"studies": studies})
+        self.assertEqual(res.status_code, 207)
+
+        results = res.json()["results"]
+        self.assertEqual([r["index"] for r in results], [0, 1, 2])
+        self.assertTrue(all(r["status"] == 422 for r in results))
+        self.assertEqual(
+            [r["error_type"] for r in results],
+            [
+                DataStoreException.__name__,
+                StateNotFoundException.__name__,
+                IdenticalPropertyException.__name__,
+            ],
+        )
+
+    def test_post_idempotency_key(self):
+        headers = {"Idempotency-Key": "test-bulk-1"}
+        studies = [{"form_name": "unknown", "initial_state": "", "entries": ""}]
+        IdempotencyRecord.objects(key=headers["Idempotency-Key"]).delete()
+
+        res = requests.post(
+            self.study_endpoint + "/bulk", json={"studies": studies}, headers=headers
+        )
+        self.assertEqual(res.status_code, 207)
+
+        # Retry: stored response
+        replay = requests.post(
+            self.study_endpoint + "/bulk", json={"studies": studies}, headers=headers
+        )
+        self.assertEqual(replay.status_code, 207)
+        self.assertEqual(replay.json(), res.json())
+
+        # Still processing (lease valid): conflict
+        IdempotencyRecord.objects(key=headers["Idempotency-Key"]).update(
+            set__status="processing",
+            set__lease_expires=datetime.now() + timedelta(minutes=5),
+        )
+        res = requests.post(
+            self.study_endpoint + "/bulk", json={"studies": studies}, headers=headers
+        )
+        self.assertEqual(res.status_code, 409)
+
+        # Lease expired (crashed worker): processed again by the retry
+        IdempotencyRecord.objects(key=headers["Idempotency-Key"]).update(
+            set__lease_expires=datetime.now() - timedelta(minutes=5)
+        )
+        res = requests.post(
+            self.study_endpoint + "/bulk", json={"studies": studies}, headers=headers
+        )
+        self.assertEqual(res.status_code, 207)
+        record = IdempotencyRecord.objects(key=headers["Idempotency-Key"]).get()
+        self.assertEqual("completed", record.status)
+
+        # Same key, different request
+        res = requests.post(
+            self.study_endpoint + "/bulk", json={"studies": []}, headers=headers
+        )
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.json()["error_type"], RequestBodyException.__name__)
+
 
 # @unittest.skip
 class StudyTestCase(BaseTestCase):
@@ -108,3 +203,145 @@ class StudyTestCase(BaseTestCase):
 
     #     res = requests.delete(study_endpoint)
     #     self.assertEqual(res.status_code, 200, f"Could not delete study with id {self.study_map['ACpilot']}")
+
+
+class StudyUniqueIdTestCase(BaseTestCase):
+    """The unicity of study_id is enforced by the unique index of Study.study_id"""
+
+    def setUp(self) -> None:
+        Study.objects().delete()
+
+    def test_study_id_unique_index(self):
+        Study(study_id="study_1").save()
+        with self.assertRaises(NotUniqueError):
+            Study(study_id="study_1").save()
+
+        # Studies without study_id are not indexed
+        Study().save()
+        Study().save()
+        self.assertEqual(3, Study.objects().count())
+
+    def test_bulk_insert_errors_per_study(self):
+        Study(study_id="study_1").save()
+        documents = [
+            Study(study_id=study_id).to_mongo()
+            for study_id in ["study_1", "study_2", "study_2"]
+        ]
+
+        with self.assertRaises(BulkWriteError) as cm:
+            Study._get_collection().insert_many(documents, ordered=False)
+
+        results = [
+            get_write_error_result(error["index"], error)
+            for error in cm.exception.details["writeErrors"]
+        ]
+        self.assertEqual([0, 2], [r["index"] for r in results])
+        self.assertEqual([409, 409], [r["status"] for r in results])
+        self.assertEqual(
+            [NotUniqueError.__name__] * 2, [r["error_type"] for r in results]
+        )
+        self.assertEqual(3, Study.objects().count())
+
+
+class StudySampleIndexTestCase(BaseTestCase):
+    """Only the changed samples are re-indexed in the SampleIndex collection"""
+
+    def setUp(self) -> None:
+        SampleIndex.objects().delete()
+
+    def test_partial_update_of_the_sample_index(self):
+        samples = [{"uuid": "s1", "sample_id": "S1"}, {"uuid": "s2", "sample_id": "S2"}]
+        update_sample_index("study_1", samples)
+
+        # s1 renamed and s3 added, s2 is not re-indexed
+        samples = [
+            {"uuid": "s1", "sample_id": "S1b"},
+            samples[1],
+            {"uuid": "s3", "sample_id": "S3"},
+        ]
+        update_sample_index(
+            "study_1", samples, [[("samples", "s1")], [("samples", "s3")]]
+        )
+
+        keys = {"sample_id:S1", "sample_id:S1b", "sample_id:S2", "sample_id:S3"}
+        self.assertEqual({"s1", "s2", "s3"}, find_sample_uuids("study_1", keys))
+        self.assertEqual(set(), find_sample_uuids("study_1", {"sample_id:S1"}))
+        self.assertEqual(3, SampleIndex.objects(study_id="study_1").count())
+
+        # Other entities don't change the index, deleted samples are removed
+        update_sample_index("study_1", samples, [[("datasets", "d1")]])
+        update_sample_index("study_1", samples[1:], [[("samples", "s1")]])
+        self.assertEqual(
+            {"s2", "s3"}, set(SampleIndex.objects(study_id="study_1").distinct("uuid"))
+        )
+
+    def test_study_without_sample_index(self):
+        # Written before the sample index existed: all its samples are indexed on the first write
+        samples = [{"uuid": "s1", "sample_id": "S1"}, {"uuid": "s2", "sample_id": "S2"}]
+        update_sample_index("study_1", samples, [[("samples", "s2")]])
+
+        self.assertEqual(
+            {"s1", "s2"}, set(SampleIndex.objects(study_id="study_1").distinct("uuid"))
+        )
+
+
+class StudyRawReadTestCase(BaseTestCase):
+    """The raw pymongo read path must return the same output as marshalling documents"""
+
+    def setUp(self) -> None:
+        Study.objects().delete()
+        self.prop = Property(
+            label="Study ID", name="study_id", level="study", description="Study ID"
+        ).save()
+        self.study = Study(
+            entries=[{"property": self.prop.id, "value": "study_1"}],
+            meta_information={
+                "state": "RegisteredState",
+                "change_log": [
+                    {
+                        "manual_user": "jane.doe",
+                        "action": "Created study",
+                        "timestamp": datetime(2020, 2, 20, 10, 30, 15, 123000),
+                    }
+                ],
+            },
+        ).save()
+
+    def tearDown(self) -> None:
+        self.study.delete()
+        self.prop.delete()
+
+    def test_raw_study_prop_id(self):
+        expected = marshal(Study.objects(id=self.study.id).get(), study_model_prop_id)
+        actual = raw_study_to_json(get_raw_study(self.study.id))
+
+        self.assertEqual(expected, actual)
+
+    def test_raw_study_expanded_properties(self):
+        expected = marshal(list(Study.objects().select_related()), study_model)
+        actual = raw_studies_to_json(get_raw_studies(), expand_properties=True)
+
+        self.assertEqual(expected, actual)
+
+    def test_get_study_endpoint(self):
+        for params in [{}, {"properties_id_only": True}]:
+            res = requests.get(
+                self.study_endpoint + f"/id/{self.study.id}", params=params
+            )
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json()["id"], str(self.study.id))
+            self.assertEqual(res.json()["entries"][0]["value"], "study_1")
+
+        res = requests.get(
+            self.study_endpoint, headers={"X-Fields": "id, meta_information{state}"}
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            res.json(),
+            [
+                {
+                    "id": str(self.study.id),
+                    "meta_information": {"state": "RegisteredState"},
+                }
+            ],
+        )
@@ -1,6 +1,17 @@
+import io
 import unittest
+from datetime import datetime
 
-from metadata_registration_api.api.api_utils import MetaInformation
+from metadata_registration_api.api.api_utils import (
+    CachedFormatConverter,
+    MetaInformation,
+    ChangeLog,
+    get_study_summary,
+    iter_ndjson_records,
+    iter_csv_records,
+    iter_batches,
+)
+from metadata_registration_api.errors import RequestBodyException
 
 
 class TestAPIUtil(unittest.TestCase):
@@ -13,3 +24,99 @@ class TestAPIUtil(unittest.TestCase):
         expected_json = {"state": state, "change_log": []}
 
         self.assertEqual(expected_json, actual_json)
+
+    def test_study_summary(self):
+        log = ChangeLog(
+            action="Updated study",
+            user_id=None,
+            timestamp=datetime(2020, 2, 20),
+            manual_user="jane.doe",
+        )
+        form_format = {
+            "study_id": "study_1",
+            "datasets": [
+                {"uuid": "d1", "process_events": [{"uuid": "p1"}, {"uuid": "p2"}]},
+                {"uuid": "d2"},
+            ],
+            "samples": [{"uuid": "s1"}, {"uuid": "s2"}, {"uuid": "s3"}],
+        }
+
+        summary = get_study_summary(form_format, "DatasetState", log)
+
+        expected_summary = {
+            "n_datasets": 2,
+            "n_pes": 2,
+            "n_samples": 3,
+            "state": "DatasetState",
+            "last_modified": datetime(2020, 2, 20),
+            "last_editor": "jane.doe",
+        }
+        self.assertEqual(expected_summary, summary)
+
+    def test_study_summary_empty(self):
+        log = ChangeLog(action="Created study", user_id=None, timestamp=None)
+
+        summary = get_study_summary({"study_id": "study_1"}, "GenericState", log)
+
+        self.assertEqual(summary["n_datasets"], 0)
+        self.assertEqual(summary["n_pes"], 0)
+        self.assertEqual(summary["n_samples"], 0)
+        self.assertIsNone(summary["last_editor"])
+
+    def test_iter_ndjson_records(self):
+        stream = io.BytesIO(b'{"sample_id": "s1"}\n\n[{"property": "p", "value": 1}]\n')
+
+        records = list(iter_ndjson_records(stream))
+
+        self.assertEqual(
+            [{"sample_id": "s1"}, [{"property": "p", "value": 1}]], records
+        )
+
+        with self.assertRaises(RequestBodyException):
+            list(iter_ndjson_records(io.BytesIO(b'{"sample_id": "s1"}\n{invalid\n')))
+
+    def test_iter_csv_records(self):
+        stream = io.BytesIO(b'sample_id,organism\ns1,human\ns2,\n"s;3","mouse, lab"\n')
+
+        records = list(iter_csv_records(stream))
+
+        self.assertEqual(
+            [
+                {"sample_id": "s1", "organism": "human"},
+                {"sample_id": "s2"},
+                {"sample_id": "s;3", "organism": "mouse, lab"},
+            ],
+            records,
+        )
+
+    def test_iter_csv_records_nested_columns(self):
+        stream = io.BytesIO(b"sample_id,individuals.sex\ns1,female\n")
+
+        with self.assertRaises(RequestBodyException):
+            list(iter_csv_records(stream))
+
+        stream = io.BytesIO(b"sample_id,organism\ns1,human,extra\n")
+
+        with self.assertRaises(RequestBodyException):
+            list(iter_csv_records(stream))
+
+    def test_iter_batches(self):
+        batches = list(iter_batches(iter(range(5)), batch_size=2))
+
+        self.assertEqual([[0, 1], [2, 3], [4]], batches)
+
+    def test_cached_format_converter(self):
+        converter = CachedFormatConverter(mapper={"p1": "study_id", "p2": "title"})
+        converter.add_api_format(
+            [{"property": "p1", "value": "s1"}, {"property": "p2", "value": "t1"}]
+        )
+
+        form_format = converter.get_form_format()
+        self.assertEqual({"study_id": "s1", "title": "t1"}, form_format)
+        self.assertIs(form_format, converter.get_form_format())
+
+        converter.remove_entries(prop_names=["title"])
+        self.assertEqual({"study_id": "s1"}, converter.get_form_format())
+        self.assertEqual(
+            [{"property": "p1", "value": "s1"}], converter.get_api_format()
+        )
@@ -0,0 +1,79 @@
+import unittest
+
+from metadata_registration_api.circuit_breaker import (
+    CircuitBreaker,
+    CircuitOpenException,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def fail():
+    raise ConnectionError("Elastic Search is down")
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            "es", failure_threshold=2, reset_timeout=10, clock=self.clock
+        )
+
+    def open_circuit(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.breaker.call(fail)
+
+    def test_opens_after_consecutive_failures(self):
+        with self.assertRaises(ConnectionError):
+            self.breaker.call(fail)
+        self.assertEqual(self.breaker.state, "closed")
+
+        with self.assertRaises(ConnectionError):
+            self.breaker.call(fail)
+        self.assertEqual(self.breaker.state, "open")
+
+        # Not called while open
+        with self.assertRaises(CircuitOpenException):
+            self.breaker.call(lambda: "ok")
+
+    def test_success_resets_failures(self):
+        with self.assertRaises(ConnectionError):
+            self.breaker.call(fail)
+        self.assertEqual(self.breaker.call(lambda: "ok"), "ok")
+        with self.assertRaises(ConnectionError):
+            self.breaker.call(fail)
+
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_half_open_single_probe(self):
+        self.open_circuit()
+        self.clock.now = 10
+        self.assertEqual(self.breaker.state, "half_open")
+
+        self.assertTrue(self.breaker.allow_request())
+        # A single probe at a time
+        self.assertFalse(self.breaker.allow_request())
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_failed_probe_opens_again(self):
+        self.open_circuit()
+        self.clock.now = 10
+
+        with self.assertRaises(ConnectionError):
+            self.breaker.call(fail)
+
+        self.assertEqual(self.breaker.state, "open")
+        self.clock.now = 15
+        self.assertFalse(self.breaker.allow_request())
+        self.clock.now = 20
+        self.assertTrue(self.breaker.allow_request())
@@ -0,0 +1,413 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+from metadata_registration_lib import es_utils
+
+from metadata_registration_api.es_bulk import get_entity_update, get_study_document
+from metadata_registration_api.es_outbox import (
+    EsOutboxFlusher,
+    enqueue_es_operation,
+    enqueue_es_update,
+)
+from metadata_registration_api.es_reindex import (
+    Reindexer,
+    read_checkpoint,
+    write_checkpoint,
+)
+from metadata_registration_api.es_reconcile import Reconciler
+from metadata_registration_api.model import (
+    ControlledVocabulary,
+    CvItem,
+    EsOutbox,
+    Property,
+    VocabularyType,
+)
+from metadata_registration_api.reference_registry import ReferenceRegistry
+from test_api_base import BaseTestCase
+
+
+class EsStandIn(BaseHTTPRequestHandler):
+    """
+    Minimal Elastic Search _bulk and _mget endpoints, records the _bulk requests
+    Single document requests (es_utils.index_study) are recorded in "documents"
+    """
+
+    requests = []
+    documents = []
+    failing_ids = set()
+    # Indexed studies {study_id: version} (_mget)
+    versions = {}
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        EsStandIn.documents.append(json.loads(body))
+        self.send_json({"result": "created"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        if not self.path.split("?")[0].endswith(("/_bulk", "/_mget")):
+            EsStandIn.documents.append(json.loads(body))
+            return self.send_json({"result": "created"})
+
+        if self.path.split("?")[0].endswith("/_mget"):
+            docs = [
+                {"_id": i, "found": True, "_source": {"version": self.versions[i]}}
+                if i in self.versions
+                else {"_id": i, "found": False}
+                for i in json.loads(body)["ids"]
+            ]
+            return self.send_json({"docs": docs})
+
+        lines = [json.loads(l) for l in body.splitlines() if l]
+        EsStandIn.requests.append(lines)
+
+        items = []
+        i = 0
+        while i < len(lines):
+            [(action, meta)] = lines[i].items()
+            status = 500 if meta["_id"] in self.failing_ids else 200
+            items.append({action: {"_id": meta["_id"], "status": status}})
+            # "index" and "update" lines are followed by the document
+            i += 2 if action in ["index", "update"] else 1
+
+        self.send_json({"errors": False, "items": items})
+
+    def send_json(self, data):
+        response = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class EsOutboxTestCase(BaseTestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        super(EsOutboxTestCase, cls).setUpClass()
+
+        cls.es_server = HTTPServer(("127.0.0.1", 0), EsStandIn)
+        Thread(target=cls.es_server.serve_forever, daemon=True).start()
+
+        es_config = {
+            "HOST": "127.0.0.1",
+            "PORT": cls.es_server.server_address[1],
+            "INDEX": "studies",
+            "SECURE": False,
+            "USERNAME": None,
+            "PASSWORD": None,
+        }
+        cls.flusher = EsOutboxFlusher(es_config, batch_size=10)
+        cls.full_flusher = EsOutboxFlusher(
+            es_config, batch_size=10, get_document=lambda study_id: {"entries": {}}
+        )
+        cls.reindexer = Reindexer(es_config, prop_id_to_name={}, es_maps={})
+        cls.reconciler_config = es_config
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.es_server.shutdown()
+        super(EsOutboxTestCase, cls).tearDownClass()
+
+    def setUp(self) -> None:
+        EsOutbox.objects().delete()
+        EsStandIn.requests = []
+        EsStandIn.documents = []
+        EsStandIn.failing_ids = set()
+        EsStandIn.versions = {}
+
+    def test_flush_coalesces_operations(self):
+        enqueue_es_operation("s1", "index", {"entries": {"title": "v1"}})
+        enqueue_es_operation("s1", "index", {"entries": {"title": "v2"}})
+        enqueue_es_operation("s2", "delete")
+
+        self.assertEqual(EsOutbox.objects().count(), 2)
+        self.assertEqual(self.flusher.flush_once(), 2)
+
+        [lines] = EsStandIn.requests
+        self.assertEqual(
+            [
+                {"index": {"_index": "studies", "_id": "s1"}},
+                {"entries": {"title": "v2"}},
+                {"delete": {"_index": "studies", "_id": "s2"}},
+            ],
+            lines,
+        )
+        self.assertEqual(EsOutbox.objects().count(), 0)
+
+    def test_flush_retries_failed_operations(self):
+        EsStandIn.failing_ids = {"s1"}
+        enqueue_es_operation("s1", "index", {"entries": {}})
+
+        self.assertEqual(self.flusher.flush_once(), 1)
+
+        outbox = EsOutbox.objects(study_id="s1").get()
+        self.assertEqual(outbox.attempts, 1)
+        self.assertGreater(outbox.next_attempt_at, datetime.now())
+        self.assertIsNone(outbox.claimed_until)
+
+        # Not due yet
+        self.assertEqual(self.flusher.flush_once(), 0)
+
+    def test_flush_sends_updates_after_document(self):
+        enqueue_es_operation("s1", "index", {"entries": {}})
+        enqueue_es_update("s1", {"changes": [], "meta_information": {}})
+
+        self.assertEqual(self.flusher.flush_once(), 1)
+
+        [lines] = EsStandIn.requests
+        self.assertEqual(
+            [{"index": {"_index": "studies", "_id": "s1"}}, {"entries": {}}],
+            lines[:2],
+        )
+        self.assertEqual({"update": {"_index": "studies", "_id": "s1"}}, lines[2])
+        self.assertEqual(
+            {"changes": [], "meta_information": {}}, lines[3]["script"]["params"]
+        )
+        self.assertEqual(EsOutbox.objects().count(), 0)
+
+    def test_flush_indexes_in_full_failed_updates(self):
+        EsStandIn.failing_ids = {"s1"}
+        enqueue_es_update("s1", {"changes": [], "meta_information": {}})
+
+        self.assertEqual(self.full_flusher.flush_once(), 1)
+
+        outbox = EsOutbox.objects(study_id="s1").get()
+        self.assertEqual(outbox.action, "index")
+        self.assertEqual(outbox.document, {"entries": {}})
+        self.assertEqual(outbox.updates, [])
+
+    def test_flush_deletes_failed_updates_of_deprecated_studies(self):
+        EsStandIn.failing_ids = {"s1"}
+        enqueue_es_update("s1", {"changes": [], "meta_information": {}})
+        flusher = EsOutboxFlusher(
+            self.reconciler_config, batch_size=10, get_document=lambda study_id: None
+        )
+
+        self.assertEqual(flusher.flush_once(), 1)
+
+        outbox = EsOutbox.objects(study_id="s1").get()
+        self.assertEqual(outbox.action, "delete")
+        self.assertEqual(outbox.updates, [])
+
+    def test_reindex_send_writes_failures_in_outbox(self):
+        EsStandIn.failing_ids = {"s2"}
+        operations = [
+            {"action": "index", "id": "s1", "document": {"entries": {}}},
+            {"action": "index", "id": "s2", "document": {"entries": {"title": "t"}}},
+        ]
+
+        self.assertEqual(self.reindexer.send(operations), 1)
+
+        # Without document: built from MongoDB when sent
+        [outbox] = EsOutbox.objects()
+        self.assertEqual(outbox.study_id, "s2")
+        self.assertEqual(outbox.action, "index")
+        self.assertEqual(outbox.document, {})
+
+    def test_reindex_failure_does_not_send_an_older_document(self):
+        # Operation written by the app after the reindex read the study
+        enqueue_es_operation("s1", "index", {"entries": {"title": "new"}})
+
+        EsStandIn.failing_ids = {"s1"}
+        operations = [
+            {"action": "index", "id": "s1", "document": {"entries": {"title": "old"}}}
+        ]
+        self.assertEqual(self.reindexer.send(operations), 1)
+
+        EsStandIn.failing_ids = set()
+        EsStandIn.requests = []
+        flusher = EsOutboxFlusher(
+            self.reconciler_config,
+            batch_size=10,
+            get_document=lambda study_id: {"entries": {"title": "current"}},
+        )
+        self.assertEqual(flusher.flush_once(), 1)
+
+        [lines] = EsStandIn.requests
+        self.assertEqual(
+            [
+                {"index": {"_index": "studies", "_id": "s1"}},
+                {"entries": {"title": "current"}},
+            ],
+            lines,
+        )
+        self.assertEqual(EsOutbox.objects().count(), 0)
+
+    def test_flush_builds_missing_documents(self):
+        enqueue_es_operation("s1", "index")
+        enqueue_es_operation("s2", "index")
+        flusher = EsOutboxFlusher(
+            self.reconciler_config,
+            batch_size=10,
+            get_document=lambda study_id: None if study_id == "s2" else {"entries": {}},
+        )
+
+        self.assertEqual(flusher.flush_once(), 2)
+
+        # No document: deleted or deprecated study
+        [lines] = EsStandIn.requests
+        self.assertIn({"delete": {"_index": "studies", "_id": "s2"}}, lines)
+        self.assertIn({"index": {"_index": "studies", "_id": "s1"}}, lines)
+
+        # Without get_document: retried later
+        enqueue_es_operation("s3", "index")
+        self.assertEqual(self.flusher.flush_once(), 0)
+        self.assertEqual(EsOutbox.objects(study_id="s3").get().attempts, 1)
+
+    def test_reconcile_drift_metrics(self):
+        now = datetime(2021, 1, 1, 12, 0, 0, 123000)
+        raw_studies = [
+            {"_id": "s1", "summary": {"last_modified": now}},
+            {"_id": "s2", "summary": {"last_modified": now}},
+            {"_id": "s3"},
+            {"_id": "s4", "meta_information": {"deprecated": True}},
+            {"_id": "s5"},
+        ]
+        EsStandIn.versions = {
+            "s1": "2021-01-01T12:00:00.123",
+            "s2": "2020-12-31T12:00:00.000",
+            "s4": None,
+        }
+        enqueue_es_operation("s5", "delete")
+
+        reconciler = Reconciler(
+            self.reconciler_config, prop_id_to_name={}, es_maps={}, dry_run=True
+        )
+        reconciler.reconcile_studies(raw_studies)
+
+        metrics = reconciler.metrics
+        self.assertEqual(metrics["n_checked"], 5)
+        self.assertEqual(metrics["n_in_sync"], 1)
+        self.assertEqual(metrics["n_outdated"], 1)
+        self.assertEqual(metrics["n_missing"], 1)
+        self.assertEqual(metrics["n_deprecated"], 1)
+        self.assertEqual(metrics["n_pending"], 1)
+        self.assertEqual(EsStandIn.requests, [])
+
+    def test_reconcile_studies_without_version(self):
+        now = datetime(2021, 1, 1, 12, 0, 0, 123000)
+        raw_studies = [
+            # Written before the summary existed
+            {"_id": "s1"},
+            # Indexed before the version was sent
+            {"_id": "s2", "summary": {"last_modified": now}},
+        ]
+        EsStandIn.versions = {"s1": None, "s2": None}
+
+        reconciler = Reconciler(
+            self.reconciler_config, prop_id_to_name={}, es_maps={}, dry_run=True
+        )
+        reconciler.reconcile_studies(raw_studies)
+
+        self.assertEqual(reconciler.metrics["n_outdated"], 2)
+        self.assertEqual(reconciler.metrics["n_in_sync"], 0)
+
+    def test_study_document_same_as_library(self):
+        """The document built from the in-memory maps is the one es_utils.index_study sends"""
+        ControlledVocabulary.objects(name="test_es_tissues").delete()
+        Property.objects(name="test_es_tissue").delete()
+        cv = ControlledVocabulary(
+            name="test_es_tissues",
+            label="Tissues",
+            description="Tissues",
+            items=[CvItem(name="liver", label="Liver")],
+        ).save()
+        Property(
+            name="test_es_tissue",
+            label="Tissue",
+            level="1",
+            description="Tissue",
+            value_type=VocabularyType(data_type="ctrl_voc", controlled_vocabulary=cv),
+        ).save()
+
+        study_json = {
+            "id": "s1",
+            "meta_information": {"state": "BeingEdited", "deprecated": False},
+        }
+        form_format = {
+            "test_es_tissue": "liver",
+            "datasets": [{"uuid": "d1", "test_es_tissue": "liver"}],
+        }
+        es_utils.index_study(
+            es_index_url=f"http://127.0.0.1:{self.es_server.server_address[1]}/studies",
+            es_auth=None,
+            study_data=dict(study_json, entries=form_format),
+            action="add",
+            endpoints={
+                "cv": self.ctrl_voc_endpoint,
+                "prop": self.property_endpoint,
+            },
+        )
+
+        document = get_study_document(
+            study_json, form_format, ReferenceRegistry().get_es_maps()
+        )
+        del document["version"]
+        self.assertEqual([document], EsStandIn.documents)
+
+    def test_reindex_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "es_reindex.checkpoint")
+            self.assertIsNone(read_checkpoint(path))
+
+            write_checkpoint(path, "5f1f0f0f0f0f0f0f0f0f0f0f", 500)
+            self.assertEqual(read_checkpoint(path), "5f1f0f0f0f0f0f0f0f0f0f0f")
+
+
+class EsDocumentTestCase(unittest.TestCase):
+    def test_get_entity_update(self):
+        document = {
+            "meta_information": {"state": "BeingEdited"},
+            "version": "2021-01-01T12:00:00.000",
+            "entries": {
+                "datasets": [
+                    {
+                        "uuid": "d1",
+                        "process_events": [{"uuid": "pe1", "tissue": "Liver"}],
+                    }
+                ],
+            },
+        }
+        update = get_entity_update(
+            document,
+            [
+                [("datasets", "d1"), ("process_events", "pe1")],
+                [("datasets", "d1"), ("process_events", "deleted")],
+            ],
+        )
+
+        self.assertEqual(
+            [
+                {
+                    "path": [{"prop": "datasets", "uuid": "d1"}],
+                    "prop": "process_events",
+                    "uuid": "pe1",
+                    "entity": {"uuid": "pe1", "tissue": "Liver"},
+                },
+                {
+                    "path": [{"prop": "datasets", "uuid": "d1"}],
+                    "prop": "process_events",
+                    "uuid": "deleted",
+                    "entity": None,
+                },
+            ],
+            update["changes"],
+        )
+        self.assertEqual({"state": "BeingEdited"}, update["meta_information"])
+        self.assertEqual("2021-01-01T12:00:00.000", update["version"])
+
+        # Unknown parent: the whole study must be indexed
+        self.assertIsNone(
+            get_entity_update(
+                document, [[("datasets", "d2"), ("process_events", "pe1")]]
+            )
+        )
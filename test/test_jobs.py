@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+import time
+from urllib.parse import urljoin
+
+import jwt
+import requests
+
+from metadata_registration_api.jobs import JobQueue
+from metadata_registration_api.model import Job, User
+from test_api_base import BaseTestCase
+
+
+def wait_for_job(job_id, timeout=5):
+    start = time.time()
+    while time.time() - start < timeout:
+        job = Job.objects(id=job_id).get()
+        if job.status in ["succeeded", "failed"]:
+            return job
+        time.sleep(0.05)
+
+    raise TimeoutError(f"Job {job_id} not finished after {timeout} seconds")
+
+
+def count_to(n, progress=None):
+    for i in range(n):
+        progress(i + 1, n)
+    return {"count": n}
+
+
+def fail(progress=None):
+    raise ValueError("Invalid upload")
+
+
+class JobQueueTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        Job.objects().delete()
+        self.job_queue = JobQueue(app=self.app, max_workers=1, progress_interval=0)
+
+    def test_job_succeeded(self):
+        job = self.job_queue.submit("count", count_to, 3)
+        job = wait_for_job(job.id)
+
+        self.assertEqual(job.status, "succeeded")
+        self.assertEqual(job.result, {"count": 3})
+        self.assertEqual((job.n_done, job.n_total), (3, 3))
+        self.assertIsNotNone(job.finished)
+
+    def test_job_failed(self):
+        job = self.job_queue.submit("fail", fail)
+        job = wait_for_job(job.id)
+
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(
+            job.error, {"error_type": "ValueError", "message": "Invalid upload"}
+        )
+
+
+class JobVisibilityTestCase(BaseTestCase):
+    """A job is only served to the user who started it"""
+
+    def setUp(self) -> None:
+        self.app.config["CHECK_ACCESS_TOKEN"] = True
+        self.owner = User(
+            firstname="Jane", lastname="Doe", email="jane@example.com", password="a"
+        ).save()
+        self.other = User(
+            firstname="John", lastname="Doe", email="john@example.com", password="b"
+        ).save()
+        self.job = Job(
+            job_type="count",
+            status="succeeded",
+            user_id=self.owner,
+            result={"count": 3},
+            created=datetime.now(),
+        ).save()
+
+    def tearDown(self) -> None:
+        self.app.config["CHECK_ACCESS_TOKEN"] = False
+        self.job.delete()
+        self.owner.delete()
+        self.other.delete()
+
+    def get_headers(self, user):
+        token = jwt.encode(
+            {
+                "user_id": str(user.id),
+                "exp": datetime.utcnow() + timedelta(minutes=5),
+            },
+            self.app.secret_key,
+            algorithm="HS256",
+        )
+        return {"X-Access-Token": token}
+
+    def test_job_of_another_user_not_found(self):
+        for path in [f"/jobs/id/{self.job.id}", f"/jobs/id/{self.job.id}/result"]:
+            res = requests.get(
+                urljoin(self.host, path), headers=self.get_headers(self.owner)
+            )
+            self.assertEqual(res.status_code, 200, path)
+
+            res = requests.get(
+                urljoin(self.host, path), headers=self.get_headers(self.other)
+            )
+            self.assertEqual(res.status_code, 404, path)
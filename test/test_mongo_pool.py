@@ -0,0 +1,140 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from flask import Flask, g
+from pymongo import MongoClient
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from metadata_registration_api.model import Study
+from metadata_registration_api.mongo_pool import (
+    ConfiguredQuerySet,
+    PoolMetrics,
+    get_pool_config,
+    get_read_preferences,
+    get_route_read_preference,
+)
+
+address = ("localhost", 27017)
+
+
+def event(**kwargs):
+    return SimpleNamespace(address=address, **kwargs)
+
+
+class MongoPoolTestCase(unittest.TestCase):
+    def test_pool_config(self):
+        environ = {
+            "MONGODB_MAX_POOL_SIZE": "1000",
+            "MONGODB_WAIT_QUEUE_TIMEOUT_MS": "2000",
+            "MONGODB_MAX_TIME_MS": "",
+        }
+        with mock.patch.dict(os.environ, environ):
+            config = get_pool_config()
+
+        self.assertEqual(1000, config["MAX_POOL_SIZE"])
+        self.assertEqual(2000, config["WAIT_QUEUE_TIMEOUT_MS"])
+        # Not set: pymongo default
+        self.assertIsNone(config["MAX_TIME_MS"])
+
+    def test_pool_metrics(self):
+        metrics = PoolMetrics()
+        metrics.pool_created(event())
+        for _ in range(2):
+            metrics.connection_created(event(connection_id=1))
+            metrics.connection_check_out_started(event())
+            metrics.connection_checked_out(event(connection_id=1))
+        metrics.connection_checked_in(event(connection_id=1))
+        metrics.connection_check_out_started(event())
+        metrics.connection_check_out_failed(event(reason="timeout"))
+
+        pool = metrics.get_metrics()["pools"]["localhost:27017"]
+        self.assertEqual(2, pool["n_open"])
+        self.assertEqual(1, pool["n_in_use"])
+        self.assertEqual(2, pool["max_in_use"])
+        self.assertEqual(2, pool["n_checkouts"])
+        self.assertEqual({"timeout": 1}, pool["n_checkout_failures"])
+        self.assertGreaterEqual(pool["wait_ms_max"], pool["wait_ms_avg"])
+
+    def test_read_preferences(self):
+        read_preferences = get_read_preferences(
+            "/studies=secondaryPreferred:120; /studies/id=primary;/properties=nearest"
+        )
+
+        def get_mode(path):
+            read_preference = get_route_read_preference(read_preferences, path)
+            return read_preference.mongos_mode if read_preference else None
+
+        self.assertEqual("secondaryPreferred", get_mode("/studies"))
+        self.assertEqual("secondaryPreferred", get_mode("/studies/export"))
+        self.assertEqual("primary", get_mode("/studies/id/123"))
+        self.assertEqual("nearest", get_mode("/properties/id/1"))
+        self.assertIsNone(get_mode("/studies_old"))
+        self.assertIsNone(get_mode("/forms"))
+        self.assertEqual(
+            120,
+            get_route_read_preference(read_preferences, "/studies").max_staleness,
+        )
+
+        with self.assertRaises(ValueError):
+            get_read_preferences("/studies=secondaryPreferred:10")
+        with self.assertRaises(ValueError):
+            get_read_preferences("/studies=secondaries")
+
+    def test_queryset_read_preference(self):
+        # Replica set stand-in: the cursors are created without connecting
+        client = MongoClient("localhost", replicaset="rs0", connect=False)
+        collection = client["test"]["study"]
+
+        with Flask(__name__).app_context():
+            queryset = ConfiguredQuerySet(Study, collection)
+            self.assertEqual(Primary(), queryset._cursor.collection.read_preference)
+
+            g.read_preference = SecondaryPreferred(max_staleness=120)
+            queryset = ConfiguredQuerySet(Study, collection)
+            self.assertEqual(
+                SecondaryPreferred(max_staleness=120),
+                queryset._cursor.collection.read_preference,
+            )
+
+            # Set on the queryset: kept
+            queryset = ConfiguredQuerySet(Study, collection).read_preference(Primary())
+            self.assertEqual(Primary(), queryset._cursor.collection.read_preference)
+
+        client.close()
+
+    def test_queryset_aggregate(self):
+        client = MongoClient("localhost", replicaset="rs0", connect=False)
+        collection = client["test"]["study"]
+        pipeline = [{"$project": {"_id": 1}}]
+
+        with mock.patch(
+            "pymongo.collection.Collection.aggregate", autospec=True
+        ) as aggregate, mock.patch(
+            "metadata_registration_api.mongo_pool._max_time_ms", 500
+        ):
+            with Flask(__name__).app_context():
+                g.read_preference = SecondaryPreferred(max_staleness=120)
+                ConfiguredQuerySet(Study, collection).aggregate(pipeline)
+
+                used_collection, used_pipeline = aggregate.call_args[0]
+                self.assertEqual(
+                    SecondaryPreferred(max_staleness=120),
+                    used_collection.read_preference,
+                )
+                self.assertEqual(pipeline, used_pipeline)
+                self.assertEqual(500, aggregate.call_args[1]["maxTimeMS"])
+
+                # Set on the queryset or given to aggregate(): kept
+                ConfiguredQuerySet(Study, collection).read_preference(
+                    Primary()
+                ).aggregate(pipeline, maxTimeMS=100)
+                self.assertEqual(Primary(), aggregate.call_args[0][0].read_preference)
+                self.assertEqual(100, aggregate.call_args[1]["maxTimeMS"])
+
+            # Outside of a request: primary
+            ConfiguredQuerySet(Study, collection).aggregate(pipeline)
+            self.assertEqual(Primary(), aggregate.call_args[0][0].read_preference)
+
+        client.close()
@@ -0,0 +1,127 @@
+import unittest
+
+from metadata_registration_api.mongo_utils import (
+    get_entity_index,
+    get_sample_keys,
+    get_sample_index,
+)
+
+
+class TestEntityIndex(unittest.TestCase):
+    def test_entity_index_levels(self):
+        form_format = {
+            "study_id": "study_1",
+            "datasets": [
+                {"uuid": "d1", "process_events": [{"uuid": "p1"}, {"uuid": "p2"}]},
+                {"uuid": "d2"},
+            ],
+            "samples": [{"uuid": "s1", "individual": {"uuid": "i1"}}],
+        }
+
+        entity_index = get_entity_index(form_format)
+
+        self.assertEqual(
+            ["d1", "p1", "p2", "d2", "s1", "i1"], [e["uuid"] for e in entity_index]
+        )
+        self.assertEqual(
+            [
+                "dataset",
+                "process_event",
+                "process_event",
+                "dataset",
+                "sample",
+                "individual",
+            ],
+            [e["prop"] for e in entity_index],
+        )
+        self.assertEqual([1, 2, 2, 1, 1, 2], [e["level"] for e in entity_index])
+        self.assertEqual(
+            [None, "d1", "d1", None, None, "s1"],
+            [e["parent_uuid"] for e in entity_index],
+        )
+
+    def test_entity_index_paths(self):
+        form_format = {
+            "datasets": [
+                {
+                    "uuid": "d1",
+                    "process_events": [
+                        {"uuid": "p1", "results": [{"uuid": "r1"}]},
+                    ],
+                }
+            ]
+        }
+
+        entity_index = get_entity_index(form_format)
+        paths = {e["uuid"]: e["path"] for e in entity_index}
+
+        self.assertEqual([], paths["d1"])
+        self.assertEqual([{"prop": "dataset", "uuid": "d1"}], paths["p1"])
+        self.assertEqual(
+            [
+                {"prop": "dataset", "uuid": "d1"},
+                {"prop": "process_event", "uuid": "p1"},
+            ],
+            paths["r1"],
+        )
+        self.assertEqual(3, entity_index[-1]["level"])
+
+    def test_entity_index_ignores_entities_without_uuid(self):
+        form_format = {"study_id": "study_1", "keywords": ["a", "b"], "datasets": [{}]}
+
+        self.assertEqual([], get_entity_index(form_format))
+
+    def test_entity_index_of_one_entity(self):
+        form_format = {
+            "datasets": [
+                {"uuid": "d1", "process_events": [{"uuid": "p1"}]},
+                {
+                    "uuid": "d2",
+                    "process_events": [{"uuid": "p2", "results": [{"uuid": "r2"}]}],
+                },
+            ]
+        }
+
+        entity_index = get_entity_index(
+            form_format, [("datasets", "d2"), ("process_events", "p2")]
+        )
+
+        self.assertEqual(["p2", "r2"], [e["uuid"] for e in entity_index])
+        self.assertEqual([{"prop": "dataset", "uuid": "d2"}], entity_index[0]["path"])
+        self.assertEqual(
+            [], get_entity_index(form_format, [("datasets", "d3")]), "Deleted entity"
+        )
+
+
+class TestSampleIndex(unittest.TestCase):
+    def test_sample_keys_ignore_uuids(self):
+        existing = {
+            "uuid": "s1",
+            "sample_id": "S1",
+            "individual": {"uuid": "i1", "individual_id": "I1", "sex": "female"},
+        }
+        new = {
+            "sample_id": "S2",
+            "individual": {"individual_id": "I1", "sex": "female"},
+        }
+
+        self.assertEqual(
+            {"individual.individual_id:I1"}
+            | {k for k in get_sample_keys(new) if k.startswith("individual:")},
+            get_sample_keys(existing) & get_sample_keys(new),
+        )
+        self.assertIn("sample_id:S1", get_sample_keys(existing))
+
+    def test_sample_index(self):
+        samples = [
+            {"uuid": "s1", "sample_id": "S1", "treatments": [{"uuid": "t1"}]},
+            {"sample_id": "S2"},
+        ]
+
+        sample_index = get_sample_index(samples)
+
+        self.assertEqual({"s1"}, {item["uuid"] for item in sample_index})
+        self.assertEqual(
+            ["sample_id", "treatments"],
+            sorted(item["key"].split(":")[0] for item in sample_index),
+        )
@@ -0,0 +1,101 @@
+import unittest
+from types import SimpleNamespace
+
+from metadata_registration_lib.api_utils import FormatConverter
+
+from metadata_registration_api.api.api_study_sample import (
+    SampleUnifier,
+    set_unified_uuids,
+)
+from metadata_registration_api.mongo_utils import get_sample_index
+
+prop_id_to_name = {"p1": "samples", "p2": "sample_id", "p3": "uuid"}
+
+
+def get_study_converter(samples):
+    samples_api_format = [
+        [
+            {"property": "p2", "value": s["sample_id"]},
+            {"property": "p3", "value": s["uuid"]},
+        ]
+        for s in samples
+    ]
+    return FormatConverter(mapper=prop_id_to_name).add_api_format(
+        [{"property": "p1", "value": samples_api_format}]
+    )
+
+
+class StoredIndexSampleUnifier(SampleUnifier):
+    """Reads the sample index from a list instead of the SampleIndex collection"""
+
+    def __init__(self, stored_index, study_converter):
+        self.stored_index = stored_index
+        self.lookups = []
+        super().__init__(SimpleNamespace(id="study_1"), study_converter)
+
+    def has_stored_index(self):
+        return len(self.stored_index) > 0
+
+    def find_stored_uuids(self, keys):
+        self.lookups.append(keys)
+        return {item["uuid"] for item in self.stored_index if item["key"] in keys}
+
+
+class SampleUnifierTestCase(unittest.TestCase):
+    def test_existing_samples_of_previous_batches(self):
+        s1 = {"sample_id": "s1", "uuid": "u1"}
+        s2 = {"sample_id": "s2", "uuid": "u2"}
+        unifier = StoredIndexSampleUnifier(
+            get_sample_index([s1]), get_study_converter([s1])
+        )
+
+        # Batch 1 added s2 (the existing samples were replaced): only in the current entry
+        unifier.add_samples([s2])
+        study_converter = get_study_converter([s2])
+
+        # Batch 2 shares a key with s2 (current entry) and with s1 (initial entry, stored index)
+        existing_samples = unifier.get_existing_samples(
+            study_converter, {"sample_id:s2", "sample_id:s1"}
+        )
+
+        self.assertEqual([s1, s2], existing_samples)
+        self.assertEqual([{"sample_id:s2", "sample_id:s1"}], unifier.lookups)
+
+    def test_study_without_stored_index(self):
+        # Written before the sample index existed: its samples are indexed in memory
+        s1 = {"sample_id": "s1", "uuid": "u1"}
+        study_converter = get_study_converter([s1])
+        unifier = StoredIndexSampleUnifier([], study_converter)
+
+        self.assertEqual(
+            [s1], unifier.get_existing_samples(study_converter, {"sample_id:s1"})
+        )
+        self.assertEqual([], unifier.lookups)
+
+    def test_no_existing_samples(self):
+        study_converter = FormatConverter(mapper=prop_id_to_name).add_api_format([])
+        unifier = StoredIndexSampleUnifier([], study_converter)
+
+        self.assertEqual(
+            [], unifier.get_existing_samples(study_converter, {"sample_id:s1"})
+        )
+
+
+class SetUnifiedUuidsTestCase(unittest.TestCase):
+    def test_only_changed_entries_are_rebuilt(self):
+        prop_name_to_id = {name: prop_id for prop_id, name in prop_id_to_name.items()}
+        sample_form_format = {"sample_id": "s1"}
+        sample_converter = FormatConverter(mapper=prop_name_to_id)
+        sample_converter.add_form_format(sample_form_format)
+        sample_id_entry = sample_converter.get_entry_by_name("sample_id")
+
+        new_sample_form_format = {"sample_id": "s1", "uuid": "u1"}
+        sample_converter = set_unified_uuids(
+            sample_converter,
+            sample_form_format,
+            new_sample_form_format,
+            prop_name_to_id,
+        )
+
+        self.assertEqual(new_sample_form_format, sample_converter.get_form_format())
+        self.assertIs(sample_id_entry, sample_converter.get_entry_by_name("sample_id"))
@@ -0,0 +1,218 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from study_state_machine.context import Context
+from study_state_machine.errors import (
+    BehaviorNotAllowedException,
+    StateNotFoundException,
+)
+
+from metadata_registration_api.state_machine import (
+    StateMachine,
+    get_read_properties,
+)
+
+states = [
+    {
+        "name": "BeingEdited",
+        "strategies_create_study": [
+            {
+                "name": "expression",
+                "value": "len(kwargs.get('datasets', [])) > 0",
+                "state_if_true": "DatasetState",
+            }
+        ],
+        "strategies_change_state": [
+            {
+                "name": "expression",
+                "value": "len(kwargs.get('datasets', [])) > 0",
+                "state_if_true": "DatasetState",
+            }
+        ],
+    },
+    {
+        "name": "DatasetState",
+        "strategies_create_study": [],
+        "strategies_change_state": [
+            {
+                "name": "expression",
+                "value": "len(kwargs.get('datasets', [])) == 0",
+                "state_if_true": "BeingEdited",
+            }
+        ],
+    },
+    {
+        "name": "Locked",
+        "strategies_create_study": [],
+        "strategies_change_state": [{"name": "locked"}],
+    },
+]
+
+
+class StateMachineTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.state_machine = StateMachine(states)
+
+    def test_same_transitions_as_context(self):
+        context = Context(available_states=states)
+
+        for state_name in ["BeingEdited", "DatasetState"]:
+            for entries in [{}, {"datasets": [{"uuid": "d1"}]}]:
+                context.load_state(state_name)
+                context.change_state(**entries)
+                self.assertEqual(
+                    context.current_state,
+                    self.state_machine.change_state(state_name, entries),
+                )
+
+                context.load_state(state_name)
+                context.create_study(**entries)
+                self.assertEqual(
+                    context.current_state,
+                    self.state_machine.create_study(state_name, entries),
+                )
+
+    def test_locked_state(self):
+        with self.assertRaises(BehaviorNotAllowedException):
+            self.state_machine.change_state("Locked", {"datasets": []})
+
+    def test_unknown_state(self):
+        with self.assertRaises(StateNotFoundException):
+            self.state_machine.change_state("Unknown", {})
+
+    def test_concurrent_evaluations(self):
+        def evaluate(i):
+            entries = {"datasets": [{"uuid": "d1"}]} if i % 2 else {}
+            return self.state_machine.change_state("BeingEdited", entries)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(evaluate, range(200)))
+
+        self.assertEqual(
+            ["DatasetState" if i % 2 else "BeingEdited" for i in range(200)], results
+        )
+
+    def test_read_properties(self):
+        self.assertEqual(
+            {"datasets"}, get_read_properties("len(kwargs.get('datasets', [])) > 0")
+        )
+        self.assertEqual(
+            {"study_id", "datasets"},
+            get_read_properties(
+                "'study_id' in kwargs and all(d for d in kwargs['datasets'])"
+            ),
+        )
+        self.assertEqual({"samples"}, get_read_properties("'samples' not in kwargs"))
+        self.assertEqual(set(), get_read_properties("True"))
+
+        # Any property may be read
+        self.assertIsNone(get_read_properties("len(kwargs) > 2"))
+        self.assertIsNone(get_read_properties("kwargs.get(name)"))
+        self.assertIsNone(get_read_properties("len(args) > 0"))
+
+    def test_only_read_properties_passed(self):
+        state = self.state_machine.get_state("BeingEdited")
+        predicate = state.strategies["change_state"][0]["predicate"]
+        self.assertEqual({"datasets"}, predicate.props)
+        self.assertTrue(predicate({"datasets": [{"uuid": "d1"}], "samples": None}))
+
+    def test_transition_is_single_hop(self):
+        state_machine = StateMachine(
+            [
+                {
+                    "name": "A",
+                    "strategies_change_state": [
+                        {
+                            "name": "expression",
+                            "value": "len(kwargs.get('datasets', [])) > 0",
+                            "state_if_true": "B",
+                        }
+                    ],
+                },
+                {
+                    "name": "B",
+                    "strategies_change_state": [
+                        {
+                            "name": "expression",
+                            "value": "len(kwargs.get('samples', [])) > 0",
+                            "state_if_true": "C",
+                        }
+                    ],
+                },
+                {"name": "C", "strategies_change_state": []},
+            ]
+        )
+        entries = {"datasets": [{"uuid": "d1"}], "samples": [{"uuid": "s1"}]}
+
+        self.assertEqual("B", state_machine.change_state("A", entries))
+        # A was evaluated, not B: the next write evaluates B
+        evaluated_state = state_machine.get_evaluated_state("A", "B")
+        self.assertIsNone(evaluated_state)
+
+        # Next write (ex: a dataset changed), B reads the samples which were already there
+        self.assertEqual(
+            "C",
+            state_machine.change_state(
+                "B",
+                entries,
+                changed_props={"datasets"},
+                evaluated_state=evaluated_state,
+            ),
+        )
+
+    def test_skip_evaluated_state(self):
+        entries = {"datasets": [], "samples": [{"uuid": "s1"}]}
+        self.assertEqual(
+            "BeingEdited", self.state_machine.change_state("BeingEdited", entries)
+        )
+        evaluated_state = self.state_machine.get_evaluated_state(
+            "BeingEdited", "BeingEdited"
+        )
+        self.assertEqual(
+            self.state_machine.get_state("BeingEdited").key, evaluated_state
+        )
+
+        # Samples changed: the strategies of BeingEdited read the datasets only, not evaluated
+        # (the entries would give DatasetState)
+        entries = {"datasets": [{"uuid": "d1"}], "samples": [{"uuid": "s1"}]}
+        for changed_props, expected in [
+            ({"samples"}, "BeingEdited"),
+            ({"datasets"}, "DatasetState"),
+            # Unknown changes
+            (None, "DatasetState"),
+            (set(), "DatasetState"),
+        ]:
+            self.assertEqual(
+                expected,
+                self.state_machine.change_state(
+                    "BeingEdited",
+                    entries,
+                    changed_props=changed_props,
+                    evaluated_state=evaluated_state,
+                ),
+            )
+
+        # Not evaluated before, or evaluated with another definition of the state
+        other_definition = dict(states[0], strategies_change_state=[])
+        for evaluated_state in [
+            None,
+            StateMachine([other_definition]).get_state("BeingEdited").key,
+        ]:
+            self.assertEqual(
+                "DatasetState",
+                self.state_machine.change_state(
+                    "BeingEdited",
+                    entries,
+                    changed_props={"samples"},
+                    evaluated_state=evaluated_state,
+                ),
+            )
+
+        # A locked state is always evaluated
+        with self.assertRaises(BehaviorNotAllowedException):
+            self.state_machine.change_state(
+                "Locked",
+                entries,
+                changed_props={"samples"},
+                evaluated_state=self.state_machine.get_state("Locked").key,
+            )
@@ -0,0 +1,64 @@
+import unittest
+from datetime import datetime
+
+from bson import ObjectId
+
+from metadata_registration_api.state_machine import StateMachine
+from metadata_registration_api.state_reevaluation import (
+    get_state_changes,
+    get_state_updates,
+)
+
+states = [
+    {
+        "name": "BeingEdited",
+        "strategies_change_state": [
+            {
+                "name": "expression",
+                "value": "len(kwargs.get('datasets', [])) > 0",
+                "state_if_true": "DatasetState",
+            }
+        ],
+    },
+    {"name": "DatasetState", "strategies_change_state": []},
+    {"name": "Locked", "strategies_change_state": [{"name": "locked"}]},
+]
+
+
+class StateReevaluationTestCase(unittest.TestCase):
+    def test_state_changes(self):
+        study_ids = [str(ObjectId()) for _ in range(5)]
+        studies = [
+            (study_ids[0], "BeingEdited", {"datasets": [{"uuid": "d1"}]}),
+            (study_ids[1], "BeingEdited", {"samples": [{"uuid": "s1"}]}),
+            (study_ids[2], "DatasetState", {"datasets": []}),
+            (study_ids[3], "Locked", {"datasets": [{"uuid": "d1"}]}),
+            (study_ids[4], "Removed", {}),
+        ]
+
+        result = get_state_changes(studies, StateMachine(states))
+
+        self.assertEqual(
+            [(study_ids[0], "BeingEdited", "DatasetState")], result["changes"]
+        )
+        self.assertEqual(1, result["n_locked"])
+        self.assertEqual(1, result["n_errors"])
+
+    def test_state_updates(self):
+        study_id = str(ObjectId())
+        timestamp = datetime(2021, 1, 1)
+
+        [update] = get_state_updates(
+            [(study_id, "BeingEdited", "DatasetState")], timestamp
+        )
+
+        # Not applied if the state was changed meanwhile
+        self.assertEqual(
+            {"_id": ObjectId(study_id), "meta_information.state": "BeingEdited"},
+            update._filter,
+        )
+        self.assertEqual("DatasetState", update._doc["$set"]["summary.state"])
+        self.assertIn("meta_information.evaluated_state", update._doc["$unset"])
+        self.assertEqual(
+            timestamp, update._doc["$push"]["meta_information.change_log"]["timestamp"]
+        )
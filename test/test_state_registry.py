@@ -0,0 +1,126 @@
+import unittest
+
+from bson import ObjectId
+from mongoengine.errors import DoesNotExist
+from pymongo.errors import OperationFailure
+
+from metadata_registration_api.state_registry import StateRegistry
+
+
+class FakeDatabase:
+    def __init__(self, collection, allow_db_hash=True):
+        self.collection = collection
+        self.allow_db_hash = allow_db_hash
+
+    def command(self, name, collections):
+        if not self.allow_db_hash:
+            raise OperationFailure("not authorized")
+        return {"collections": {self.collection.name: str(self.collection.version)}}
+
+
+class FakeCollection:
+    """States collection counting the reads"""
+
+    name = "state"
+
+    def __init__(self, states, allow_db_hash=True):
+        self.states = states
+        self.version = 0
+        self.n_finds = 0
+        self.database = FakeDatabase(self, allow_db_hash)
+
+    def find(self, q):
+        self.n_finds += 1
+        return iter(self.states)
+
+
+class StateRegistryTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.state_id = ObjectId()
+        self.collection = FakeCollection(
+            [{"_id": self.state_id, "name": "BeingEdited"}]
+        )
+        self.registry = StateRegistry(self.collection, check_interval=0)
+
+    def test_indexed_by_id_and_name(self):
+        self.assertEqual(
+            self.registry.get_by_id(str(self.state_id))["name"], "BeingEdited"
+        )
+        self.assertEqual(self.registry.get_by_name("BeingEdited")["_id"], self.state_id)
+        with self.assertRaises(DoesNotExist):
+            self.registry.get_by_name("Unknown")
+
+    def test_reload_on_new_version_only(self):
+        self.registry.get_states()
+        self.registry.get_states()
+        self.assertEqual(self.collection.n_finds, 1)
+
+        self.collection.states = self.collection.states + [
+            {"_id": ObjectId(), "name": "Locked"}
+        ]
+        self.collection.version += 1
+
+        self.assertEqual(len(self.registry.get_states()), 2)
+        self.assertEqual(self.collection.n_finds, 2)
+
+    def test_check_interval(self):
+        registry = StateRegistry(self.collection, check_interval=3600)
+        registry.get_states()
+        self.collection.version += 1
+        registry.get_states()
+
+        self.assertEqual(self.collection.n_finds, 1)
+
+    def test_without_db_hash(self):
+        collection = FakeCollection([], allow_db_hash=False)
+        registry = StateRegistry(collection, check_interval=0)
+        registry.get_states()
+        registry.get_states()
+
+        self.assertEqual(collection.n_finds, 2)
+
+    def test_hot_swap_state_machine(self):
+        self.collection.states = [
+            {
+                "_id": self.state_id,
+                "name": "BeingEdited",
+                "strategies_change_state": [
+                    {"name": "expression", "value": "True", "state_if_true": "A"}
+                ],
+            }
+        ]
+        self.collection.version += 1
+        snapshot = self.registry.get_snapshot()
+
+        self.collection.states = [
+            {
+                "_id": self.state_id,
+                "name": "BeingEdited",
+                "strategies_change_state": [
+                    {"name": "expression", "value": "True", "state_if_true": "B"}
+                ],
+            }
+        ]
+        self.collection.version += 1
+
+        self.assertEqual(
+            self.registry.get_state_machine().change_state("BeingEdited", {}), "B"
+        )
+        # A request holding the previous snapshot is not affected
+        self.assertEqual(snapshot.state_machine.change_state("BeingEdited", {}), "A")
+
+    def test_invalid_definitions_keep_current_version(self):
+        snapshot = self.registry.get_snapshot()
+
+        self.collection.states = [
+            {
+                "_id": self.state_id,
+                "name": "BeingEdited",
+                "strategies_change_state": [
+                    {"name": "expression", "value": "len(", "state_if_true": "A"}
+                ],
+            }
+        ]
+        self.collection.version += 1
+
+        self.assertIs(self.registry.get_snapshot(), snapshot)
@@ -0,0 +1,71 @@
+import datetime
+import unittest
+
+import jwt
+
+from metadata_registration_api.user_cache import UserCache
+
+
+def get_token(user_id, minutes=30):
+    return jwt.encode(
+        {
+            "user_id": user_id,
+            "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=minutes),
+        },
+        "secret",
+        algorithm="HS256",
+    )
+
+
+class UserCacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loaded = []
+        self.users = {"u1": {"firstname": "Ada"}}
+
+        def load_user(user_id):
+            self.loaded.append(user_id)
+            return self.users.get(user_id)
+
+        self.cache = UserCache("secret", max_age=60, load_user=load_user)
+
+    def test_token_checked_once(self):
+        token = get_token("u1")
+        payload = self.cache.get_payload(token)
+        self.assertEqual("u1", payload["user_id"])
+        self.assertIs(payload, self.cache.get_payload(token))
+
+    def test_invalid_token(self):
+        with self.assertRaises(jwt.InvalidTokenError):
+            self.cache.get_payload(get_token("u1")[:-2])
+        with self.assertRaises(jwt.ExpiredSignatureError):
+            self.cache.get_payload(get_token("u1", minutes=-1))
+
+    def test_user_cached_until_invalidated(self):
+        self.assertEqual({"firstname": "Ada"}, self.cache.get_user("u1"))
+        self.assertEqual({"firstname": "Ada"}, self.cache.get_user("u1"))
+        self.assertEqual(["u1"], self.loaded)
+
+        self.users["u1"] = {"firstname": "Grace"}
+        self.cache.invalidate("u1")
+        self.assertEqual({"firstname": "Grace"}, self.cache.get_user("u1"))
+        self.assertEqual(["u1", "u1"], self.loaded)
+
+    def test_expired_tokens_removed(self):
+        self.cache.max_tokens = 2
+        self.cache._payloads["old"] = ({"user_id": "u1"}, 0)
+        self.cache.get_payload(get_token("u1"))
+        self.cache.get_payload(get_token("u2"))
+
+        self.assertNotIn("old", self.cache._payloads)
+        self.assertEqual(2, len(self.cache._payloads))
+
+    def test_max_tokens(self):
+        self.cache.max_tokens = 2
+        tokens = [get_token(user_id) for user_id in ["u1", "u2", "u3"]]
+        self.cache.get_payload(tokens[0])
+        self.cache.get_payload(tokens[1])
+        # Used again: u2 is the least recently used token
+        self.cache.get_payload(tokens[0])
+        self.cache.get_payload(tokens[2])
+
+        self.assertEqual([tokens[0], tokens[2]], list(self.cache._payloads))
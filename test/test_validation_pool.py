@@ -0,0 +1,118 @@
+import copy
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+from flask import Flask
+
+from metadata_registration_api.api.api_study import validate_forms_data
+from metadata_registration_api.errors import RequestBodyException
+from metadata_registration_api.validation_pool import ValidationPool
+
+FORM_TEMPLATE = {
+    "name": "study",
+    "fields": [
+        {
+            "class_name": "StringField",
+            "property": {"name": "study_id", "label": "Study ID", "description": "ID"},
+            "kwargs": {
+                "validators": {"args": {"objects": [{"class_name": "DataRequired"}]}}
+            },
+        }
+    ],
+}
+
+
+class SyncExecutor:
+    """Runs the submitted chunks in the current process, records their arguments"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args)
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class FormDataStore:
+    def load_form_by_name(self, form_name):
+        # The parser updates the template in place
+        return copy.deepcopy(FORM_TEMPLATE)
+
+
+class ValidationPoolTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = Flask(__name__)
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+        self.pool = ValidationPool(FormDataStore(), processes=3, min_batch_size=5)
+        self.executor = self.pool._executor = SyncExecutor()
+        self.app.validation_pool = self.pool
+
+    def tearDown(self) -> None:
+        self.app_context.pop()
+
+    def test_chunks(self):
+        # ceil(7 / 3) = 3 entries per chunk
+        forms_data = [{"study_id": f"study_{i}"} for i in range(7)]
+        errors = self.pool.validate_forms(forms_data, ["study"] * 7)
+
+        self.assertEqual([], errors)
+        self.assertEqual([0, 3, 6], [args[0] for args in self.executor.submitted])
+        self.assertEqual([3, 3, 1], [len(args[1]) for args in self.executor.submitted])
+
+        forms_data = [{"study_id": f"study_{i}"} for i in range(2)]
+        self.pool.validate_forms(forms_data, ["study"] * 2)
+        self.assertEqual([0, 1], [args[0] for args in self.executor.submitted[3:]])
+
+    def test_forms_errors(self):
+        forms_data = [{"study_id": "study_1"}, {}, {"study_id": "study_3"}, {}]
+        errors = self.pool.validate_forms(forms_data, ["study"] * 4)
+
+        # Indexes in the original order, not in the chunk
+        self.assertEqual([1, 3], [index for index, _ in errors])
+        self.assertTrue(all(isinstance(e, RequestBodyException) for _, e in errors))
+        self.assertIn("study_id", str(errors[0][1]))
+
+    def test_samples_first_error(self):
+        def validate_chunk(start, samples, validate_dict, form_templates):
+            return [
+                (start + i, RequestBodyException(f"Sample {start + i}"))
+                for i, sample in enumerate(samples)
+                if not sample["valid"]
+            ]
+
+        samples = [{"valid": i not in [4, 5]} for i in range(7)]
+        with mock.patch(
+            "metadata_registration_api.validation_pool._validate_chunk", validate_chunk
+        ):
+            with self.assertRaises(RequestBodyException) as cm:
+                self.pool.validate_samples(samples, {}, {"samples": "study"})
+            self.pool.validate_samples(samples[:4], {}, {"samples": "study"})
+
+        self.assertEqual("Sample 4", str(cm.exception))
+
+    def test_min_batch_size(self):
+        forms = {"study": mock.Mock(side_effect=AssertionError("Not in the pool"))}
+
+        # Large batch: pool
+        forms_data = [{"study_id": f"study_{i}"} for i in range(5)] + [{}]
+        errors = validate_forms_data(forms_data, ["study"] * 6, forms)
+        self.assertEqual([5], [index for index, _ in errors])
+        self.assertEqual(3, len(self.executor.submitted))
+
+        # Small batch: current process, with the given forms
+        form_cls = mock.Mock()
+        form_cls.return_value.validate.return_value = True
+        errors = validate_forms_data(forms_data[:4], ["study"] * 4, {"study": form_cls})
+        self.assertEqual([], errors)
+        self.assertEqual(4, form_cls.call_count)
+        self.assertEqual(3, len(self.executor.submitted))
+
+
+if __name__ == "__main__":
+    unittest.main()